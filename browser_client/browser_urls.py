@@ -17,5 +17,8 @@ urlpatterns = [
     url(r'^exit$', views.ExitLogin.as_view(), name='exit'),
 
     # GET    download exam template
-    url(r'^template$', views.ExamTemplateDownload.as_view(), name='download_t')
+    url(r'^template$', views.ExamTemplateDownload.as_view(), name='download_t'),
+
+    # GET    export attendance of a lesson as csv/xlsx
+    url(r'^attendance$', login_required(views.AttendanceExport.as_view()), name='export_attendance'),
 ]
@@ -0,0 +1,104 @@
+"""
+扫码登录状态推送(Server-Sent Events)
+
+浏览器通过 EventSource 连接 gdata.LOGIN_QR_EVENTS_PATH 后，连接被挂起，
+直至会话被微信端扫码(BrowserQRLogin.put)或二维码过期，期间浏览器无需轮询。
+会话存储支持推送时(logic.qr_login.RedisQRLoginStore)由扫码通知唤醒，否则服务端退避轮询会话。
+
+事件：
+    * success: 已扫码，浏览器随后调用一次 LoginView.post 完成登录
+    * expired: 二维码不存在或已过期，需刷新页面
+
+该处理器直接运行在 ASGI 入口(teaching_helper/asgi.py)，挂起期间不占用任何工作线程。
+"""
+import asyncio
+import time
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+
+from logic import qr_login
+from teaching_helper import gdata
+from teaching_helper import glog
+
+_logger = glog.get_logger(__name__)
+
+
+def _fetch_login_item(qr_uid):
+    try:
+        return qr_login.get_qr_login_store().fetch(qr_uid)
+    finally:
+        close_old_connections()
+
+
+async def _wait_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def qr_login_events(scope, receive, send):
+    """ASGI handler of the QR login event stream
+    """
+    query = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+    qr_uid = query.get('random_code', [''])[0]
+    fetch = sync_to_async(_fetch_login_item)
+    store = qr_login.get_qr_login_store()
+    scanned = store.watch(qr_uid) if qr_uid else None
+    if scanned is not None:
+        interval = gdata.LOGIN_QR_EVENTS_PING_SECS
+    else:
+        interval = gdata.LOGIN_QR_EVENTS_CHECK_SECS
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),  # disable nginx proxy buffering
+        ],
+    })
+
+    async def _event(name, data=''):
+        body = 'event: {}\ndata: {}\n\n'.format(name, data).encode('utf-8')
+        await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+
+    disconnect = asyncio.ensure_future(_wait_disconnect(receive))
+    started_at = last_ping = time.monotonic()
+    try:
+        while not disconnect.done():
+            if scanned is not None:
+                scanned.clear()  # 查询期间到达的通知会重新置位，不会丢失
+            item = await fetch(qr_uid) if qr_uid else None
+            if item is None or time.time() >= item.effective_time + gdata.LOGIN_QR_EXPIRED_SECS:
+                await _event('expired')
+                break
+            if item.user_id is not None:
+                await _event('success')
+                break
+
+            now = time.monotonic()
+            if now - started_at >= gdata.LOGIN_QR_EVENTS_MAX_SECS:
+                break
+            if now - last_ping >= gdata.LOGIN_QR_EVENTS_PING_SECS:
+                await send({'type': 'http.response.body', 'body': b': ping\n\n', 'more_body': True})
+                last_ping = now
+
+            if scanned is None:
+                await asyncio.wait([disconnect], timeout=interval)
+                interval = min(interval * 2, gdata.LOGIN_QR_EVENTS_MAX_CHECK_SECS)
+            else:
+                notified = asyncio.ensure_future(scanned.wait())
+                await asyncio.wait([disconnect, notified], timeout=interval, return_when=asyncio.FIRST_COMPLETED)
+                notified.cancel()
+    except Exception as e:
+        _logger.warning('qr login event stream error: {}'.format(e), exc_info=True)
+    finally:
+        if scanned is not None:
+            store.unwatch(qr_uid, scanned)
+        if not disconnect.done():
+            disconnect.cancel()
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
@@ -1,12 +1,11 @@
 import os
-import time
 import uuid
 import json
-from urllib.parse import urljoin
+from urllib.parse import quote, urljoin
 
 from django.conf import settings
 from django.contrib.auth import get_user_model, login, logout
-from django.http import JsonResponse, FileResponse, Http404
+from django.http import JsonResponse, FileResponse, Http404, StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.views import View
 
@@ -16,6 +15,8 @@ from fdfs_storage import fc
 from teaching_helper import gdata
 from teaching_helper import glog
 from wx_client import models as wx_models
+from logic import attendance
+from logic import qr_login
 from logic import resource_upload
 from wx_client.components.authentication import LoginRequire
 
@@ -65,14 +66,8 @@ class LoginView(View):
         """
         _ = self
         qr_uid = uuid.uuid4().hex
-        qr_generator = utils.QRCodeHelper.qr_code_helper()
-        qr_generator.generate_qr_code(qr_uid, path=gdata.LOGIN_QR_CODE_PATH)
-        now_timestamp = time.time()
-        qr_url = urljoin(gdata.HTTP_DOMAIN + '/images/loginqr/',
-                         '{}.png'.format(qr_uid)) if qr_generator.is_successful else ''
-        login_qr_obj = utils.LoginQRItem(now_timestamp, False, None, qr_url)
-        with gdata.LOGIN_QR_CODE_CACHE_LOCK:
-            gdata.LOGIN_QR_CODE_CACHE[qr_uid] = login_qr_obj
+        qr_url = utils.QRCodeHelper.qr_code_url(qr_uid)
+        qr_login.get_qr_login_store().create(qr_uid, qr_url)
 
         page_data = {'login_qr_addr': qr_url, 'auth_key': qr_uid}
         return render(request, 'login_index.html', context=page_data)
@@ -83,10 +78,8 @@ class LoginView(View):
         _ = self
         try:
             login_id = request.POST.get('random_code')
-            with gdata.LOGIN_QR_CODE_CACHE_LOCK:
-                qr_code_cache = gdata.LOGIN_QR_CODE_CACHE
-
-            login_record = qr_code_cache.get(login_id)  # type: utils.LoginQRItem
+            store = qr_login.get_qr_login_store()
+            login_record = store.fetch(login_id)  # type: utils.LoginQRItem
             _logger.debug('login authenticator item: {}'.format(login_record))
             if not login_record:
                 return JsonResponse({'url': '', 'errmsg': '请刷新页面并重新尝试'})
@@ -94,7 +87,7 @@ class LoginView(View):
                 return JsonResponse({'url': '', 'errmsg': '请打开微信扫码'})
 
             login(request, User(id=login_record.user_id))
-            del qr_code_cache[login_id]
+            store.consume(login_id)
             return JsonResponse({'url': urljoin(gdata.HTTP_DOMAIN, 'api/v1/browser_client/index'), 'errmsg': ''})
         except (ValueError, Exception) as e:
             _logger.warning('效验登录态失败: {}'.format(e), exc_info=True)
@@ -111,7 +104,7 @@ class UploadFile(View):
                     'lesson_code': t.lesson_code,
                     'lesson_name': t.lesson_name,
                     'stu_num': t.stu_num,
-                } for t in user.teaching_lessons.all()]
+                } for t in user.teaching_lessons.select_related('counter').all()]
         })
 
     def post(self, request, **_):
@@ -178,3 +171,29 @@ class ExamTemplateDownload(View):
         except Exception as err:
             _logger.warning('Failed to download examination: {}'.format(err), exc_info=True)
             raise Http404
+
+
+class AttendanceExport(View):
+
+    def get(self, request, **_):
+        """导出班课考勤表
+
+        :param: lesson_code 班课码, fmt csv(默认)/xlsx
+        :remark:
+            * csv 边查询边输出；xlsx 先按行写入临时文件，再分块返回
+        """
+        _ = self
+        fmt = request.GET.get('fmt', 'csv')
+        lesson = wx_models.Lesson.objects.filter(lesson_code=request.GET.get('lesson_code', ''),
+                                                 teacher_id=request.user.id).only('id', 'lesson_name').first()
+        if lesson is None or fmt not in ('csv', 'xlsx'):
+            raise Http404
+
+        filename = quote('{}-考勤.{}'.format(lesson.lesson_name or lesson.id, fmt))
+        if fmt == 'csv':
+            response = StreamingHttpResponse(attendance.iter_csv(lesson.id), content_type='text/csv; charset=utf-8')
+        else:
+            response = FileResponse(attendance.write_xlsx(lesson.id), content_type=(
+                'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'))
+        response['Content-Disposition'] = "attachment; filename*=UTF-8''{}".format(filename)
+        return response
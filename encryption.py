@@ -2,20 +2,62 @@
 common salt: settings.SECRET_KEY
 
 support:
-    * PKCS #5: use HMAC
+    * PKCS #5: use HMAC (legacy, `sha256`)
+    * keyed HMAC login index, versioned (`login_index`)
 """
 from django.conf.global_settings import SECRET_KEY
+from django.conf import settings
+import functools
 import hashlib
+import hmac
 import binascii
 
+LOGIN_INDEX_FORMAT = 'h{version}${digest}'
+
 
 def sha256(data):
+    """legacy index of `UserProfile.encrypted_code`, 100000 rounds of PBKDF2 per call
+    """
     b_data = bytes(data, encoding='utf-8')
     salt = bytes(SECRET_KEY, encoding='utf-8')
     dk = hashlib.pbkdf2_hmac('sha256', b_data, salt, 100000)
     return str(binascii.hexlify(dk), encoding='utf-8')
 
 
+@functools.lru_cache(maxsize=None)
+def _login_index_key(version):
+    """derive the HMAC key of the specified version, the KDF cost is paid once per process
+    """
+    secret = bytes(settings.LOGIN_INDEX_KEYS[version], encoding='utf-8')
+    salt = bytes('login-index-v{}'.format(version), encoding='utf-8')
+    return hashlib.pbkdf2_hmac('sha256', secret, salt, settings.LOGIN_INDEX_KDF_ITERATIONS)
+
+
+def login_index(data, version=None):
+    """keyed HMAC-SHA256 index of `data`
+
+    the index can't be reversed or brute-forced without the key, and costs microseconds per call
+
+    :param data: openid
+    :param version: key version, default -> settings.LOGIN_INDEX_VERSION
+    :return: 'h<version>$<hex digest>'
+    """
+    if version is None:
+        version = settings.LOGIN_INDEX_VERSION
+    digest = hmac.new(_login_index_key(version), bytes(data, encoding='utf-8'), hashlib.sha256).hexdigest()
+    return LOGIN_INDEX_FORMAT.format(version=version, digest=digest)
+
+
+def legacy_login_indexes(data):
+    """indexes which `data` may be stored as before re-keying, newest first
+    """
+    indexes = [login_index(data, version) for version in sorted(settings.LOGIN_INDEX_KEYS, reverse=True)
+               if version != settings.LOGIN_INDEX_VERSION]
+    if settings.LOGIN_INDEX_LEGACY_FALLBACK:
+        indexes.append(sha256(data))
+    return indexes
+
+
 if __name__ == '__main__':
     print(sha256('123'))
     print(sha256('123'))
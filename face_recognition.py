@@ -6,23 +6,58 @@ face recognition related function
     reference: https://ai.baidu.com/ai-doc/FACE/ek37c1qiz
 * check validation of face-image requested，verify this image have common face_token in database.
     reference model: FeatureForSignIn
+* AIPFaceService: every call to AIP goes through a bounded thread pool and a token bucket,
+    detect results are cached by image content, concurrent duplicate calls are collapsed into one
+* pluggable face-match backends (settings.FACE_BACKEND)
+    AIPFaceBackend: faces are registered in an AIP face library group,
+        a probe is matched against the lesson with one 1:N library search,
+        a group photo with one M:N library search
+    LocalEmbeddingBackend: float32 embeddings stored in FeatureForSignIn.embedding,
+        a probe is matched against the whole lesson with one matrix-vector product
 """
 
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import base64
+import functools
+import hashlib
+import json
+import threading
+import time
 
 from aip import AipFace
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+import numpy as np
 
+import utils
 from teaching_helper import gdata
 from teaching_helper import glog
+from teaching_helper.exception import RateLimitError
+from wx_client import models
 
 _logger = glog.get_logger(__name__)
 
 aip_client = AipFace(**gdata.AIP_KWARGS)
+aip_client.setConnectionTimeoutInMillis(gdata.HTTP_CONNECT_TIMEOUT * 1000)
+aip_client.setSocketTimeoutInMillis(gdata.HTTP_READ_TIMEOUT * 1000)
 
 
 # functions
 
 
+def read_img_data(path):
+    """
+    :param path: face-image path
+    :return: raw bytes, None if the file can't be read
+    """
+    try:
+        with open(path, mode='rb') as face_img:
+            return face_img.read()
+    except OSError as _:
+        return None
+
+
 def generate_b64encode_img_data(path):
     """
     :param path: face-image path
@@ -39,9 +74,150 @@ def generate_b64encode_img_data(path):
         return None
 
 
+def decode_b64_image(b64_data):
+    """base64 图片(可带 data:image/...;base64, 前缀)解码为字节，无效时返回None
+    """
+    try:
+        return base64.b64decode(b64_data.split(',', 1)[-1], validate=True)
+    except (ValueError, AttributeError) as _:
+        return None
+
+
+def guess_image_suffix(image):
+    """按文件头判断图片格式，未知格式按jpg处理
+    """
+    if image.startswith(b'\x89PNG'):
+        return 'png'
+    if image.startswith(b'GIF8'):
+        return 'gif'
+    return 'jpg'
+
+
 # classes
 
 
+class AIPFaceService(object):
+    """concurrent, rate-limited and cached access to the AIP face api
+
+    * requests run on a bounded thread pool, callers get a Future
+    * every request takes a token from a bucket sized to the AIP QPS quota
+    * detect results are cached by (sha256 of the image, options), error responses are not cached
+    * concurrent requests for the same content share one in-flight request
+    * images are base64-encoded by the worker right before sending
+    """
+
+    FACE_TOKEN = 'FACE_TOKEN'
+
+    def __init__(self, client, qps=gdata.AIP_QPS, burst=gdata.AIP_BURST, max_workers=gdata.AIP_MAX_WORKERS):
+        self.client = client
+        self.bucket = utils.TokenBucket(qps, burst)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='th-aip')
+        self.detect_cache = utils.LRUCache(max_size=gdata.AIP_DETECT_CACHE_SIZE, ttl=gdata.AIP_DETECT_CACHE_TTL)
+        self.flight = utils.SingleFlight()
+        self.request_count = 0
+        self._count_lock = threading.Lock()
+
+    def _request(self, method, *args, **kwargs):
+        if not self.bucket.acquire(timeout=gdata.AIP_QUOTA_WAIT):
+            raise RateLimitError('aip')
+        with self._count_lock:
+            self.request_count += 1
+        res = getattr(self.client, method)(*args, **kwargs)
+        if res.get('error_code'):
+            _logger.warning('AIP {} failed, error_code:{} error_msg:{}'.format(
+                method, res.get('error_code'), res.get('error_msg')))
+        return res
+
+    @staticmethod
+    def _encode(image):
+        return base64.b64encode(image).decode()
+
+    def submit_detect(self, image, options=None) -> Future:
+        options = options or gdata.AIP_CLIENT_ARGS.get('options')
+        key = ('detect', hashlib.sha256(image).hexdigest(), json.dumps(options, sort_keys=True))
+        res = self.detect_cache.get(key)
+        if res is not None:
+            future = Future()
+            future.set_result(res)
+            return future
+        return self.flight.submit(self.executor, key, self._detect, key, image, options)
+
+    def _detect(self, key, image, options):
+        res = self.detect_cache.get(key)  # finished by an earlier flight
+        if res is not None:
+            return res
+        res = self._request('detect', image=self._encode(image), image_type=gdata.AIP_CLIENT_ARGS.get('image_type'),
+                            options=options)
+        if not res.get('error_code'):
+            self.detect_cache.set(key, res)
+        return res
+
+    def detect(self, image, options=None, timeout=gdata.AIP_CALL_TIMEOUT) -> dict:
+        return self.submit_detect(image, options).result(timeout)
+
+    def submit_match(self, images) -> Future:
+        """
+        :param images: raw image bytes, or face_token str
+        """
+        images = list(images)
+        key = ('match',) + tuple(hashlib.sha256(_i).hexdigest() if isinstance(_i, bytes) else _i for _i in images)
+        return self.flight.submit(self.executor, key, self._match, images)
+
+    def _match(self, images):
+        return self._request('match', [
+            {'image': self._encode(_i), 'image_type': gdata.AIP_CLIENT_ARGS.get('image_type')}
+            if isinstance(_i, bytes) else {'image': _i, 'image_type': self.FACE_TOKEN}
+            for _i in images])
+
+    def match(self, images, timeout=gdata.AIP_CALL_TIMEOUT) -> dict:
+        return self.submit_match(images).result(timeout)
+
+    def submit_search(self, image, max_face_num=1) -> Future:
+        """在人脸库用户组 gdata.AIP_FACE_GROUP 中搜索
+
+        :param max_face_num: 大于1时为合照 M:N 搜索(multiSearch)，结果按人脸列出
+        """
+        key = ('search', hashlib.sha256(image).hexdigest(), max_face_num)
+        return self.flight.submit(self.executor, key, self._search, image, max_face_num)
+
+    def _search(self, image, max_face_num):
+        options = {'max_user_num': gdata.AIP_SEARCH_MAX_USER_NUM}
+        method = 'search'
+        if max_face_num > 1:
+            options['max_face_num'] = max_face_num
+            method = 'multiSearch'
+        return self._request(method, image=self._encode(image), image_type=gdata.AIP_CLIENT_ARGS.get('image_type'),
+                             group_id_list=gdata.AIP_FACE_GROUP, options=options)
+
+    def search(self, image, max_face_num=1, timeout=gdata.AIP_CALL_TIMEOUT) -> dict:
+        return self.submit_search(image, max_face_num).result(timeout)
+
+    def add_user(self, image, user_id, timeout=gdata.AIP_CALL_TIMEOUT) -> dict:
+        """注册用户人脸到 gdata.AIP_FACE_GROUP，已注册的用户覆盖原人脸
+
+        :param image: raw image bytes, or face_token str
+        """
+        return self.executor.submit(self._add_user, image, str(user_id)).result(timeout)
+
+    def _add_user(self, image, user_id):
+        if isinstance(image, bytes):
+            image, image_type = self._encode(image), gdata.AIP_CLIENT_ARGS.get('image_type')
+        else:
+            image_type = self.FACE_TOKEN
+        return self._request('addUser', image=image, image_type=image_type, group_id=gdata.AIP_FACE_GROUP,
+                             user_id=user_id, options={'action_type': 'REPLACE'})
+
+    def stats(self):
+        return {
+            'requests': self.request_count,
+            'in_flight': len(self.flight),
+            'detect_cache': self.detect_cache.stats(),
+        }
+
+
+aip_service = AIPFaceService(aip_client)
+
+
 class FaceRecognitionAccess(object):
 
     @staticmethod
@@ -52,25 +228,333 @@ class FaceRecognitionAccess(object):
             * reference -> https://ai.baidu.com/ai-doc/FACE/ek37c1qiz#%E4%BA%BA%E8%84%B8%E6%A3%80%E6%B5%8B
         """
 
-        b64encode_data = generate_b64encode_img_data(face_img_path)
-        res = aip_client.detect(image=b64encode_data,
-                                image_type=gdata.AIP_CLIENT_ARGS.get('image_type'),
-                                options=options)
+        image = read_img_data(face_img_path)
+        if image is None:
+            return None
+        res = aip_service.detect(image, options=options)
 
         return res.get('result', None)
 
     @staticmethod
-    def similarity_in_img_list(face_image_paths) -> bool:
+    def similarity_in_img_list(face_image_paths) -> dict:
         """Comparing two people's faces is consistent
 
         :param face_image_paths
             Both sets of face image paths, guaranteed to be iterative
         """
 
-        http_args = [
-            {
-                'image': generate_b64encode_img_data(_path),
-                'image_type': gdata.AIP_CLIENT_ARGS.get('image_type'),
-            } for _path in face_image_paths]
+        images = [read_img_data(_path) for _path in face_image_paths]
+        if any(_i is None for _i in images):
+            return {'error_code': -1, 'error_msg': 'failed to read face images', 'result': None}
+
+        return aip_service.match(images)
+
 
-        return aip_client.match(http_args)
+# ---------------------------------------------
+# face-match backends
+
+
+class BaseFaceBackend(object):
+    """人脸比对后端
+
+    图片均为原始字节(bytes)，score 取值 [0, 1]；
+    除 match_batch 外每张图片按一张人脸处理，match_batch 每张图片最多 faces_per_image 张人脸(合照)
+    """
+
+    name = ''
+    # 整班签到(match_batch)单次的图片数及单张图片大小上限
+    faces_per_image = 1
+    batch_max_images = gdata.FACE_BATCH_MAX_PROBES
+    batch_image_max_size = gdata.FACE_BATCH_IMAGE_MAX_SIZE
+
+    def enroll(self, image, user_id=None) -> dict:
+        """录入人脸时需要额外写入 FeatureForSignIn 的字段，录入失败时返回None
+        """
+        raise NotImplementedError
+
+    def verify(self, image, user_id) -> float:
+        """1:1 比对，用户未录入人脸时返回0
+        """
+        raise NotImplementedError
+
+    def match(self, image, lesson_id, top_k=1) -> list:
+        """1:N 比对，在班课全部学生中查找
+
+        :return: [(user_id, score), ...]，按 score 降序
+        """
+        records = models.FeatureForSignIn.objects.filter(
+            user__listening_lessons=lesson_id).values_list('user_id', flat=True)
+        scores = [(_id, self.verify(image, _id)) for _id in records]
+        return sorted(scores, key=lambda _s: _s[1], reverse=True)[:top_k]
+
+    def match_batch(self, images, lesson_id, threshold=gdata.FACE_MATCH_THRESHOLD):
+        """多张人脸与班课全部学生比对，每张人脸最多认定一名学生
+
+        :param images: 图片(bytes)的可迭代对象，可以是生成器
+        :return: (scores, matched)
+            scores: {user_id: 各人脸中的最高得分}
+            matched: {user_id: score}，被某张人脸认定(得分最高且不低于阈值)的学生
+        """
+        scores, matched = {}, {}
+        for image in images:
+            ranked = self.match(image, lesson_id, top_k=1)
+            if not ranked:
+                continue
+            user_id, score = ranked[0]
+            scores[user_id] = max(score, scores.get(user_id, 0.0))
+            if score >= threshold:
+                matched[user_id] = scores[user_id]
+        return scores, matched
+
+
+class AIPFaceBackend(BaseFaceBackend):
+    """BaiDu AIP 人脸库，face_token 由客户端检测后上传
+
+    录入的人脸注册到用户组 gdata.AIP_FACE_GROUP(user_id 为 UserProfile.id)，
+    与班课比对是一次人脸库搜索，候选人再按班课学生过滤，请求数与班课人数无关；
+    整班签到的图片可以是合照，每张合照一次 M:N 搜索
+    """
+
+    name = 'aip'
+    faces_per_image = gdata.AIP_GROUP_PHOTO_MAX_FACES
+    batch_max_images = gdata.AIP_BATCH_MAX_IMAGES
+    batch_image_max_size = gdata.AIP_BATCH_IMAGE_MAX_SIZE
+
+    def enroll(self, image, user_id=None):
+        try:
+            res = aip_service.add_user(image, user_id)
+        except (RateLimitError, FutureTimeoutError) as e:
+            _logger.warning('AIP addUser failed, [UserProfile:{}] error:{!r}'.format(user_id, e))
+            return None
+        return None if res.get('error_code') else {}
+
+    def verify(self, image, user_id):
+        record = models.FeatureForSignIn.objects.filter(user_id=user_id).only('face_token').first()
+        if record is None:
+            return 0.0
+        return self._score(aip_service.match([image, record.face_token]), user_id)
+
+    def match(self, image, lesson_id, top_k=1):
+        """AIP配额不足或超时时按未匹配处理，返回空列表
+        """
+        try:
+            res = aip_service.search(image)
+        except (RateLimitError, FutureTimeoutError) as e:
+            _logger.warning('AIP search failed, [Lesson:{}] error:{!r}'.format(lesson_id, e))
+            return []
+        if res.get('error_code'):
+            return []
+        candidates = self._candidates(res['result'].get('user_list'))
+        members = self._lesson_members(candidates, lesson_id)
+        scores = [(_id, _score) for _id, _score in candidates.items() if _id in members]
+        return sorted(scores, key=lambda _s: _s[1], reverse=True)[:top_k]
+
+    def match_batch(self, images, lesson_id, threshold=gdata.FACE_MATCH_THRESHOLD):
+        """每张图片(可以是合照)一次 M:N 搜索，请求全部提交后在 gdata.AIP_CALL_TIMEOUT 内统一等待
+
+        配额不足、超时或出错的图片跳过，全部图片都失败时抛出 RateLimitError
+        """
+        futures = [aip_service.submit_search(_i, self.faces_per_image) for _i in images]
+        deadline = time.monotonic() + gdata.AIP_CALL_TIMEOUT
+        faces, failed = [], 0
+        for future in futures:
+            try:
+                res = future.result(max(0.0, deadline - time.monotonic()))
+            except (RateLimitError, FutureTimeoutError) as e:
+                _logger.warning('AIP multiSearch failed, [Lesson:{}] error:{!r}'.format(lesson_id, e))
+                failed += 1
+                continue
+            if res.get('error_code') == gdata.AIP_ERROR_USER_NOT_FOUND:
+                continue
+            if res.get('error_code'):
+                failed += 1
+                continue
+            faces.extend(self._candidates(_f.get('user_list')) for _f in res['result'].get('face_list') or [])
+        if futures and failed == len(futures):
+            raise RateLimitError('aip')
+
+        members = self._lesson_members(set().union(*faces), lesson_id)
+        scores, matched = {}, {}
+        for candidates in faces:
+            ranked = [(_id, _score) for _id, _score in candidates.items() if _id in members]
+            if not ranked:
+                continue
+            user_id, score = max(ranked, key=lambda _s: _s[1])
+            scores[user_id] = max(score, scores.get(user_id, 0.0))
+            if score >= threshold:
+                matched[user_id] = scores[user_id]
+        return scores, matched
+
+    @staticmethod
+    def _candidates(user_list):
+        """人脸库搜索的候选人
+
+        :return: {user_id: score}
+        """
+        candidates = {}
+        for user in user_list or []:
+            try:
+                user_id = int(user['user_id'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            candidates[user_id] = max(user.get('score', 0) / 100.0, candidates.get(user_id, 0.0))
+        return candidates
+
+    @staticmethod
+    def _lesson_members(user_ids, lesson_id):
+        """user_ids 中已录入人脸的班课学生
+        """
+        if not user_ids:
+            return set()
+        return set(models.FeatureForSignIn.objects.filter(
+            user__listening_lessons=lesson_id, user_id__in=user_ids).values_list('user_id', flat=True))
+
+    @staticmethod
+    def _score(res, user_id):
+        if res.get('error_code'):
+            _logger.warning('AIP match failed, [UserProfile:{}] error:{}'.format(user_id, res.get('error_msg')))
+            return 0.0
+        return res['result']['score'] / 100.0
+
+
+class StubEmbedder(object):
+    """确定性的伪人脸特征：以图片内容的哈希为种子生成单位向量
+
+    同一张图片总是得到同一特征，用于测试及压测，不具备识别能力
+    """
+
+    def __init__(self, dim=gdata.FACE_EMBEDDING_DIM):
+        self.dim = dim
+
+    def __call__(self, image):
+        seed = int.from_bytes(hashlib.sha256(image).digest()[:8], 'little')
+        vector = np.random.RandomState(seed % 2 ** 32).standard_normal(self.dim).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+
+def to_embedding_bytes(vector):
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def from_embedding_bytes(data):
+    return np.frombuffer(data, dtype=np.float32)
+
+
+class LessonFaceMatrix(object):
+    """班课学生人脸特征矩阵(每行一个学生，已归一化)
+    """
+
+    __slots__ = ('user_ids', 'matrix')
+
+    def __init__(self, user_ids, matrix):
+        self.user_ids = user_ids
+        self.matrix = matrix
+
+    @classmethod
+    def load(cls, lesson_id, dim):
+        rows = models.FeatureForSignIn.objects.filter(
+            user__listening_lessons=lesson_id, embedding__isnull=False).values_list('user_id', 'embedding')
+        user_ids, vectors = [], []
+        for user_id, data in rows.iterator():
+            vector = from_embedding_bytes(bytes(data))
+            if vector.shape == (dim,):
+                user_ids.append(user_id)
+                vectors.append(vector)
+        matrix = np.vstack(vectors) if vectors else np.empty((0, dim), dtype=np.float32)
+        return cls(np.asarray(user_ids, dtype=np.int64), matrix)
+
+
+class LocalEmbeddingBackend(BaseFaceBackend):
+    """本地特征比对，特征由 settings.FACE_EMBEDDER 生成
+
+    班课特征矩阵缓存在进程内，学生加入班课或重新录入人脸时失效(wx_client.signals)
+    """
+
+    name = 'local'
+
+    def __init__(self, embedder=None, dim=gdata.FACE_EMBEDDING_DIM):
+        self.dim = dim
+        if embedder is None:
+            if not getattr(settings, 'FACE_EMBEDDER', None):
+                raise ImproperlyConfigured('LocalEmbeddingBackend requires settings.FACE_EMBEDDER')
+            embedder = import_string(settings.FACE_EMBEDDER)(dim)
+        self.embedder = embedder
+        self.matrices = utils.LRUCache(max_size=gdata.FACE_MATRIX_CACHE_SIZE, ttl=gdata.FACE_MATRIX_CACHE_TTL)
+        self._lock = threading.Lock()
+
+    def embed(self, image):
+        vector = np.asarray(self.embedder(image), dtype=np.float32)
+        assert vector.shape == (self.dim,), 'unexpected embedding shape {}'.format(vector.shape)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def enroll(self, image, user_id=None):
+        return {'embedding': to_embedding_bytes(self.embed(image))}
+
+    def verify(self, image, user_id):
+        record = models.FeatureForSignIn.objects.filter(user_id=user_id, embedding__isnull=False).only(
+            'embedding').first()
+        if record is None:
+            return 0.0
+        return self._score(from_embedding_bytes(bytes(record.embedding)) @ self.embed(image))
+
+    def lesson_matrix(self, lesson_id):
+        matrix = self.matrices.get(lesson_id)
+        if matrix is None:
+            with self._lock:
+                matrix = self.matrices.get(lesson_id)
+                if matrix is None:
+                    matrix = LessonFaceMatrix.load(lesson_id, self.dim)
+                    self.matrices.set(lesson_id, matrix)
+        return matrix
+
+    def invalidate(self, lesson_ids):
+        for lesson_id in lesson_ids:
+            self.matrices.pop(lesson_id)
+
+    def match(self, image, lesson_id, top_k=1):
+        matrix = self.lesson_matrix(lesson_id)
+        if not len(matrix.user_ids):
+            return []
+        scores = matrix.matrix @ self.embed(image)
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [(int(matrix.user_ids[_i]), self._score(scores[_i])) for _i in best]
+
+    def match_batch(self, images, lesson_id, threshold=gdata.FACE_MATCH_THRESHOLD):
+        """全部人脸与班课特征矩阵一次相乘，得到 人脸数 x 学生数 的得分矩阵
+
+        图片逐张读取并提取特征，内存中只保留特征向量
+        """
+        matrix = self.lesson_matrix(lesson_id)
+        if not len(matrix.user_ids):
+            return {}, {}
+
+        probes = [self.embed(_i) for _i in images]
+        if not probes:
+            return {}, {}
+        probes = np.vstack(probes)
+        cosines = probes @ matrix.matrix.T
+        best = cosines.argmax(axis=1)
+        best_scores = cosines[np.arange(len(best)), best]
+
+        scores = {int(_u): self._score(_c) for _u, _c in zip(matrix.user_ids, cosines.max(axis=0))}
+        matched = {}
+        for idx, cosine in zip(best.tolist(), best_scores.tolist()):
+            user_id = int(matrix.user_ids[idx])
+            if self._score(cosine) >= threshold:
+                matched[user_id] = scores[user_id]
+        return scores, matched
+
+    @staticmethod
+    def _score(cosine):
+        """余弦相似度映射到 [0, 1]
+        """
+        return float(max(0.0, min(1.0, (cosine + 1) / 2)))
+
+
+@functools.lru_cache(maxsize=None)
+def get_face_backend():
+    """获取settings.FACE_BACKEND指定的人脸比对后端(单例)
+    """
+    return import_string(settings.FACE_BACKEND)()
@@ -1,20 +1,261 @@
+import collections
+import contextlib
+import hashlib
+import struct
+import threading
+import time
+
 from django.conf import settings
 from django.core.files.storage import Storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
 from django.utils.deconstruct import deconstructible
-from fdfs_client.client import Fdfs_client
+from fdfs_client.client import Fdfs_client, get_tracker_conf
+from fdfs_client.exceptions import (ConnectionError as FDFSConnectionError, DataError as FDFSDataError,
+                                    ResponseError as FDFSResponseError)
+from fdfs_client.storage_client import Storage_client
+from fdfs_client.tracker_client import Tracker_client
+from fdfs_client.utils import split_remote_fileid
 
+from teaching_helper import gdata
 from teaching_helper import glog
+from teaching_helper.exception import StoragePoolTimeout
+from wx_client import models
 
 _logger = glog.get_logger(__name__)
 
+# errors after which a client (and its tracker/storage connections) is dropped,
+# struct.error is raised by fdfs_client when the server closes a connection halfway
+CONNECTION_ERRORS = (FDFSConnectionError, FDFSResponseError, OSError, struct.error)
+# errors after which a call is retried with a new client; uploads are not idempotent, so a call that may have
+# reached the storage server (bad response, timeout, connection closed halfway) is not retried
+RETRY_ERRORS = (FDFSConnectionError,)
+
+
+class PooledFdfsClient(Fdfs_client):
+    """复用 storage 连接的 Fdfs_client
+
+    :remark:
+        * Fdfs_client 每次上传/删除都新建 Storage_client(即新建到 storage 的连接)，
+          此处按 storage 地址 (ip, port) 缓存 Storage_client，其连接在调用之间保持
+        * 只覆盖 FastDFSStorage 用到的方法
+        * 客户端由 FdfsClientPool 分配，同一时间只被一个线程使用，缓存无需加锁；
+          出现连接错误时整个客户端(含缓存的 Storage_client)被丢弃
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._storages = {}
+
+    def _storage(self, store_serv):
+        key = (store_serv.ip_addr, store_serv.port)
+        store = self._storages.get(key)
+        if store is None:
+            store = self._storages[key] = Storage_client(store_serv.ip_addr, store_serv.port, self.timeout)
+        return store
+
+    def _query(self, query, *args):
+        """向 tracker 查询 storage 地址
+
+        查询时尚未写入任何数据，出错统一转为可重试的连接错误
+        """
+        tc = Tracker_client(self.tracker_pool)
+        try:
+            return tc, getattr(tc, query)(*args)
+        except CONNECTION_ERRORS as e:
+            raise FDFSConnectionError('[-] Error: tracker query failed, {!r}'.format(e)) from e
+
+    @staticmethod
+    def _split(remote_file_id):
+        ret = split_remote_fileid(remote_file_id)
+        if not ret:
+            raise FDFSDataError('[-] Error: remote_file_id is invalid.')
+        return ret
+
+    def upload_by_buffer(self, filebuffer, file_ext_name=None, meta_dict=None):
+        if not filebuffer:
+            raise FDFSDataError('[-] Error: argument filebuffer can not be null.')
+        tc, store_serv = self._query('tracker_query_storage_stor_without_group')
+        return self._storage(store_serv).storage_upload_by_buffer(tc, store_serv, filebuffer, file_ext_name,
+                                                                  meta_dict)
+
+    def upload_appender_by_buffer(self, filebuffer, file_ext_name=None, meta_dict=None):
+        if not filebuffer:
+            raise FDFSDataError('[-] Error: argument filebuffer can not be null.')
+        tc, store_serv = self._query('tracker_query_storage_stor_without_group')
+        return self._storage(store_serv).storage_upload_appender_by_buffer(tc, store_serv, filebuffer, meta_dict,
+                                                                           file_ext_name)
+
+    def append_chunks_by_buffer(self, chunks, remote_fileid):
+        """向追加文件依次追加多个块，只查询一次 tracker，全部块经同一 Storage_client(连接)发送
+
+        :return: 追加的字节数
+        """
+        group_name, appended_filename = self._split(remote_fileid)
+        tc, store_serv = self._query('tracker_query_storage_update', group_name, appended_filename)
+        store = self._storage(store_serv)
+        size = 0
+        for chunk in chunks:
+            store.storage_append_by_buffer(tc, store_serv, chunk, appended_filename)
+            size += len(chunk)
+        return size
+
+    def delete_file(self, remote_file_id):
+        group_name, remote_filename = self._split(remote_file_id)
+        tc, store_serv = self._query('tracker_query_storage_update', group_name, remote_filename)
+        return self._storage(store_serv).storage_delete_file(tc, store_serv, remote_filename)
+
+
+class FdfsClientPool(object):
+    """线程安全的 Fdfs_client 连接池
+
+    :remark:
+        * 每个 Fdfs_client 只解析一次配置文件，并复用其 tracker 连接；
+          PooledFdfsClient 同时复用 storage 连接
+        * 最多 size 个客户端，取用时池空则等待，超过 timeout 秒抛出 StoragePoolTimeout
+        * 空闲超过 idle_check 秒的客户端在取用前做健康检查(查询tracker分组)，失败则重建
+        * 使用中出现连接错误的客户端直接丢弃，由下一次取用重建
+        * 通过 stats() 获取取用等待及调用耗时统计
+    """
+
+    def __init__(self, factory, size=gdata.FDFS_POOL_SIZE, timeout=gdata.FDFS_POOL_TIMEOUT,
+                 idle_check=gdata.FDFS_IDLE_CHECK_SECS):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.idle_check = idle_check
+        self._idle = collections.deque()  # (client, last_used)
+        self._created = 0
+        self._cond = threading.Condition()
+        self._counters = collections.Counter()
+        self._timers = collections.defaultdict(lambda: [0, 0.0, 0.0])  # name -> [count, total, max]
+
+    def _record(self, name, seconds):
+        with self._cond:
+            timer = self._timers[name]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def _incr(self, name):
+        with self._cond:
+            self._counters[name] += 1
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    client, last_used = self._idle.pop()
+                    break
+                if self._created < self.size:
+                    self._created += 1
+                    client, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    raise StoragePoolTimeout('no free FastDFS client in {}s'.format(self.timeout))
+                self._cond.wait(remaining)
+        self._record('wait', time.monotonic() - start)
+
+        if client is not None and time.monotonic() - last_used > self.idle_check and not self._healthy(client):
+            self._incr('reconnects')
+            client = None
+        if client is None:
+            try:
+                client = self.factory()
+            except Exception:
+                self._dispose()
+                raise
+            self._incr('created')
+        return client
+
+    def _healthy(self, client):
+        try:
+            client.list_all_groups()
+            return True
+        except CONNECTION_ERRORS as e:
+            _logger.warning('FastDFS client failed the health check: {}'.format(e))
+            self._incr('unhealthy')
+            return False
+
+    def release(self, client):
+        with self._cond:
+            self._idle.append((client, time.monotonic()))
+            self._cond.notify()
+
+    def _dispose(self):
+        with self._cond:
+            self._created -= 1
+            self._cond.notify()
+
+    def discard(self, client):
+        """丢弃出错的客户端，其连接随对象回收关闭
+        """
+        _ = client
+        self._incr('discarded')
+        self._dispose()
+
+    @contextlib.contextmanager
+    def connection(self):
+        client = self.acquire()
+        try:
+            yield client
+        except CONNECTION_ERRORS:
+            self.discard(client)
+            raise
+        except BaseException:
+            self.release(client)
+            raise
+        else:
+            self.release(client)
+
+    def call(self, method, *args, retries=gdata.FDFS_CALL_RETRIES, **kwargs):
+        """用池中客户端调用 Fdfs_client 的方法
+
+        出错的客户端均被丢弃，只有连接错误(RETRY_ERRORS)换一个新客户端重试
+        """
+        for attempt in range(retries + 1):
+            start = time.monotonic()
+            try:
+                with self.connection() as client:
+                    ret = getattr(client, method)(*args, **kwargs)
+            except CONNECTION_ERRORS as e:
+                self._incr('{}_errors'.format(method))
+                if attempt >= retries or not isinstance(e, RETRY_ERRORS):
+                    raise
+                _logger.warning('FastDFS {} failed, retry with a new client: {}'.format(method, e))
+            else:
+                self._record(method, time.monotonic() - start)
+                return ret
+
+    def stats(self):
+        with self._cond:
+            ret = {
+                'size': self.size,
+                'open': self._created,
+                'idle': len(self._idle),
+            }
+            ret.update(self._counters)
+            for name, (count, total, max_seconds) in self._timers.items():
+                ret[name] = {
+                    'count': count,
+                    'avg_ms': round(total / count * 1000, 3) if count else 0.0,
+                    'max_ms': round(max_seconds * 1000, 3),
+                }
+            return ret
+
 
 @deconstructible
 class FastDFSStorage(Storage):
-    def __init__(self, base_url=None, client_conf=None):
+    def __init__(self, base_url=None, client_conf=None, dedup=True):
         """
         初始化
         :param base_url: 用于构造图片完整路径使用，图片服务器的域名
         :param client_conf: FastDFS客户端配置文件的路径
+        :param dedup: 是否按内容去重(models.StoredFile)，关闭后不访问数据库
         """
         if base_url is None:
             base_url = settings.FDFS_URL
@@ -22,6 +263,23 @@ class FastDFSStorage(Storage):
         if client_conf is None:
             client_conf = settings.FDFS_CLIENT_CONF
         self.client_conf = client_conf
+        self.dedup = dedup
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    @property
+    def pool(self):
+        """客户端连接池，首次使用时创建；配置文件只解析一次，各客户端共用解析出的 tracker 配置
+        """
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    trackers = get_tracker_conf(self.client_conf)
+                    self._pool = FdfsClientPool(lambda: PooledFdfsClient(trackers))
+        return self._pool
+
+    def stats(self):
+        return self.pool.stats()
 
     def save(self, name, content, max_length=None):
         """
@@ -41,13 +299,99 @@ class FastDFSStorage(Storage):
         # }
 
         suffix = name.split('.')[-1]
-        client = Fdfs_client(self.client_conf)
-        ret = client.upload_by_buffer(content.read(), file_ext_name=suffix)
+        ext_name = suffix[:models.StoredFile._meta.get_field('ext_name').max_length]
+        # 大文件已由Django写入临时文件(settings.FILE_UPLOAD_MAX_MEMORY_SIZE)，分块读取后追加上传；
+        # 不使用 upload_by_filename，它会把临时文件名的 .upload.<ext> 当作扩展名
+        chunked = (content.size or 0) > gdata.FDFS_CHUNK_SIZE
+        data = None if chunked else content.read()
+        if self.dedup:
+            digest, size = self._digest(content) if chunked else (hashlib.sha256(data).hexdigest(), len(data))
+            file_name = self._reuse(digest, ext_name)
+            if file_name is not None:
+                _logger.info('reuse stored file `{}` for the same content'.format(file_name.decode()))
+                return file_name
+
+        if chunked:
+            ret = self._save_chunked(content, suffix)
+        else:
+            ret = self.pool.call('upload_by_buffer', data, file_ext_name=suffix)
         if "success" not in ret.get("Status"):
             raise Exception("upload file failed")
         file_name = ret.get("Remote file_id")
         _logger.info('upload file `{}` by fdfs_client, status:{}'.format(file_name.decode(), ret.get("Status")))
-        return file_name
+        if not self.dedup:
+            return file_name
+        return self._register(digest, ext_name, size, file_name)
+
+    @staticmethod
+    def _digest(content):
+        """分块计算内容的sha256，内存中最多只有一个块
+
+        :return: (digest, size)
+        """
+        sha, size = hashlib.sha256(), 0
+        for chunk in content.chunks(chunk_size=gdata.FDFS_CHUNK_SIZE):
+            sha.update(chunk)
+            size += len(chunk)
+        return sha.hexdigest(), size
+
+    @staticmethod
+    def _reuse(digest, ext_name):
+        """内容已保存过时引用计数加一
+
+        :return: 已有文件的 file id(bytes)，未保存过返回None
+        """
+        with transaction.atomic():
+            stored = models.StoredFile.objects.select_for_update().filter(
+                digest=digest, ext_name=ext_name).only('id', 'remote_file_id').first()
+            if stored is None:
+                return None
+            models.StoredFile.objects.filter(pk=stored.pk).update(ref_count=F('ref_count') + 1)
+        return stored.remote_file_id.encode()
+
+    def _register(self, digest, ext_name, size, file_name):
+        """登记新上传的文件；并发上传了相同内容时保留先登记的文件，删除本次上传的副本
+
+        先登记的文件可能在引用前被删除，此时重新登记，最多 gdata.FDFS_REGISTER_ATTEMPTS 次，
+        仍失败时删除本次上传的文件并抛出异常
+        """
+        for attempt in range(1, gdata.FDFS_REGISTER_ATTEMPTS + 1):
+            try:
+                with transaction.atomic():
+                    models.StoredFile.objects.create(
+                        digest=digest, ext_name=ext_name, remote_file_id=file_name.decode(), size=size)
+                return file_name
+            except IntegrityError as e:
+                existing = self._reuse(digest, ext_name)
+                if existing is not None:
+                    self._delete_remote(file_name)
+                    return existing
+                if attempt >= gdata.FDFS_REGISTER_ATTEMPTS:
+                    _logger.warning('failed to register the file `{}`: {}'.format(file_name.decode(), e))
+                    self._delete_remote(file_name)
+                    raise
+
+    def _delete_remote(self, file_name):
+        try:
+            self.pool.call('delete_file', file_name)
+        except (FDFSDataError,) + CONNECTION_ERRORS as e:
+            _logger.warning('failed to delete the file `{}`: {}'.format(file_name.decode(), e))
+
+    def _save_chunked(self, content, suffix):
+        """以追加上传的方式分块保存，内存中最多只有一个块(gdata.FDFS_CHUNK_SIZE)
+
+        追加失败时删除已上传的部分；追加不重试，避免重复写入同一块
+        """
+        chunks = content.chunks(chunk_size=gdata.FDFS_CHUNK_SIZE)
+        ret = self.pool.call('upload_appender_by_buffer', next(chunks), file_ext_name=suffix)
+        file_id = ret.get("Remote file_id")
+        try:
+            # 其余块在一次调用中经同一连接依次追加
+            self.pool.call('append_chunks_by_buffer', chunks, file_id, retries=0)
+        except Exception:
+            self._delete_remote(file_id)
+            raise
+        return ret
 
     def url(self, name):
         """
@@ -81,8 +425,21 @@ class FastDFSStorage(Storage):
     def delete(self, name):
         """
         Delete the specified file from the storage system.
+
+        引用计数减一，减到0(或文件不在索引中)时才删除远端文件
         """
-        pass
+        name = name.decode() if isinstance(name, bytes) else str(name)
+        if not self.dedup:
+            return self._delete_remote(name.encode())
+        with transaction.atomic():
+            stored = models.StoredFile.objects.select_for_update().filter(
+                remote_file_id=name).only('id', 'ref_count').first()
+            if stored is not None:
+                if stored.ref_count > 1:
+                    models.StoredFile.objects.filter(pk=stored.pk).update(ref_count=F('ref_count') - 1)
+                    return
+                stored.delete()
+        self._delete_remote(name.encode())
 
     def listdir(self, path):
         """
@@ -0,0 +1,210 @@
+"""
+shared outbound HTTP layer for third-party APIs (WeChat, ...)
+
+support:
+    * keep-alive connection pooling, one `requests.Session` per third-party
+    * per-call deadline, retries included
+    * bounded retries with jittered exponential backoff (idempotent methods only)
+    * circuit breaker
+    * latency and error counters
+    * query strings (credentials) are never written to logs or error messages
+"""
+import random
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from teaching_helper import gdata
+from teaching_helper import glog
+from teaching_helper.exception import HTTPAccessError, CircuitOpenError
+
+_logger = glog.get_logger(__name__)
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_QUERY_PATTERN = re.compile(r'\?[^\s\'"]+')
+
+
+def redact(text):
+    """去掉文本中URL的查询字符串，appid/secret/js_code 等凭证不得出现在日志中
+
+    requests 的异常信息会包含完整的请求路径，也需要经过此函数
+    """
+    return _QUERY_PATTERN.sub('?<redacted>', str(text))
+
+
+class CircuitBreaker(object):
+    """熔断器
+
+    :remark:
+        * closed: 正常放行，连续失败 failure_threshold 次后打开
+        * open: 直接拒绝请求，recovery_timeout 秒后进入 half-open
+        * half-open: 仅放行一个探测请求，成功则关闭，失败则重新打开
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=gdata.HTTP_BREAKER_FAILURES, recovery_timeout=gdata.HTTP_BREAKER_RECOVERY):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+class HTTPAccess(object):
+    """pooled, deadline-bounded, retrying HTTP client of one third-party
+
+    example:
+        ```
+        >>> wx_http = HTTPAccess('wechat')
+        >>> res = wx_http.get(url, params={'js_code': code})
+        ```
+
+        credentials should be passed by `params`, `url` must not contain them
+    """
+
+    def __init__(self, name,
+                 pool_size=gdata.HTTP_POOL_SIZE,
+                 connect_timeout=gdata.HTTP_CONNECT_TIMEOUT,
+                 read_timeout=gdata.HTTP_READ_TIMEOUT,
+                 deadline=gdata.HTTP_DEADLINE,
+                 max_retries=gdata.HTTP_MAX_RETRIES,
+                 retry_backoff=gdata.HTTP_RETRY_BACKOFF,
+                 breaker=None):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0, pool_block=False)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self._counters = {
+            'requests': 0,
+            'errors': 0,
+            'retries': 0,
+            'rejected': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+        }
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, deadline=None, retry=None, **kwargs):
+        """send a request under the deadline
+
+        :param deadline: total seconds of this call, retries included, default -> self.deadline
+        :param retry: whether to retry, default -> only idempotent methods are retried
+        :raise CircuitOpenError: the circuit is open
+        :raise HTTPAccessError: timeout, connection error, retries exhausted or bad status
+        """
+        method = method.upper()
+        if retry is None:
+            retry = method in IDEMPOTENT_METHODS
+        max_attempts = self.max_retries + 1 if retry else 1
+        expire_at = time.monotonic() + (deadline or self.deadline)
+
+        if not self.breaker.allow():
+            self._incr('rejected')
+            raise CircuitOpenError(self.name, 'circuit is open, request to {} rejected'.format(redact(url)))
+
+        last_error = None
+        for attempt in range(max_attempts):
+            remaining = expire_at - time.monotonic()
+            if remaining <= 0:
+                break
+            if attempt:
+                self._incr('retries')
+
+            start = time.monotonic()
+            try:
+                res = self.session.request(method, url,
+                                           timeout=(min(self.connect_timeout, remaining),
+                                                    min(self.read_timeout, remaining)),
+                                           **kwargs)
+                if res.status_code in RETRY_STATUS_CODES:
+                    raise HTTPAccessError(self.name, 'bad status {} from {}'.format(res.status_code, redact(url)))
+                self._record(time.monotonic() - start, error=False)
+                self.breaker.record_success()
+                return res
+            except (requests.RequestException, HTTPAccessError) as e:
+                self._record(time.monotonic() - start, error=True)
+                last_error = e
+                _logger.warning('[{}] {} {} failed, attempt {}/{}, error: {}'.format(
+                    self.name, method, redact(url), attempt + 1, max_attempts, redact(e)))
+
+            # full jitter backoff, never sleep past the deadline
+            backoff = random.uniform(0, self.retry_backoff * (2 ** attempt))
+            if attempt + 1 < max_attempts:
+                time.sleep(max(0, min(backoff, expire_at - time.monotonic())))
+
+        self.breaker.record_failure()
+        raise HTTPAccessError(self.name, '{} {} failed: {}'.format(
+            method, redact(url), redact(last_error or 'deadline exceeded')))
+
+    def _incr(self, key):
+        with self._lock:
+            self._counters[key] += 1
+
+    def _record(self, latency, error):
+        with self._lock:
+            self._counters['requests'] += 1
+            self._counters['latency_total'] += latency
+            self._counters['latency_max'] = max(self._counters['latency_max'], latency)
+            if error:
+                self._counters['errors'] += 1
+
+    def stats(self):
+        with self._lock:
+            ret = dict(self._counters)
+        ret['latency_avg'] = ret['latency_total'] / ret['requests'] if ret['requests'] else 0.0
+        ret['breaker'] = self.breaker.state
+        return ret
+
+
+wx_http = HTTPAccess('wechat')
@@ -0,0 +1,99 @@
+"""
+班课考勤导出
+
+每名学生一行，每次签到一列。学生按id分批(键集分页)读取，每批只查询该批学生的签到记录，
+导出过程中内存占用与班课学生数、签到次数无关(MySQL驱动不支持服务端游标，不依赖 .iterator() 流式读取)
+"""
+import csv
+import tempfile
+
+from django.utils import timezone
+import xlsxwriter
+
+from teaching_helper import gdata
+from wx_client import models
+
+SIGNED_MARK = '√'
+
+
+def sign_in_events(lesson_id):
+    """班课的全部签到事件，按开始时间排序
+
+    :return: [(event_id, start_time), ...]
+    """
+    return list(models.TeachingEventTracker.objects.filter(
+        lesson_id=lesson_id, event_type=gdata.EVENT_SIGN).order_by('start_time', 'id').values_list('id', 'start_time'))
+
+
+def _students(lesson_id, batch_size):
+    """按学生id分批读取班课学生
+
+    :return: 生成器，每次产出 [(user_id, nickName), ...]
+    """
+    last_id = 0
+    while True:
+        batch = list(models.Lesson.student.through.objects.filter(
+            lesson_id=lesson_id, userprofile_id__gt=last_id).order_by('userprofile_id').values_list(
+            'userprofile_id', 'userprofile__nickName')[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1][0]
+
+
+def attendance_rows(lesson_id, batch_size=gdata.ATTENDANCE_EXPORT_BATCH_SIZE):
+    """考勤表的行，第一行为表头
+
+    :return: 生成器，每次产出一行(list)
+    """
+    events = sign_in_events(lesson_id)
+    columns = {_id: _idx for _idx, (_id, _) in enumerate(events)}
+    yield ['学生编号', '昵称'] + [timezone.localtime(_t).strftime('%Y-%m-%d %H:%M') for _, _t in events] + \
+          ['出勤次数', '出勤率']
+
+    for students in _students(lesson_id, batch_size):
+        signed = {}
+        sign_ins = models.SignInTable.objects.filter(
+            lesson_id=lesson_id, event_id__in=list(columns),
+            user_id__in=[_id for _id, _ in students]).values_list('user_id', 'event_id')
+        for user_id, event_id in sign_ins.iterator():
+            signed.setdefault(user_id, set()).add(columns[event_id])
+
+        for user_id, nick_name in students:
+            marks = signed.get(user_id, ())
+            row = [SIGNED_MARK if _idx in marks else '' for _idx in range(len(events))]
+            rate = '{:.0%}'.format(len(marks) / len(events)) if events else ''
+            yield [user_id, nick_name] + row + [len(marks), rate]
+
+
+class Echo(object):
+    """只转发写入内容的伪文件对象，供 csv.writer 逐行生成CSV文本
+    """
+
+    @staticmethod
+    def write(value):
+        return value
+
+
+def iter_csv(lesson_id):
+    """逐行生成CSV文本(带BOM，Excel可直接打开)
+    """
+    writer = csv.writer(Echo())
+    yield '\ufeff'
+    for row in attendance_rows(lesson_id):
+        yield writer.writerow(row)
+
+
+def write_xlsx(lesson_id):
+    """写入临时xlsx文件(constant_memory模式，按行写出，不保留整张表)
+
+    :return: 已定位到开头的临时文件对象，关闭后自动删除
+    """
+    f = tempfile.TemporaryFile()
+    workbook = xlsxwriter.Workbook(f, {'constant_memory': True, 'in_memory': False})
+    sheet = workbook.add_worksheet('考勤')
+    for row_idx, row in enumerate(attendance_rows(lesson_id)):
+        sheet.write_row(row_idx, 0, row)
+    workbook.close()
+    f.seek(0)
+    return f
@@ -0,0 +1,82 @@
+"""
+定位签到的地理围栏
+
+* 每个签到事件的围栏(中心、半径及外接经纬度矩形)预先计算并缓存
+* 一批签到位置一次性校验：先用外接矩形剔除明显超出范围的点，再对剩余的点做向量化的haversine计算
+"""
+import math
+
+import numpy as np
+
+import utils
+from teaching_helper import gdata
+
+EARTH_RADIUS = 6371008.8  # 地球平均半径(米)
+
+
+class GeoFence(object):
+    """圆形地理围栏
+    """
+
+    __slots__ = ('latitude', 'longitude', 'radius', 'lat_min', 'lat_max', 'lng_min', 'lng_max')
+
+    def __init__(self, latitude, longitude, radius):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.radius = radius
+
+        d_lat = math.degrees(radius / EARTH_RADIUS)
+        cos_lat = math.cos(math.radians(latitude))
+        # 靠近两极时经度方向不做限制
+        d_lng = math.degrees(radius / (EARTH_RADIUS * cos_lat)) if cos_lat > 1e-6 else 180.0
+        self.lat_min, self.lat_max = latitude - d_lat, latitude + d_lat
+        self.lng_min, self.lng_max = longitude - d_lng, longitude + d_lng
+
+    def check(self, latitudes, longitudes):
+        """批量校验
+
+        :param latitudes: 纬度序列
+        :param longitudes: 经度序列
+        :return: (distances, inside)
+            distances: 距离(米)，被外接矩形剔除的点为 nan
+            inside: 是否在围栏内
+        """
+        lats = np.asarray(latitudes, dtype=np.float64)
+        lngs = np.asarray(longitudes, dtype=np.float64)
+        distances = np.full(lats.shape, np.nan)
+
+        # longitude wrap-around near ±180° is not handled, campuses are far away from it
+        in_box = (lats >= self.lat_min) & (lats <= self.lat_max) & (lngs >= self.lng_min) & (lngs <= self.lng_max)
+        if in_box.any():
+            distances[in_box] = haversine(self.latitude, self.longitude, lats[in_box], lngs[in_box])
+
+        inside = in_box & (np.nan_to_num(distances, nan=np.inf) <= self.radius)
+        return distances, inside
+
+
+def haversine(lat, lng, lats, lngs):
+    """点(lat, lng)到一组点的球面距离(米)
+    """
+    lat1, lng1 = math.radians(lat), math.radians(lng)
+    lat2, lng2 = np.radians(lats), np.radians(lngs)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+_fence_cache = utils.LRUCache(max_size=gdata.SIGN_IN_FENCE_CACHE_SIZE)
+
+
+def get_fence(event):
+    """签到事件的地理围栏，事件未设置围栏时返回None
+
+    :param event: TeachingEventTracker
+    """
+    if event.latitude is None or event.longitude is None or not event.radius:
+        return None
+
+    key = (event.id, event.latitude, event.longitude, event.radius)
+    fence = _fence_cache.get(key)
+    if fence is None:
+        fence = GeoFence(event.latitude, event.longitude, event.radius)
+        _fence_cache.set(key, fence)
+    return fence
@@ -0,0 +1,270 @@
+"""
+班课码生成
+"""
+import collections
+import functools
+import hashlib
+import hmac
+import random
+import string
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+
+import schedulers
+from teaching_helper import gdata
+from teaching_helper import glog
+from wx_client import models
+
+_logger = glog.get_logger(__name__)
+
+LESSON_CODE_ALPHABET = string.ascii_uppercase + string.digits
+
+
+class LessonCodeGenerator(object):
+    """批量生成班课码
+
+    :remark:
+        * 每批候选码在内存中生成并去重
+        * 每批仅用一次 `code IN (...)` 查询排除已存在的码，再 bulk_create 写入
+        * LessonCode.code 的唯一约束兜底并发写入
+    """
+
+    def __init__(self, batch_size=gdata.LESSON_CODE_BATCH_SIZE, code_len=gdata.LESSON_CODE_LEN):
+        self.batch_size = batch_size
+        self.code_len = code_len
+        self._random = random.Random()
+
+    def _candidates(self, num):
+        candidates = set()
+        while len(candidates) < num:
+            candidates.add(''.join(self._random.choices(LESSON_CODE_ALPHABET, k=self.code_len)))
+        return candidates
+
+    def generate(self, total, progress=None):
+        """生成 total 个新班课码
+
+        :param total: 数量
+        :param progress: 回调 progress(created, total)，每批写入后调用
+        :return: 实际生成数量
+        """
+        created = 0
+        while created < total:
+            candidates = self._candidates(min(self.batch_size, total - created))
+            existing = set(models.LessonCode.objects.filter(code__in=candidates).values_list('code', flat=True))
+            fresh = candidates - existing
+            models.LessonCode.objects.bulk_create([models.LessonCode(code=_c) for _c in fresh],
+                                                  batch_size=2000,
+                                                  ignore_conflicts=True)
+            created += len(fresh)
+            if progress:
+                progress(created, total)
+        return created
+
+
+class LessonCodeJob(object):
+    """后台班课码生成任务，进度保存在共享缓存中
+    """
+
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+
+    @staticmethod
+    def progress():
+        return cache.get(gdata.LESSON_CODE_JOB_KEY, None)
+
+    @staticmethod
+    def _save(status, created, total, started_at):
+        cache.set(gdata.LESSON_CODE_JOB_KEY, {
+            'status': status,
+            'created': created,
+            'total': total,
+            'started_at': started_at,
+            'cost': round(time.time() - started_at, 3),
+        }, None)
+
+    @staticmethod
+    def start(total):
+        """启动后台任务
+
+        :return: 是否启动成功，已有任务在运行时返回False
+        """
+        started_at = time.time()
+        # cache.add 原子占位，并发的请求只有一个能启动任务
+        if not cache.add(gdata.LESSON_CODE_JOB_LOCK_KEY, started_at, gdata.LESSON_CODE_JOB_LOCK_TIMEOUT):
+            return False
+
+        try:
+            LessonCodeJob._save(LessonCodeJob.STATUS_RUNNING, 0, total, started_at)
+            schedulers.submit(LessonCodeJob._run, total, started_at)
+        except Exception:
+            cache.delete(gdata.LESSON_CODE_JOB_LOCK_KEY)
+            raise
+        return True
+
+    @staticmethod
+    def _run(total, started_at):
+        created = 0
+
+        def _progress(_created, _total):
+            nonlocal created
+            created = _created
+            LessonCodeJob._save(LessonCodeJob.STATUS_RUNNING, _created, _total, started_at)
+
+        try:
+            LessonCodeGenerator().generate(total, progress=_progress)
+        except Exception:
+            LessonCodeJob._save(LessonCodeJob.STATUS_FAILED, created, total, started_at)
+            raise
+        else:
+            LessonCodeJob._save(LessonCodeJob.STATUS_DONE, created, total, started_at)
+        finally:
+            cache.delete(gdata.LESSON_CODE_JOB_LOCK_KEY)
+        _logger.info('generate {} lesson codes, cost {:.3f}s'.format(created, time.time() - started_at))
+
+
+class LessonCodeAllocator(object):
+    """班课码分配器
+
+    :remark:
+        * 每个进程预先原子地占用一小块(block_size)班课码，创建班课时直接从本地块中取码，无需访问数据库
+        * 占用通过 `SELECT ... FOR UPDATE SKIP LOCKED` 实现，数据库不支持时退化为逐行的条件UPDATE
+        * 进程退出时本地块中未使用的码不会归还(最多 block_size 个)
+    """
+
+    def __init__(self, block_size=gdata.LESSON_CODE_BLOCK_SIZE):
+        self.block_size = block_size
+        self._block = collections.deque()
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        """分配一个班课码
+
+        :return: 班课码，已用尽时返回None
+        """
+        with self._lock:
+            if not self._block:
+                self._block.extend(self._reserve_block())
+            return self._block.popleft() if self._block else None
+
+    def release(self, code):
+        """归还未使用的班课码至本地块，供下次分配
+        """
+        with self._lock:
+            self._block.appendleft(code)
+
+    def _reserve_block(self):
+        if connection.features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                rows = list(models.LessonCode.objects.select_for_update(skip_locked=True)
+                            .filter(is_occupied=False)
+                            .values_list('id', 'code')[:self.block_size])
+                models.LessonCode.objects.filter(id__in=[_id for _id, _ in rows]).update(is_occupied=True)
+            codes = [_code for _, _code in rows]
+        else:
+            codes = []
+            candidates = models.LessonCode.objects.filter(is_occupied=False).values_list('id', 'code')
+            for _id, _code in candidates[:self.block_size * 2]:
+                if len(codes) >= self.block_size:
+                    break
+                # conditional UPDATE, only one worker can claim the row
+                if models.LessonCode.objects.filter(id=_id, is_occupied=False).update(is_occupied=True):
+                    codes.append(_code)
+
+        if not codes:
+            _logger.error('no lesson code left, generate more by LessonCodeAPIView')
+        _logger.debug('reserve lesson code block: {}'.format(codes))
+        return codes
+
+
+allocator = LessonCodeAllocator()
+
+
+class LessonCodeCipher(object):
+    """班课序号 <-> 班课码 的带密钥双射(格式保持加密)
+
+    :remark:
+        * 定义域为 [0, 36 ** code_len)，值域为 code_len 位的 `ascii_uppercase + digits` 字符串
+        * 平衡Feistel网络 + cycle-walking，轮函数为 HMAC-SHA256
+        * 以班课id为序号，无需班课码表、无需扫描且不会冲突，班课码可直接解码回班课id
+    """
+
+    ROUNDS = 8
+
+    def __init__(self, key, code_len=gdata.LESSON_CODE_LEN):
+        self.code_len = code_len
+        self.domain = len(LESSON_CODE_ALPHABET) ** code_len
+        self.half_bits = (self.domain - 1).bit_length() // 2 + 1
+        self.half_mask = (1 << self.half_bits) - 1
+        self._key = bytes(key, encoding='utf-8') if isinstance(key, str) else key
+        self._index = {_c: _i for _i, _c in enumerate(LESSON_CODE_ALPHABET)}
+
+    def _round(self, idx, value):
+        msg = bytes([idx]) + value.to_bytes(8, 'big')
+        digest = hmac.new(self._key, msg, hashlib.sha256).digest()
+        return int.from_bytes(digest[:8], 'big') & self.half_mask
+
+    def _permute(self, value):
+        left, right = value >> self.half_bits, value & self.half_mask
+        for idx in range(self.ROUNDS):
+            left, right = right, left ^ self._round(idx, right)
+        return (left << self.half_bits) | right
+
+    def _unpermute(self, value):
+        left, right = value >> self.half_bits, value & self.half_mask
+        for idx in reversed(range(self.ROUNDS)):
+            left, right = right ^ self._round(idx, left), left
+        return (left << self.half_bits) | right
+
+    def encode(self, seq):
+        """序号 -> 班课码
+        """
+        assert 0 <= seq < self.domain, '班课序号超出范围: {}'.format(seq)
+        value = self._permute(seq)
+        while value >= self.domain:  # cycle-walking
+            value = self._permute(value)
+
+        chars = []
+        for _ in range(self.code_len):
+            value, rem = divmod(value, len(LESSON_CODE_ALPHABET))
+            chars.append(LESSON_CODE_ALPHABET[rem])
+        return ''.join(reversed(chars))
+
+    def decode(self, code):
+        """班课码 -> 序号，无效的班课码返回None
+        """
+        if not isinstance(code, str) or len(code) != self.code_len:
+            return None
+
+        value = 0
+        for _c in code:
+            if _c not in self._index:
+                return None
+            value = value * len(LESSON_CODE_ALPHABET) + self._index[_c]
+
+        value = self._unpermute(value)
+        while value >= self.domain:  # cycle-walking
+            value = self._unpermute(value)
+        return value
+
+
+def cipher_enabled():
+    """是否使用 LessonCodeCipher 生成班课码(settings.LESSON_CODE_ENGINE)
+    """
+    return settings.LESSON_CODE_ENGINE == gdata.LESSON_CODE_ENGINE_CIPHER
+
+
+@functools.lru_cache(maxsize=None)
+def get_cipher():
+    return LessonCodeCipher(settings.LESSON_CODE_KEY)
+
+
+def placeholder_code():
+    """班课入库前使用的临时班课码，以'~'开头，不会与正式班课码冲突
+    """
+    return '~' + uuid.uuid4().hex[:gdata.LESSON_CODE_LEN - 1]
@@ -0,0 +1,96 @@
+"""
+班课计数(wx_client.models.LessonCounter)维护
+
+* incr: 随业务写入增量更新，由 wx_client.signals 调用
+* reconcile: 按实际数据重新统计，用于定期校准
+"""
+from django.db.models import Count, F
+from django.utils import timezone
+
+from teaching_helper import gdata
+from teaching_helper import glog
+from wx_client import models
+
+_logger = glog.get_logger(__name__)
+
+COUNTER_FIELDS = (
+    'student_num',
+    'resource_num',
+    'question_num',
+    'solved_question_num',
+    'notice_num',
+    'event_num',
+)
+
+
+def incr(lesson_ids, **deltas):
+    """原子地增减计数
+
+    :param lesson_ids: 班课id集合
+    :param deltas: 计数字段 -> 增量，如 incr([1], student_num=2)
+    """
+    lesson_ids = list(lesson_ids)
+    deltas = {_f: _d for _f, _d in deltas.items() if _d}
+    if not lesson_ids or not deltas:
+        return
+
+    updated = models.LessonCounter.objects.filter(lesson_id__in=lesson_ids).update(
+        **{_f: F(_f) + _d for _f, _d in deltas.items()})
+    if updated < len(lesson_ids):
+        # 计数记录缺失(历史班课)，直接按实际数据统计
+        existing = set(models.LessonCounter.objects.filter(lesson_id__in=lesson_ids).values_list('lesson_id',
+                                                                                                  flat=True))
+        reconcile([_id for _id in lesson_ids if _id not in existing])
+
+
+def refresh_solved(lesson_id):
+    """重新统计单个班课的已解决问题数
+    """
+    solved = models.LessonQuestion.objects.filter(lesson_id=lesson_id,
+                                                  lesson_answers__is_correct=True).distinct().count()
+    models.LessonCounter.objects.filter(lesson_id=lesson_id).update(solved_question_num=solved)
+
+
+def _count_by_lesson(queryset, lesson_ids, field='lesson_id', distinct_on=None):
+    queryset = queryset.filter(**{'{}__in'.format(field): lesson_ids})
+    count = Count(distinct_on, distinct=True) if distinct_on else Count('*')
+    return dict(queryset.order_by().values_list(field).annotate(n=count).values_list(field, 'n'))
+
+
+def reconcile(lesson_ids=None, batch_size=500):
+    """按实际数据重新统计计数，lesson_ids为None时校准全部班课
+
+    :return: 校准的班课数
+    """
+    if lesson_ids is None:
+        lesson_ids = models.Lesson.objects.order_by('id').values_list('id', flat=True)
+    lesson_ids = list(lesson_ids)
+
+    done = 0
+    for start in range(0, len(lesson_ids), batch_size):
+        batch = lesson_ids[start:start + batch_size]
+        counts = {
+            'student_num': _count_by_lesson(models.Lesson.student.through.objects, batch),
+            'resource_num': _count_by_lesson(models.LessonResource.objects.filter(is_delete=False), batch),
+            'question_num': _count_by_lesson(models.LessonQuestion.objects, batch),
+            'solved_question_num': _count_by_lesson(
+                models.LessonQuestion.objects.filter(lesson_answers__is_correct=True), batch, distinct_on='id'),
+            'notice_num': _count_by_lesson(
+                models.TeachingEventTracker.objects.filter(event_type=gdata.EVENT_NOTICE), batch),
+            'event_num': _count_by_lesson(models.TeachingEventTracker.objects, batch),
+        }
+
+        now = timezone.now()
+        counters = [models.LessonCounter(lesson_id=_id,
+                                         reconcile_time=now,
+                                         **{_f: counts[_f].get(_id, 0) for _f in COUNTER_FIELDS})
+                    for _id in batch]
+        existing = set(models.LessonCounter.objects.filter(lesson_id__in=batch).values_list('lesson_id', flat=True))
+        models.LessonCounter.objects.bulk_update([_c for _c in counters if _c.lesson_id in existing],
+                                                 fields=COUNTER_FIELDS + ('reconcile_time',))
+        models.LessonCounter.objects.bulk_create([_c for _c in counters if _c.lesson_id not in existing],
+                                                 ignore_conflicts=True)
+        done += len(batch)
+
+    _logger.info('reconcile counters of {} lessons'.format(done))
+    return done
@@ -0,0 +1,200 @@
+"""
+Web 扫码登录会话存储
+
+支持多个uwsgi进程共享会话，会话在 gdata.LOGIN_QR_EXPIRED_SECS 后自动过期。
+存储后端可通过 settings.LOGIN_QR_STORE 替换。
+"""
+import asyncio
+import functools
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from django_redis import get_redis_connection
+import redis
+import redis.asyncio
+
+import utils
+from teaching_helper import gdata
+from teaching_helper import glog
+
+_logger = glog.get_logger(__name__)
+
+
+class BaseQRLoginStore(object):
+    """扫码登录会话存储接口
+    """
+
+    def create(self, qr_uid, qr_path):
+        """新建会话
+
+        :return: utils.LoginQRItem
+        """
+        raise NotImplementedError('create must be implemented by subclass')
+
+    def fetch(self, qr_uid):
+        """查询会话，会话不存在或已过期时返回None
+
+        :return: utils.LoginQRItem or None
+        """
+        raise NotImplementedError('fetch must be implemented by subclass')
+
+    def scan(self, qr_uid, user_id):
+        """标记会话已被`user_id`扫码(compare-and-set)，仅首个扫码的用户生效
+
+        :return: 是否扫码成功
+        """
+        raise NotImplementedError('scan must be implemented by subclass')
+
+    def consume(self, qr_uid):
+        """删除会话，会话用于登录后调用
+        """
+        raise NotImplementedError('consume must be implemented by subclass')
+
+    def watch(self, qr_uid):
+        """订阅会话的扫码通知，只能在ASGI事件循环中调用
+
+        :return: asyncio.Event，扫码后被置位；不支持推送时返回None，由事件流退避轮询
+        """
+        _ = qr_uid
+        return None
+
+    def unwatch(self, qr_uid, event):
+        """取消 watch 的订阅
+        """
+        pass
+
+
+class CacheQRLoginStore(BaseQRLoginStore):
+    """基于Django缓存框架的会话存储
+
+    :remark:
+        * 会话本体与扫码结果分两个键存储，扫码结果通过 `cache.add` 原子写入
+        * 两个键都设置了过期时间，无需清理
+    """
+
+    def __init__(self, alias=None, ttl=gdata.LOGIN_QR_EXPIRED_SECS):
+        self.cache = caches[alias or settings.LOGIN_QR_CACHE_ALIAS]
+        self.ttl = ttl
+
+    @staticmethod
+    def _item_key(qr_uid):
+        return '{}:{}'.format(gdata.LOGIN_QR_CACHE_PREFIX, qr_uid)
+
+    @staticmethod
+    def _scan_key(qr_uid):
+        return '{}:{}:scan'.format(gdata.LOGIN_QR_CACHE_PREFIX, qr_uid)
+
+    def create(self, qr_uid, qr_path):
+        effective_time = time.time()
+        self.cache.set(self._item_key(qr_uid), (effective_time, qr_path), self.ttl)
+        return utils.LoginQRItem(effective_time, False, None, qr_path)
+
+    def fetch(self, qr_uid):
+        item_key, scan_key = self._item_key(qr_uid), self._scan_key(qr_uid)
+        values = self.cache.get_many([item_key, scan_key])
+        if item_key not in values:
+            return None
+
+        effective_time, qr_path = values[item_key]
+        user_id = values.get(scan_key, None)
+        return utils.LoginQRItem(effective_time, user_id is not None, user_id, qr_path)
+
+    def scan(self, qr_uid, user_id):
+        item = self.cache.get(self._item_key(qr_uid))
+        if item is None:
+            return False
+
+        remaining = int(item[0] + self.ttl - time.time())
+        if remaining <= 0:
+            return False
+
+        if self.cache.add(self._scan_key(qr_uid), user_id, remaining):
+            return True
+
+        # re-scan by the same user is idempotent
+        return self.cache.get(self._scan_key(qr_uid)) == user_id
+
+    def consume(self, qr_uid):
+        self.cache.delete_many([self._item_key(qr_uid), self._scan_key(qr_uid)])
+
+
+class RedisQRLoginStore(CacheQRLoginStore):
+    """扫码成功后通过Redis发布通知的会话存储，缓存别名须使用 django-redis
+
+    :remark:
+        * 扫码由uwsgi进程处理，事件流运行在ASGI进程，两者通过Redis pub/sub通信
+        * 每个ASGI进程只建立一个模式订阅连接，收到通知后按 qr_uid 唤醒等待中的事件流
+        * 通知只是唤醒信号，状态仍以缓存中的会话为准；订阅断开时唤醒全部事件流重新检查
+    """
+
+    CHANNEL_SUFFIX = ':scanned'
+
+    def __init__(self, alias=None, ttl=gdata.LOGIN_QR_EXPIRED_SECS):
+        super(RedisQRLoginStore, self).__init__(alias, ttl)
+        self.alias = alias or settings.LOGIN_QR_CACHE_ALIAS
+        self._waiters = {}  # qr_uid -> {asyncio.Event, ...}
+        self._listener = None
+
+    @classmethod
+    def _channel(cls, qr_uid):
+        return '{}:{}{}'.format(gdata.LOGIN_QR_CACHE_PREFIX, qr_uid, cls.CHANNEL_SUFFIX)
+
+    def scan(self, qr_uid, user_id):
+        scanned = super(RedisQRLoginStore, self).scan(qr_uid, user_id)
+        if scanned:
+            try:
+                get_redis_connection(self.alias).publish(self._channel(qr_uid), user_id)
+            except redis.RedisError as e:
+                # 事件流会在下一次定期检查时发现扫码结果
+                _logger.warning('failed to publish the scan of qr login `{}`: {}'.format(qr_uid, e))
+        return scanned
+
+    def watch(self, qr_uid):
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.ensure_future(self._listen())
+        event = asyncio.Event()
+        self._waiters.setdefault(qr_uid, set()).add(event)
+        return event
+
+    def unwatch(self, qr_uid, event):
+        waiters = self._waiters.get(qr_uid)
+        if waiters is not None:
+            waiters.discard(event)
+            if not waiters:
+                del self._waiters[qr_uid]
+
+    def _wake(self, qr_uid=None):
+        waiters = self._waiters.values() if qr_uid is None else [self._waiters.get(qr_uid, ())]
+        for events in waiters:
+            for event in events:
+                event.set()
+
+    async def _listen(self):
+        prefix_len = len(gdata.LOGIN_QR_CACHE_PREFIX) + 1
+        while self._waiters:
+            client = redis.asyncio.from_url(settings.CACHES[self.alias]['LOCATION'])
+            pubsub = client.pubsub()
+            try:
+                await pubsub.psubscribe(self._channel('*'))
+                async for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        channel = message['channel']
+                        channel = channel.decode('utf-8') if isinstance(channel, bytes) else channel
+                        self._wake(channel[prefix_len:-len(self.CHANNEL_SUFFIX)])
+            except (redis.RedisError, OSError) as e:
+                _logger.warning('qr login subscription lost, retry in {}s: {}'.format(
+                    gdata.LOGIN_QR_EVENTS_CHECK_SECS, e))
+                self._wake()
+                await asyncio.sleep(gdata.LOGIN_QR_EVENTS_CHECK_SECS)
+            finally:
+                await pubsub.close()
+                await client.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_qr_login_store():
+    """获取settings.LOGIN_QR_STORE指定的会话存储(单例)
+    """
+    return import_string(settings.LOGIN_QR_STORE)()
@@ -0,0 +1,181 @@
+"""
+随机点名(gdata.EVENT_CALL)
+
+* Roster: 班课学生名单，学生id以 array('I') 紧凑存放，按班课缓存在进程内；
+  学生加入班课时由 wx_client.signals 增量追加，退出班课时整体失效后按需重新加载
+* RollCallSession: 一次点名(一个点名事件)，部分 Fisher–Yates 抽样，不放回，每次抽取 O(1)；
+  已点到的学生通过共享缓存 `cache.add` 原子登记，多个 uwsgi 进程各自持有会话时也不会重复点到同一学生
+"""
+from array import array
+import random
+import threading
+
+from django.core.cache import cache
+
+import utils
+from teaching_helper import gdata
+from teaching_helper import glog
+from wx_client import models
+
+_logger = glog.get_logger(__name__)
+
+
+class Roster(object):
+    """班课学生名单
+    """
+
+    __slots__ = ('lesson_id', 'student_ids', 'lock')
+
+    def __init__(self, lesson_id, student_ids):
+        self.lesson_id = lesson_id
+        self.student_ids = array('I', student_ids)
+        self.lock = threading.Lock()
+
+    def extend(self, student_ids):
+        with self.lock:
+            existing = set(self.student_ids)
+            self.student_ids.extend(_id for _id in student_ids if _id not in existing)
+
+    def __len__(self):
+        return len(self.student_ids)
+
+
+class RosterCache(object):
+    """按班课缓存学生名单
+    """
+
+    def __init__(self, max_size=gdata.ROLL_CALL_ROSTER_CACHE_SIZE):
+        self._cache = utils.LRUCache(max_size=max_size)
+        self._lock = threading.Lock()
+
+    def get(self, lesson_id):
+        roster = self._cache.get(lesson_id)
+        if roster is not None:
+            return roster
+
+        with self._lock:
+            roster = self._cache.get(lesson_id)
+            if roster is None:
+                student_ids = models.Lesson.student.through.objects.filter(
+                    lesson_id=lesson_id).order_by('id').values_list('userprofile_id', flat=True)
+                roster = Roster(lesson_id, student_ids)
+                self._cache.set(lesson_id, roster)
+        return roster
+
+    def add_students(self, lesson_id, student_ids):
+        """学生加入班课，名单未缓存时不加载
+        """
+        roster = self._cache.get(lesson_id)
+        if roster is not None:
+            roster.extend(student_ids)
+
+    def invalidate(self, lesson_id):
+        self._cache.pop(lesson_id)
+
+
+rosters = RosterCache()
+
+
+class RollCallSession(object):
+    """一次点名
+
+    pool[:unchecked] 为本进程尚未抽取过的学生，每次在其中随机取一个并交换到末尾，
+    再以 `cache.add` 在共享缓存中登记，登记失败说明已被其他进程点到，继续抽取；
+    点名期间新加入班课的学生追加到未抽取区间
+    """
+
+    def __init__(self, event_id, lesson_id, teacher_id):
+        self.event_id = event_id
+        self.lesson_id = lesson_id
+        self.teacher_id = teacher_id
+        self.lock = threading.Lock()
+        self._roster = rosters.get(lesson_id)
+        self._seen = len(self._roster)
+        self.pool = array('I', self._roster.student_ids[:self._seen])
+        self.unchecked = len(self.pool)
+        self._called_num_key = gdata.ROLL_CALL_CALLED_NUM_KEY.format(event_id)
+        cache.add(self._called_num_key, 0, gdata.ROLL_CALL_SESSION_TTL)
+
+    def _called_key(self, student_id):
+        return gdata.ROLL_CALL_CALLED_KEY.format(self.event_id, student_id)
+
+    def _sync(self):
+        roster = rosters.get(self.lesson_id)
+        if roster is not self._roster:
+            # 名单重新加载过(有学生退出)，按新名单重建未抽取区间
+            checked = set(self.pool[self.unchecked:])
+            self.pool = array('I', [_id for _id in roster.student_ids if _id not in checked])
+            self.unchecked = len(self.pool)
+            self.pool.extend(checked)
+            self._roster, self._seen = roster, len(roster)
+            return
+
+        if len(roster) > self._seen:
+            for _id in roster.student_ids[self._seen:]:
+                self.pool.append(_id)
+                self.pool[self.unchecked], self.pool[-1] = self.pool[-1], self.pool[self.unchecked]
+                self.unchecked += 1
+            self._seen = len(roster)
+
+    def _claim(self, student_id):
+        """在共享缓存中登记点到的学生
+
+        :return: 是否登记成功，False 表示已被其他进程点到
+        """
+        if not cache.add(self._called_key(student_id), 1, gdata.ROLL_CALL_SESSION_TTL):
+            return False
+        try:
+            cache.incr(self._called_num_key)
+        except ValueError:
+            # 计数已过期
+            cache.add(self._called_num_key, 0, gdata.ROLL_CALL_SESSION_TTL)
+            cache.incr(self._called_num_key)
+        return True
+
+    def draw(self):
+        """点名
+
+        :return: 学生id，全部点过时返回None
+        """
+        with self.lock:
+            self._sync()
+            while self.unchecked:
+                idx = random.randrange(self.unchecked)
+                last = self.unchecked - 1
+                self.pool[idx], self.pool[last] = self.pool[last], self.pool[idx]
+                self.unchecked = last
+                if self._claim(self.pool[last]):
+                    return self.pool[last]
+            return None
+
+    @property
+    def called_num(self):
+        return cache.get(self._called_num_key, 0)
+
+    @property
+    def remaining(self):
+        return max(len(self.pool) - self.called_num, 0)
+
+
+_sessions = utils.LRUCache(max_size=gdata.ROLL_CALL_SESSION_CACHE_SIZE, ttl=gdata.ROLL_CALL_SESSION_TTL)
+_sessions_lock = threading.Lock()
+
+
+def get_session(event_id):
+    """点名事件对应的点名会话，事件不存在或不是点名事件时返回None
+    """
+    session = _sessions.get(event_id)
+    if session is not None:
+        return session
+
+    with _sessions_lock:
+        session = _sessions.get(event_id)
+        if session is None:
+            event = models.TeachingEventTracker.objects.select_related('lesson').filter(
+                pk=event_id, event_type=gdata.EVENT_CALL).first()
+            if event is None:
+                return None
+            session = RollCallSession(event.id, event.lesson_id, event.lesson.teacher_id)
+            _sessions.set(event_id, session)
+            _logger.debug('start roll call session of event {}, {} students'.format(event_id, len(session.pool)))
+    return session
@@ -0,0 +1,229 @@
+"""
+签到写入
+
+签到请求先进入进程内缓冲区，按 (签到事件, 学生) 去重，
+由后台线程每隔 gdata.SIGN_IN_FLUSH_INTERVAL 秒或缓冲区满 gdata.SIGN_IN_BATCH_SIZE 条时批量写入。
+请求线程等待所在批次提交后才返回，签到成功即已落库。
+签到事件设置了地理围栏时，同一批次的定位在写入前一次性校验(logic.geofence)。
+整班人脸签到(verify_faces)不经过缓冲区，比对结果直接在一个事务内写入。
+"""
+from concurrent.futures import Future
+import collections
+import threading
+import time
+
+from django.db import close_old_connections, transaction
+from django.db.models import F
+
+import face_recognition
+from logic import geofence
+from teaching_helper import gdata
+from teaching_helper import glog
+from wx_client import models
+
+_logger = glog.get_logger(__name__)
+
+
+class SignInSubmission(object):
+    """一次签到请求
+    """
+
+    __slots__ = ('event_id', 'user_id', 'latitude', 'longitude', 'future')
+
+    def __init__(self, event_id, user_id, latitude=None, longitude=None):
+        self.event_id = event_id
+        self.user_id = user_id
+        self.latitude = latitude
+        self.longitude = longitude
+        self.future = Future()
+
+
+def _result(status, errmsg='', distance=None):
+    return {'status': status, 'errmsg': errmsg, 'distance': distance}
+
+
+def _check_locations(event, user_ids, locations):
+    """按签到事件的地理围栏校验学生位置
+
+    :param locations: {user_id: (latitude, longitude)}
+    :return: (distances, rejected)
+        distances: {user_id: 距离(米)}
+        rejected: {user_id: 拒绝结果}
+    """
+    fence = geofence.get_fence(event)
+    if fence is None:
+        return {}, {}
+
+    located = [_id for _id in user_ids if locations.get(_id) is not None]
+    rejected = {_id: _result(gdata.SIGN_IN_REJECTED, '缺少定位信息') for _id in user_ids if locations.get(_id) is None}
+    if not located:
+        return {}, rejected
+
+    distances, inside = fence.check([locations[_id][0] for _id in located], [locations[_id][1] for _id in located])
+    ret = {}
+    for _id, _distance, _inside in zip(located, distances.tolist(), inside.tolist()):
+        _distance = None if _distance != _distance else int(round(_distance))  # nan: 在外接矩形之外
+        if _inside:
+            ret[_id] = _distance
+        else:
+            rejected[_id] = _result(gdata.SIGN_IN_REJECTED, '不在签到范围内', _distance)
+    return ret, rejected
+
+
+def persist_sign_ins(event_id, user_ids, locations=None, check_fence=True):
+    """在一个事务内写入同一签到事件的多条签到，参与人数一次原子递增
+
+    签到事件行被锁定，同一事件的并发写入(多进程)串行执行；
+    未通过地理围栏校验的签到不写入
+
+    :param locations: {user_id: (latitude, longitude)}，签到事件未设置地理围栏时忽略
+    :param check_fence: 是否校验地理围栏，教师代签(如整班人脸签到)时不校验
+    :return: {user_id: {'status': ..., 'errmsg': ..., 'distance': ...}}
+    """
+    user_ids = set(user_ids)
+    locations = locations or {}
+    with transaction.atomic():
+        event = models.TeachingEventTracker.objects.select_for_update().filter(pk=event_id).first()
+        if event is None or event.event_type != gdata.EVENT_SIGN:
+            return {_id: _result(gdata.SIGN_IN_REJECTED, '签到不存在') for _id in user_ids}
+        if event.status != gdata.EVENT_STATUS_ON_SHELF:
+            return {_id: _result(gdata.SIGN_IN_REJECTED, '签到未开始或已结束') for _id in user_ids}
+
+        students = set(models.Lesson.student.through.objects.filter(
+            lesson_id=event.lesson_id, userprofile_id__in=user_ids).values_list('userprofile_id', flat=True))
+        signed = set(models.SignInTable.objects.filter(
+            event_id=event_id, user_id__in=students).values_list('user_id', flat=True))
+        distances, rejected = _check_locations(event, students - signed, locations) if check_fence else ({}, {})
+        fresh = students - signed - set(rejected)
+
+        models.SignInTable.objects.bulk_create([
+            models.SignInTable(lesson_id=event.lesson_id, event_id=event_id, user_id=_id, distance=distances.get(_id))
+            for _id in fresh])
+        if fresh:
+            models.TeachingEventTracker.objects.filter(pk=event_id).update(join_num=F('join_num') + len(fresh))
+
+    ret = {}
+    for _id in user_ids:
+        if _id in fresh:
+            ret[_id] = _result(gdata.SIGN_IN_SUCCESS, distance=distances.get(_id))
+        elif _id in rejected:
+            ret[_id] = rejected[_id]
+        elif _id in signed:
+            ret[_id] = _result(gdata.SIGN_IN_DUPLICATED, '已签到')
+        else:
+            ret[_id] = _result(gdata.SIGN_IN_REJECTED, '未加入该班课')
+    return ret
+
+
+class SignInBuffer(object):
+    """签到写入缓冲区(每进程一个)
+    """
+
+    def __init__(self, batch_size=gdata.SIGN_IN_BATCH_SIZE, interval=gdata.SIGN_IN_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending = collections.OrderedDict()  # (event_id, user_id) -> SignInSubmission
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.flush_count = 0
+
+    def submit(self, event_id, user_id, latitude=None, longitude=None):
+        """提交签到，同一学生在同一批次内的重复提交共享同一结果(以第一次提交的定位为准)
+
+        :return: concurrent.futures.Future，结果为 {'status': ..., 'errmsg': ..., 'distance': ...}
+        """
+        key = (event_id, user_id)
+        with self._lock:
+            submission = self._pending.get(key)
+            if submission is None:
+                submission = SignInSubmission(event_id, user_id, latitude, longitude)
+                self._pending[key] = submission
+            pending_num = len(self._pending)
+            self._ensure_worker()
+
+        if pending_num >= self.batch_size:
+            self._wakeup.set()
+        return submission.future
+
+    def _ensure_worker(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='th-sign-in-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                _logger.error('failed to flush sign-in buffer: {}'.format(e), exc_info=True)
+
+    def _take(self):
+        with self._lock:
+            batch, self._pending = list(self._pending.values()), collections.OrderedDict()
+        return batch
+
+    def flush(self):
+        """写入缓冲区中的全部签到
+
+        :return: 写入的签到请求数
+        """
+        batch = self._take()
+        if not batch:
+            return 0
+
+        by_event = collections.defaultdict(list)
+        for submission in batch:
+            by_event[submission.event_id].append(submission)
+
+        start = time.perf_counter()
+        try:
+            for event_id, submissions in by_event.items():
+                try:
+                    results = self._persist(event_id, submissions)
+                except Exception as e:
+                    _logger.error('failed to persist sign-ins of event {}: {}'.format(event_id, e), exc_info=True)
+                    for submission in submissions:
+                        submission.future.set_exception(e)
+                    continue
+                for submission in submissions:
+                    submission.future.set_result(results[submission.user_id])
+        finally:
+            close_old_connections()
+
+        self.flush_count += 1
+        _logger.debug('flush {} sign-ins of {} events in {:.3f}s'.format(
+            len(batch), len(by_event), time.perf_counter() - start))
+        return len(batch)
+
+    @staticmethod
+    def _persist(event_id, submissions):
+        locations = {_s.user_id: (_s.latitude, _s.longitude) for _s in submissions
+                     if _s.latitude is not None and _s.longitude is not None}
+        return persist_sign_ins(event_id, [_s.user_id for _s in submissions], locations)
+
+
+sign_in_buffer = SignInBuffer()
+
+
+def verify_faces(event_id, images, backend=None):
+    """整班人脸签到：全部人脸一次与班课学生比对，认定的学生在同一事务内签到
+
+    :param images: 图片(bytes)的可迭代对象，每张图片的人脸数见 face_recognition.BaseFaceBackend.faces_per_image；
+        传入生成器时图片在比对时读取
+    :return: {
+        'scores': {user_id: 最高得分}，班课中已录入人脸的学生,
+        'results': {user_id: 签到结果}，被认定的学生,
+    }
+    """
+    backend = backend or face_recognition.get_face_backend()
+    lesson_id = models.TeachingEventTracker.objects.filter(pk=event_id).values_list('lesson_id', flat=True).first()
+    if lesson_id is None:
+        return {'scores': {}, 'results': {}}
+
+    scores, matched = backend.match_batch(images, lesson_id)
+    results = persist_sign_ins(event_id, matched, check_fence=False) if matched else {}
+    _logger.info('face sign-in of event {}: {} students matched'.format(event_id, len(matched)))
+    return {'scores': scores, 'results': results}
@@ -1,4 +1,12 @@
+from django.core.cache import cache
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.utils import timezone
+
+import encryption
+import utils
+from logic import lesson_code as lesson_cipher
 from wx_client import models as wx_m
+from teaching_helper import gdata
 from teaching_helper import glog
 
 _logger = glog.get_logger(__name__)
@@ -6,12 +14,16 @@ _logger = glog.get_logger(__name__)
 
 class QueryFeatureForSignInHelper(object):
 
+    # 不含 base64_face/embedding 等大字段
+    FACE_RECORD_FIELDS = ('id', 'user_id', 'face_token', 'face_image', 'blue_tooth_mac', 'record_time')
+
     @staticmethod
     def query_face_record_by_user(user):
-        """查询指定user的人脸数据
+        """查询指定user的人脸数据(不加载人像及特征数据)
         """
         assert isinstance(user, wx_m.UserProfile), '`user` must be instance of UserProfile.'
-        face_record = wx_m.FeatureForSignIn.objects.filter(user=user).first()
+        face_record = wx_m.FeatureForSignIn.objects.filter(user=user).only(
+            *QueryFeatureForSignInHelper.FACE_RECORD_FIELDS).first()
         if not face_record:
             _logger.warning('Failed to get the face record of [<UserProfile>: {}]'.format(user.nickName))
         return face_record
@@ -19,6 +31,49 @@ class QueryFeatureForSignInHelper(object):
 
 class QueryUserProfileHelper(object):
 
+    # 进程内用户对象缓存，UserProfile的 post_save/post_delete 信号负责失效
+    user_cache = utils.LRUCache(max_size=gdata.USER_CACHE_SIZE, ttl=gdata.USER_CACHE_TTL)
+
+    @staticmethod
+    def query_user_by_id(user_id):
+        """按主键查询用户，优先命中进程内缓存
+        """
+        user = QueryUserProfileHelper.user_cache.get(user_id)
+        if user is not None:
+            return user
+
+        user = wx_m.UserProfile.objects.filter(pk=user_id).first()
+        if not user:
+            _logger.warning('Failed to get object of UserProfile by id:{}'.format(user_id))
+            return None
+
+        QueryUserProfileHelper.user_cache.set(user_id, user)
+        return user
+
+    @staticmethod
+    def invalidate_user(user_id):
+        QueryUserProfileHelper.user_cache.pop(user_id)
+
+    @staticmethod
+    def query_user_by_openid(openid):
+        """按openid的登录索引查询用户，命中旧版本索引时惰性地重新生成索引
+
+        :return: (user or None, 当前版本的登录索引)
+        """
+        index = encryption.login_index(openid)
+        user = wx_m.UserProfile.objects.filter(encrypted_code=index).first()
+        if user:
+            return user, index
+
+        legacy_indexes = encryption.legacy_login_indexes(openid)
+        user = wx_m.UserProfile.objects.filter(encrypted_code__in=legacy_indexes).first() if legacy_indexes else None
+        if user:
+            wx_m.UserProfile.objects.filter(pk=user.pk, encrypted_code=user.encrypted_code).update(encrypted_code=index)
+            QueryUserProfileHelper.invalidate_user(user.pk)
+            user.encrypted_code = index
+            _logger.info('re-keyed login index of [<UserProfile>: {}]'.format(user.pk))
+        return user, index
+
     @staticmethod
     def query_user_by_encrypted_code(encrypted_code):
         assert isinstance(encrypted_code, str)
@@ -46,6 +101,101 @@ class QuerySayingHelper(object):
 
 class QueryLesson(object):
 
+    # 班课码 -> (lesson_id, teacher_id)，进程内LRU + 共享缓存，班课创建/变更/删除时由信号失效
+    # 其他进程的LRU依赖较短的过期时间，班课码不会被重新分配，过期前的旧值仅在班课删除后出现
+    lesson_ref_cache = utils.LRUCache(max_size=gdata.LESSON_REF_CACHE_SIZE, ttl=gdata.LESSON_REF_LOCAL_TTL)
+
+    @staticmethod
+    def _ref_key(lesson_code):
+        return '{}:{}'.format(gdata.LESSON_REF_CACHE_PREFIX, lesson_code)
+
+    @staticmethod
+    def resolve_lesson_code(lesson_code):
+        """解析班课码
+
+        :return: (lesson_id, teacher_id)，班课不存在时返回None
+        """
+        if not isinstance(lesson_code, str) or not lesson_code:
+            return None
+
+        ref = QueryLesson.lesson_ref_cache.get(lesson_code)
+        if ref is not None:
+            return ref
+
+        ref = cache.get(QueryLesson._ref_key(lesson_code))
+        if ref is None:
+            lessons = wx_m.Lesson.objects.filter(lesson_code=lesson_code)
+            if lesson_cipher.cipher_enabled():
+                lesson_id = lesson_cipher.get_cipher().decode(lesson_code)
+                ref = lessons.filter(pk=lesson_id).values_list('id', 'teacher_id').first() if lesson_id else None
+            ref = ref or lessons.values_list('id', 'teacher_id').first()
+            if ref is None:
+                return None
+            ref = tuple(ref)
+            cache.set(QueryLesson._ref_key(lesson_code), ref, gdata.LESSON_REF_SHARED_TTL)
+
+        QueryLesson.lesson_ref_cache.set(lesson_code, ref)
+        return ref
+
+    @staticmethod
+    def invalidate_lesson_code(lesson_code):
+        QueryLesson.lesson_ref_cache.pop(lesson_code)
+        cache.delete(QueryLesson._ref_key(lesson_code))
+
     @staticmethod
     def query_lesson_by_lesson_code(lesson_code):
-        return wx_m.Lesson.objects.filter(lesson_code=lesson_code).first()
+        ref = QueryLesson.resolve_lesson_code(lesson_code)
+        if ref is None:
+            return None
+        return wx_m.Lesson.objects.select_related('counter').filter(pk=ref[0]).first()
+
+
+class QueryTeachingEvent(object):
+
+    @staticmethod
+    def query_schedule(lesson, page_size=gdata.LESSON_SCHEDULE_PAGE_SIZE, with_inactive=True):
+        """班课教学日程，按状态分桶，每桶一次查询、最多page_size条
+
+        状态在数据库中计算，查询命中 (lesson, start_time, end_time) 索引，查询次数与事件总数无关
+
+        :return:
+            {
+                'all': [...],
+                'active': [...],    # 进行中
+                'inactive': [...],  # 已结束，with_inactive为False时不返回
+                'upcoming': [...],  # 待开始
+            }
+        """
+        now = timezone.now()
+        is_active = Q(start_time__lte=now) & (Q(end_time__isnull=True) | Q(end_time__gt=now))
+        schedule_status = Case(
+            When(start_time__gt=now, then=Value(gdata.EVENT_STATUS_CODE_TO_SHELF)),
+            When(is_active, then=Value(gdata.EVENT_STATUS_CODE_ON_SHELF)),
+            default=Value(gdata.EVENT_STATUS_CODE_OFF_SHELF),
+            output_field=IntegerField())
+
+        events = wx_m.TeachingEventTracker.objects.filter(lesson=lesson).annotate(
+            schedule_status=schedule_status).values('id', 'event_type', 'start_time', 'end_time', 'join_num',
+                                                    'schedule_status')
+        buckets = {
+            'all': events.order_by('-start_time')[:page_size],
+            'active': events.filter(is_active).order_by('-start_time')[:page_size],
+            'upcoming': events.filter(start_time__gt=now).order_by('start_time')[:page_size],
+        }
+        if with_inactive:
+            buckets['inactive'] = events.filter(end_time__lte=now).order_by('-end_time')[:page_size]
+
+        event_names = dict(gdata.TEACHING_TRACK_EVENT_CHOICE)
+
+        def _format(event):
+            end_time = event['end_time']
+            return {
+                'start_time': timezone.localtime(event['start_time']).strftime('%Y-%m-%d %H:%M:%S'),
+                'end_time': timezone.localtime(end_time).strftime('%Y-%m-%d %H:%M:%S') if end_time else '',
+                'detail': event_names.get(event['event_type'], event['event_type']),
+                'status': event['schedule_status'],
+                'join_num': event['join_num'],
+                'code': str(event['id']),
+            }
+
+        return {name: [_format(_e) for _e in queryset] for name, queryset in buckets.items()}
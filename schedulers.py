@@ -3,6 +3,39 @@
 1. 邮件发送任务
 2. 缓存清理任务
 3. 异步日志收集
+4. 耗时的后台任务(如批量生成班课码)
 """
 
 from concurrent.futures import ThreadPoolExecutor
+import functools
+
+from django.db import close_old_connections
+
+from teaching_helper import gdata
+from teaching_helper import glog
+
+_logger = glog.get_logger(__name__)
+
+executor = ThreadPoolExecutor(max_workers=gdata.SCHEDULER_WORKERS, thread_name_prefix='th-scheduler')
+
+
+# functions
+
+
+def submit(fn, *args, **kwargs):
+    """提交后台任务，任务异常写入日志，任务结束后释放数据库连接
+
+    :return: concurrent.futures.Future
+    """
+
+    @functools.wraps(fn)
+    def _task():
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            _logger.error('background task `{}` failed: {}'.format(fn.__qualname__, e), exc_info=True)
+            raise
+        finally:
+            close_old_connections()
+
+    return executor.submit(_task)
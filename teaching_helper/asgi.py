@@ -3,6 +3,11 @@ ASGI config for teaching_helper project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Requests to ``gdata.LOGIN_QR_EVENTS_PATH`` are served by the Server-Sent Events
+handler in ``browser_client.sse``, all other requests are passed to Django.
+Route that path from nginx to the ASGI server (e.g. uvicorn) with
+``proxy_buffering off``.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 """
@@ -13,4 +18,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'teaching_helper.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from browser_client import sse  # noqa: E402  (django must be set up first)
+from teaching_helper import gdata  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] == gdata.LOGIN_QR_EVENTS_PATH:
+        await sse.qr_login_events(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
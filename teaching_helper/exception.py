@@ -1,3 +1,33 @@
 """
 项目自定义异常
 """
+
+
+class HTTPAccessError(Exception):
+    """第三方HTTP接口访问失败(超时、连接失败、重试耗尽、响应状态异常)
+    """
+
+    def __init__(self, name, msg):
+        self.name = name
+        super(HTTPAccessError, self).__init__('[{}] {}'.format(name, msg))
+
+
+class CircuitOpenError(HTTPAccessError):
+    """熔断器处于打开状态，请求被直接拒绝
+    """
+    pass
+
+
+class RateLimitError(Exception):
+    """等待限流令牌超时(第三方接口配额耗尽)
+    """
+
+    def __init__(self, name):
+        self.name = name
+        super(RateLimitError, self).__init__('[{}] rate limit exceeded'.format(name))
+
+
+class StoragePoolTimeout(Exception):
+    """等待文件存储连接超时(连接池已满)
+    """
+    pass
@@ -1,5 +1,5 @@
 # coding: utf-8
-import threading
+import os
 
 """
 提供除内置settings外的全局常量
@@ -7,18 +7,15 @@ import threading
 
 HTTP_DOMAIN = 'http://134.175.27.71'
 DEFAULT_LESSON_IMG = 'http://134.175.27.71/images/lesson_type_computer.jpg'
-LESSON_QR_CODE_PATH = r'/home/ubuntu/static_files/images/qrcode'
-LOGIN_QR_CODE_PATH = r'/home/ubuntu/static_files/images/loginqr'
 EXAM_TEMPLATE_PATH = r'/home/ubuntu/Downloads/quiz_template.xls'
 BASE_RESOURCE_PATH = r'/home/ubuntu/fdfs/storage/avatar_imgs/data'
 
 # WeChat api for registering
 
-WX_AUTH_API = 'https://api.weixin.qq.com/sns/jscode2session' \
-              '?appid={appid}' \
-              '&secret={secret}' \
-              '&js_code={js_code}' \
-              '&grant_type=authorization_code'
+# 可通过环境变量指向本地桩服务(python manage.py wx_stub_server)
+WX_API_BASE = os.environ.get('TH_WX_API_BASE', 'https://api.weixin.qq.com')
+# appid/secret/js_code 通过 params 传递，不拼入URL
+WX_AUTH_API = WX_API_BASE + '/sns/jscode2session'
 
 # necessary keys when use aip
 
@@ -41,6 +38,50 @@ AIP_CLIENT_ARGS = {
     }
 }
 
+# AIP face api access (face_recognition.AIPFaceService)
+AIP_QPS = 2  # AIP账号的QPS配额
+AIP_BURST = 2  # 令牌桶容量
+AIP_MAX_WORKERS = 4  # 并发请求线程数
+AIP_QUOTA_WAIT = 5  # 等待配额的最长时间(秒)
+AIP_CALL_TIMEOUT = 15  # 调用方等待结果的最长时间(秒)，含排队
+AIP_DETECT_CACHE_SIZE = 1024  # 人脸检测结果缓存数(按图片内容)
+AIP_DETECT_CACHE_TTL = 3000  # AIP face_token 1小时后失效，缓存时间需小于该值
+AIP_FACE_GROUP = 'students'  # 人脸库用户组，录入的人脸均注册在此组
+AIP_SEARCH_MAX_USER_NUM = 5  # 人脸库搜索返回的候选人数(AIP上限50)，候选人再按班课学生过滤
+AIP_ERROR_USER_NOT_FOUND = 222207  # 人脸库搜索未找到匹配的用户
+AIP_GROUP_PHOTO_MAX_FACES = 10  # 合照中参与搜索的最大人脸数(AIP M:N 搜索上限10)
+AIP_BATCH_MAX_IMAGES = 8  # 整班人脸签到单次最多上传的合照数，每张一次请求，需在 AIP_QUOTA_WAIT 内按 AIP_QPS 完成
+AIP_BATCH_IMAGE_MAX_SIZE = 1536 * 1024  # 整班人脸签到单张合照大小上限(字节)
+
+# face-match backends (face_recognition, settings.FACE_BACKEND)
+FACE_EMBEDDING_DIM = 512  # 本地人脸特征维数(float32)
+FACE_MATCH_THRESHOLD = 0.8  # 比对得分阈值，[0, 1]
+FACE_MATRIX_CACHE_SIZE = 256  # 缓存特征矩阵的班课数
+FACE_MATRIX_CACHE_TTL = 600  # 班课特征矩阵缓存时间(秒)
+FACE_IMAGE_MAX_SIZE = 2 * 1024 * 1024  # 人像图片大小上限(字节)
+FACE_BATCH_MAX_PROBES = 60  # 整班人脸签到单次最多上传的人脸数(本地比对，每张图片一张人脸)
+FACE_BATCH_IMAGE_MAX_SIZE = 256 * 1024  # 整班人脸签到单张人脸图片大小上限(字节)
+
+# outbound http (http_access.HTTPAccess)
+
+HTTP_POOL_SIZE = 64  # keep-alive connections per host, equals to uwsgi threads
+HTTP_CONNECT_TIMEOUT = 3
+HTTP_READ_TIMEOUT = 5
+HTTP_DEADLINE = 8  # total seconds per call, retries included
+HTTP_MAX_RETRIES = 2
+HTTP_RETRY_BACKOFF = 0.2  # base seconds of the jittered exponential backoff
+HTTP_BREAKER_FAILURES = 5  # consecutive failures before the circuit opens
+HTTP_BREAKER_RECOVERY = 30  # seconds before a half-open probe is allowed
+
+# FastDFS client pool (fdfs_storage.FdfsClientPool)
+
+FDFS_POOL_SIZE = 16  # pooled Fdfs_client instances per process
+FDFS_POOL_TIMEOUT = 5  # seconds to wait for a free client
+FDFS_IDLE_CHECK_SECS = 60  # clients idle longer than this are health-checked before use
+FDFS_CALL_RETRIES = 1  # retries with a fresh client after a connection error
+FDFS_CHUNK_SIZE = 4 * 1024 * 1024  # files larger than this are uploaded in appended chunks
+FDFS_REGISTER_ATTEMPTS = 3  # attempts to register an uploaded file in models.StoredFile
+
 REST_HTTP_METHODS = (
     'GET',
     'PUT',
@@ -180,19 +221,85 @@ EVENT_STATUS_TO_SHELF = '未开始'
 EVENT_STATUS_ON_SHELF = '进行中'
 EVENT_STATUS_OFF_SHELF = '已结束'
 
+# 教学日程中的事件状态码
+EVENT_STATUS_CODE_OFF_SHELF = 0  # 已结束
+EVENT_STATUS_CODE_ON_SHELF = 1  # 进行中
+EVENT_STATUS_CODE_TO_SHELF = 2  # 待开始
+
+LESSON_SCHEDULE_PAGE_SIZE = 10  # 班课首页教学日程每类返回的事件数
+
+# 签到写入缓冲(logic.sign_in)
+SIGN_IN_BATCH_SIZE = 200  # 缓冲区达到该数量时立即写入
+SIGN_IN_FLUSH_INTERVAL = 0.2  # 最长写入间隔(秒)
+SIGN_IN_ACK_TIMEOUT = 10  # 等待写入确认的最长时间(秒)
+
+SIGN_IN_FENCE_CACHE_SIZE = 1024  # 签到事件地理围栏缓存数
+SIGN_IN_MAX_RADIUS = 5000  # 签到半径上限(米)
+SIGN_IN_DEFAULT_DURATION = 5  # 签到默认持续时间(分钟)
+
+SIGN_IN_SUCCESS = 'success'
+SIGN_IN_DUPLICATED = 'duplicated'
+SIGN_IN_REJECTED = 'rejected'
+
+# 随机点名(logic.roll_call)
+ROLL_CALL_ROSTER_CACHE_SIZE = 1024  # 缓存学生名单的班课数
+ROLL_CALL_SESSION_CACHE_SIZE = 1024  # 同时进行的点名数
+ROLL_CALL_SESSION_TTL = 3 * 3600  # 点名会话保留时间(秒)
+ROLL_CALL_CALLED_KEY = 'roll_call:{}:called:{}'  # 共享缓存中已点到的学生(事件id, 学生id)
+ROLL_CALL_CALLED_NUM_KEY = 'roll_call:{}:called_num'  # 共享缓存中已点人数(事件id)
+
+# 考勤导出(logic.attendance)
+ATTENDANCE_EXPORT_BATCH_SIZE = 200  # 每批读取的学生数
+
 
 LESSON_CODE_NUM = 10000
 LESSON_CODE_LEN = 7
+LESSON_CODE_BATCH_SIZE = 10000  # 批量生成班课码时每批的候选数
+LESSON_CODE_JOB_KEY = 'lesson_code:job'  # 班课码生成任务进度的缓存键
+LESSON_CODE_JOB_LOCK_KEY = 'lesson_code:job:lock'  # 任务占位键，同时只允许一个任务运行
+LESSON_CODE_JOB_LOCK_TIMEOUT = 60 * 60  # 占位的最长时间，进程异常退出后自动释放
+LESSON_CODE_BLOCK_SIZE = 20  # 每个进程预留的班课码数量
+
+# 班课码生成方式(settings.LESSON_CODE_ENGINE)
+LESSON_CODE_ENGINE_TABLE = 'table'  # 从 LessonCode 表中分配
+LESSON_CODE_ENGINE_CIPHER = 'cipher'  # 由班课id经带密钥的双射直接计算，无需 LessonCode 表
+
+# 后台任务线程数(schedulers)
+SCHEDULER_WORKERS = 4
 
 
 # ------------缓存区------------------
 
-# 扫码登录缓存
-# 元素结构：
-# {
-#     'uuid': NamedTuple(effective_time=起效时间, is_success=是否成功, user_id=None, qr_path=None)
-# }
+# 已验证JWT缓存(以签名段为键，过期时间与token的exp一致)
+JWT_TOKEN_CACHE_SIZE = 4096
+
+# 已认证用户对象缓存(按主键)
+USER_CACHE_SIZE = 4096
+USER_CACHE_TTL = 10 * 60
+
+# 班课码解析缓存(班课码 -> 班课id)
+LESSON_REF_CACHE_SIZE = 4096
+LESSON_REF_CACHE_PREFIX = 'lesson_ref'
+LESSON_REF_LOCAL_TTL = 60
+LESSON_REF_SHARED_TTL = 24 * 60 * 60
+
+# 二维码渲染结果缓存(按内容)
+QR_CODE_CACHE_SIZE = 2048
+QR_CODE_URL_PREFIX = '/api/v1/wx_client/qrcode/'
+QR_CODE_MAX_AGE = 365 * 24 * 60 * 60
+
+# 扫码登录会话，存储于Django缓存(见 logic.qr_login)，过期后自动淘汰
+# 缓存键：
+#     'qr_login:<uuid>'       -> (起效时间, 二维码地址)
+#     'qr_login:<uuid>:scan'  -> 扫码用户的user_id，仅首次扫码可写入
 LOGIN_QR_EXPIRED_SECS = 5 * 60 * 60
-LOGIN_QR_CLS_NAME = 'LoginQRItem'
-LOGIN_QR_CODE_CACHE = dict()
-LOGIN_QR_CODE_CACHE_LOCK = threading.Lock()
+LOGIN_QR_CACHE_PREFIX = 'qr_login'
+
+# 扫码登录状态推送(SSE，见 browser_client.sse)
+LOGIN_QR_EVENTS_PATH = '/api/v1/browser_client/login/events'
+# 有推送(logic.qr_login.RedisQRLoginStore)时每隔 LOGIN_QR_EVENTS_PING_SECS 检查一次会话，只用于发现过期；
+# 无推送时从 LOGIN_QR_EVENTS_CHECK_SECS 开始按倍数退避，最长 LOGIN_QR_EVENTS_MAX_CHECK_SECS
+LOGIN_QR_EVENTS_CHECK_SECS = 1
+LOGIN_QR_EVENTS_MAX_CHECK_SECS = 5
+LOGIN_QR_EVENTS_PING_SECS = 15  # 保活注释行的发送间隔
+LOGIN_QR_EVENTS_MAX_SECS = 10 * 60  # 单个连接的最长持续时间，超时后浏览器自动重连
@@ -95,6 +95,31 @@ DATABASES = {
     }
 }
 
+# Cache
+# Redis (django-redis), shared by all uwsgi processes; QR-login sessions use a dedicated alias (and database),
+# so they are never evicted by lesson-code, job-progress or roll-call keys of the default cache
+
+REDIS_URL = os.environ.get('TH_REDIS_URL', 'redis://127.0.0.1:6379')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': REDIS_URL + '/1',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        },
+    },
+    'login': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': REDIS_URL + '/2',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        },
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -170,10 +195,49 @@ JWT_AUTH = {
     'JWT_PAYLOAD_HANDLER': utils.JWTHandler.jwt_payload_handler,
 }
 
+# ---------------------------------
+# login index (UserProfile.encrypted_code) configuration
+
+# HMAC keys by version, new logins are indexed with LOGIN_INDEX_VERSION.
+# rows indexed by an older version (or the legacy PBKDF2 `encryption.sha256`) are re-keyed on first login.
+LOGIN_INDEX_VERSION = 1
+LOGIN_INDEX_KEYS = {
+    1: SECRET_KEY,
+}
+LOGIN_INDEX_KDF_ITERATIONS = 100000  # key derivation cost, paid once per process and version
+
+# set it to False once no legacy PBKDF2 rows are left, then unknown openids no longer pay for PBKDF2
+LOGIN_INDEX_LEGACY_FALLBACK = True
+
+# ---------------------------------
+# lesson code engine: 'table' (LessonCode rows) or 'cipher' (keyed permutation of the lesson id)
+# don't change the key once codes have been issued by the cipher engine
+
+LESSON_CODE_ENGINE = 'table'
+LESSON_CODE_KEY = SECRET_KEY
+
+# ---------------------------------
+# QR login session store
+
+LOGIN_QR_STORE = 'logic.qr_login.RedisQRLoginStore'
+LOGIN_QR_CACHE_ALIAS = 'login'
+
+# ---------------------------------
+# face-match backend: 'face_recognition.AIPFaceBackend' or 'face_recognition.LocalEmbeddingBackend'
+# FACE_EMBEDDER maps image bytes to a float32 vector of gdata.FACE_EMBEDDING_DIM, used by the local backend only;
+# it has no default, set it to a real face model before switching FACE_BACKEND to the local backend
+# (face_recognition.StubEmbedder can't recognize faces, it is meant for tests and benchmarks)
+
+FACE_BACKEND = 'face_recognition.AIPFaceBackend'
+
 # ---------------------------------
 # FastDFS configuration
 
 DEFAULT_FILE_STORAGE = 'fdfs_storage.FastDFSStorage'
 
+# uploads larger than this are written to a temporary file instead of memory,
+# FastDFSStorage then streams the file to the storage server
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2 * 1024 * 1024
+
 FDFS_URL = 'http://134.175.27.71/'
 FDFS_CLIENT_CONF = '/etc/fdfs/client.conf'
@@ -1,9 +1,14 @@
+from urllib.parse import urljoin
+import collections
 import datetime
+import io
 import threading
+import time
 
 import jwt
+import qrcode
+import qrcode.image.svg
 from rest_framework.response import Response
-from MyQR import myqr
 
 from teaching_helper import glog
 from teaching_helper import gdata
@@ -38,9 +43,8 @@ class JWTHandler(object):
         options = {
             'verify_exp': True,
         }
-        # get user from token, BEFORE verification, to get user secret key
-        unverified_payload = jwt.decode(token, None, False)
-        secret_key = jwt_get_secret_key(unverified_payload)
+        # the secret key does not depend on the payload, so the token is decoded only once
+        secret_key = jwt_get_secret_key(None)
         return jwt.decode(
             token,
             secret_key,
@@ -70,35 +74,184 @@ class JWTHandler(object):
         return payload
 
 
-class QRCodeHelper(object):
-    """生成二维码
+class LRUCache(object):
+    """线程安全的LRU缓存，支持过期时间
+
+    :remark:
+        * 超过 max_size 时淘汰最久未使用的元素
+        * 每个元素可单独指定过期时间戳(expire_at)，未指定时使用 ttl(秒)，两者皆无则永不过期
+        * 通过 stats() 获取命中统计
+    """
+
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()  # key -> (expire_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key, None)
+            if item is None:
+                self.misses += 1
+                return default
+
+            expire_at, value = item
+            if expire_at is not None and expire_at <= now:
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expire_at=None):
+        if expire_at is None and self.ttl is not None:
+            expire_at = time.time() + self.ttl
+        with self._lock:
+            self._data[key] = (expire_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            }
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TokenBucket(object):
+    """线程安全的令牌桶限流
+
+    :remark:
+        * 每秒补充 rate 个令牌，最多积累 capacity 个
+        * acquire 阻塞等待令牌，超过 timeout 秒仍未取得返回False
     """
 
-    lock = threading.Lock()
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _wait_time(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                wait = self._wait_time()
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class SingleFlight(object):
+    """合并并发的重复调用
+
+    同一key的调用执行期间，后续调用不再提交，直接共享同一Future(结果或异常)
+    """
 
     def __init__(self):
-        self.is_successful = False
+        self._calls = {}  # key -> Future
+        self._lock = threading.Lock()
+
+    def submit(self, executor, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future
+            future = executor.submit(fn, *args, **kwargs)
+            self._calls[key] = future
+        future.add_done_callback(lambda _f: self._forget(key, _f))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def __len__(self):
+        return len(self._calls)
+
+
+class QRCodeHelper(object):
+    """二维码渲染服务
+
+    :remark:
+        * 在内存中生成PNG/SVG字节，不再写入磁盘
+        * 渲染结果按(内容, 格式)缓存于LRU，线程安全，每次调用独立返回结果
+        * 由 wx_client.views.QRCodeView 直接输出，图片地址见 `qr_code_url`
+    """
+
+    CONTENT_TYPES = {
+        'png': 'image/png',
+        'svg': 'image/svg+xml',
+    }
+
+    cache = LRUCache(max_size=gdata.QR_CODE_CACHE_SIZE)
 
     @staticmethod
-    def qr_code_helper():
-        with QRCodeHelper.lock:
-            if not hasattr(QRCodeHelper, 'ins'):
-                setattr(QRCodeHelper, 'ins', QRCodeHelper())
-            return getattr(QRCodeHelper, 'ins')
+    def qr_code_url(code, fmt='png'):
+        """二维码图片地址
+        """
+        return urljoin(gdata.HTTP_DOMAIN, '{}{}.{}'.format(gdata.QR_CODE_URL_PREFIX, code, fmt))
 
-    def generate_qr_code(self, code, path=gdata.LESSON_QR_CODE_PATH):
+    @staticmethod
+    def render(code, fmt='png'):
         """生成二维码
+
+        :return: 图片字节
         """
-        self.is_successful = True
-        try:
-            assert isinstance(code, str), '无法生成二维码'
-            myqr.run(words=code,
-                     version=9,
-                     save_name='{}.png'.format(code),
-                     save_dir=path)
-        except (AssertionError, Exception) as e:
-            _logger.warning('generate_qr_code, error:{}'.format(e), exc_info=True)
-            self.is_successful = False
+        assert isinstance(code, str) and code, '无法生成二维码'
+        assert fmt in QRCodeHelper.CONTENT_TYPES, '不支持的二维码格式: {}'.format(fmt)
+
+        data = QRCodeHelper.cache.get((code, fmt))
+        if data is not None:
+            return data
+
+        qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=10, border=2)
+        qr.add_data(code)
+        qr.make(fit=True)
+        image_factory = qrcode.image.svg.SvgPathImage if fmt == 'svg' else None
+        buffer = io.BytesIO()
+        qr.make_image(image_factory=image_factory).save(buffer)
+
+        data = buffer.getvalue()
+        QRCodeHelper.cache.set((code, fmt), data)
+        return data
 
 
 class DictResponse(Response):
@@ -118,6 +271,11 @@ class DictResponse(Response):
 
 
 class LoginQRItem(object):
+    """扫码登录会话
+    """
+
+    __slots__ = ('effective_time', 'is_success', 'user_id', 'qr_path')
+
     def __init__(self, effective_time, is_success, user_id, qr_path):
         self.effective_time = effective_time
         self.is_success = is_success
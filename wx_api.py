@@ -2,13 +2,12 @@
 support:
     * authenticate code and get openId and session_key
 """
-import json
-
 from teaching_helper import glog
 
 from teaching_helper import gdata
+from teaching_helper.exception import HTTPAccessError
 
-import requests
+from http_access import wx_http
 
 _logger = glog.get_logger(__name__)
 
@@ -22,16 +21,21 @@ class WxAPIAccess(object):
         """
 
         :param code:
-        :return:
+        :return: (session_key, open_id), both are None when WeChat is unavailable
         """
         data = {
             'appid': 'wx4669cc2551ee1599',
             'secret': 'eb2bbfd05a5ea50a33671c36922af13c',
             'js_code': code,
+            'grant_type': 'authorization_code',
         }
 
-        wx_auth_url = gdata.WX_AUTH_API.format(**data)
-        res = json.loads(requests.get(wx_auth_url).text)
+        try:
+            res = wx_http.get(gdata.WX_AUTH_API, params=data).json()
+        except (HTTPAccessError, ValueError) as e:
+            _logger.warning('failed to request jscode2session, error: {}'.format(e))
+            return None, None
+
         session_key = res.get('session_key', None)
         open_id = res.get('openid', None)
 
@@ -0,0 +1 @@
+default_app_config = 'wx_client.apps.WxClientConfig'
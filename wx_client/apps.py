@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class WxClientConfig(AppConfig):
     name = 'wx_client'
+
+    def ready(self):
+        # register signal handlers
+        from wx_client import signals  # noqa: F401
@@ -3,12 +3,54 @@ from rest_framework.authentication import BaseAuthentication
 from django.utils.decorators import classonlymethod
 from django.contrib.auth.decorators import login_required
 
+import model_access as mc
+import utils
 from wx_client import serializers
+from teaching_helper import gdata
 from teaching_helper import glog
 
 _logger = glog.get_logger(__name__)
 
 
+class VerifiedTokenCache(object):
+    """已验证JWT缓存
+
+    :remark:
+        * 以token的签名段为键，缓存过期时间与token的`exp`一致
+        * 缓存已解析的用户id，命中时经由用户缓存取得用户，无需再次解码JWT或查询数据库
+        * 命中时仍比对完整token，防止篡改payload后复用签名
+    """
+
+    def __init__(self, max_size=gdata.JWT_TOKEN_CACHE_SIZE):
+        self._cache = utils.LRUCache(max_size=max_size)
+
+    @staticmethod
+    def _key(token):
+        return token.rsplit('.', 1)[-1]
+
+    def get(self, token):
+        item = self._cache.get(self._key(token))
+        if item is None:
+            return None
+
+        cached_token, user_id = item
+        if cached_token != token:
+            return None
+        return user_id
+
+    def set(self, token, user_id, exp):
+        self._cache.set(self._key(token), (token, user_id), expire_at=exp)
+
+    def invalidate(self, token):
+        self._cache.pop(self._key(token))
+
+    def stats(self):
+        return self._cache.stats()
+
+
+token_cache = VerifiedTokenCache()
+
+
 class JWTokenAuth(BaseAuthentication):
     """验证接收自客户端的JWT签证
     """
@@ -17,10 +59,17 @@ class JWTokenAuth(BaseAuthentication):
         token = request.data.get('token')
         if not token:
             token = request.query_params.get('token')
+
+        user_id = token_cache.get(token) if token else None
+        user = mc.QueryUserProfileHelper.query_user_by_id(user_id) if user_id else None
+        if user and user.is_active:
+            return user, None
+
         valid_data = serializers.JWTVerificationSerializer().validate({'token': token})
 
         user = valid_data['user']
         if user:
+            token_cache.set(token, user.id, valid_data['payload'].get('exp'))
             return user, None
 
         return exceptions.AuthenticationFailed('login failed!')
@@ -31,4 +80,4 @@ class LoginRequire(object):
     @classonlymethod
     def as_view(cls, **initkwargs):
         _v = super(LoginRequire, cls).as_view(**initkwargs)
-        return login_required(_v)
\ No newline at end of file
+        return login_required(_v)
@@ -0,0 +1,58 @@
+"""
+本地人脸比对压测：用确定性的伪特征构造班课特征矩阵，测量 1:N 比对及整班批量比对的耗时并校验结果
+
+用法:
+    python manage.py bench_face_match --students 1000 --probes 200
+
+不访问数据库及 BaiDu AIP
+"""
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+import numpy as np
+
+import face_recognition
+from teaching_helper import gdata
+
+
+class Command(BaseCommand):
+    help = 'benchmark 1:N face matching of the local embedding backend'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=1000)
+        parser.add_argument('--probes', type=int, default=200)
+        parser.add_argument('--dim', type=int, default=gdata.FACE_EMBEDDING_DIM)
+
+    def handle(self, *args, **options):
+        dim = options['dim']
+        backend = face_recognition.LocalEmbeddingBackend(face_recognition.StubEmbedder(dim), dim=dim)
+        images = [os.urandom(64) for _ in range(options['students'])]
+
+        start = time.perf_counter()
+        vectors = [face_recognition.from_embedding_bytes(backend.enroll(_img)['embedding']) for _img in images]
+        enroll_cost = time.perf_counter() - start
+
+        lesson_id = 0
+        user_ids = np.arange(1, len(images) + 1, dtype=np.int64)
+        backend.matrices.set(lesson_id, face_recognition.LessonFaceMatrix(user_ids, np.vstack(vectors)))
+
+        probes = np.random.randint(0, len(images), options['probes'])
+        start = time.perf_counter()
+        results = [backend.match(images[_i], lesson_id) for _i in probes]
+        match_cost = time.perf_counter() - start
+
+        start = time.perf_counter()
+        scores, matched = backend.match_batch([images[_i] for _i in probes], lesson_id)
+        batch_cost = time.perf_counter() - start
+
+        wrong = sum(1 for _i, _r in zip(probes, results) if _r[0][0] != user_ids[_i] or _r[0][1] < 0.999)
+        self.stdout.write('enroll {} faces in {:.3f}s'.format(len(images), enroll_cost))
+        self.stdout.write('match {} probes against {} students in {:.3f}s ({:.3f}ms per probe)'.format(
+            len(probes), len(images), match_cost, match_cost / len(probes) * 1000))
+        self.stdout.write('batch match {} probes in {:.3f}s, {} students matched'.format(
+            len(probes), batch_cost, len(matched)))
+        if wrong:
+            raise CommandError('{} probes matched the wrong student'.format(wrong))
+        if set(matched) != {int(user_ids[_i]) for _i in probes} or len(scores) != len(images):
+            raise CommandError('batch match differs from single matches')
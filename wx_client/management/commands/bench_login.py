@@ -0,0 +1,59 @@
+"""
+登录索引压测：模拟早高峰并发登录，比较 PBKDF2 索引与 HMAC 索引的登录延迟
+
+用法:
+    python manage.py bench_login --logins 2000 --concurrency 64
+"""
+from concurrent.futures import ThreadPoolExecutor
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+import encryption
+from wx_client import models
+
+
+def _percentile(sorted_values, percent):
+    idx = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[idx]
+
+
+class Command(BaseCommand):
+    help = 'benchmark login latency of the legacy PBKDF2 index and the keyed HMAC index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--logins', type=int, default=2000, help='number of logins per scheme')
+        parser.add_argument('--concurrency', type=int, default=64, help='concurrent logins (uwsgi threads)')
+
+    def handle(self, *args, **options):
+        openids = ['o{}'.format(uuid.uuid4().hex) for _ in range(options['logins'])]
+        for name, index_func in (('pbkdf2 (legacy)', encryption.sha256),
+                                 ('hmac index', encryption.login_index)):
+            self._run(name, index_func, openids, options['concurrency'])
+
+    def _run(self, name, index_func, openids, concurrency):
+
+        def _login(openid):
+            start = time.perf_counter()
+            try:
+                models.UserProfile.objects.filter(encrypted_code=index_func(openid)).first()
+                return time.perf_counter() - start
+            finally:
+                connection.close()
+
+        # warm up: derive keys outside of the measurement
+        index_func(openids[0])
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = sorted(executor.map(_login, openids))
+        cost = time.perf_counter() - start
+
+        self.stdout.write('{:<16} {:>8.1f} login/s  p50={:.2f}ms p95={:.2f}ms p99={:.2f}ms'.format(
+            name,
+            len(openids) / cost,
+            _percentile(latencies, 50) * 1000,
+            _percentile(latencies, 95) * 1000,
+            _percentile(latencies, 99) * 1000))
@@ -0,0 +1,83 @@
+"""
+签到突发压测：模拟整班学生在同一时刻签到
+
+用法:
+    python manage.py bench_sign_in --students 500 --threads 64
+
+压测结束后删除创建的临时数据
+"""
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import datetime
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from logic.sign_in import SignInBuffer
+from teaching_helper import gdata
+from wx_client import models
+
+
+def _new_user(name):
+    u_uuid = uuid.uuid4()
+    return models.UserProfile(u_uuid=u_uuid, username=u_uuid.hex, nickName=name, encrypted_code=u_uuid.hex)
+
+
+class Command(BaseCommand):
+    help = 'simulate a class-start sign-in burst'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=500)
+        parser.add_argument('--threads', type=int, default=64, help='uwsgi threads')
+        parser.add_argument('--repeat', type=int, default=2, help='submissions per student')
+
+    def handle(self, *args, **options):
+        teacher = _new_user('sign-in-bench-teacher')
+        teacher.save()
+        models.UserProfile.objects.bulk_create(
+            [_new_user('sign-in-bench-{}'.format(_i)) for _i in range(options['students'])])
+        student_ids = list(models.UserProfile.objects.filter(
+            nickName__startswith='sign-in-bench-', id__gt=teacher.id).values_list('id', flat=True))
+        lesson = models.Lesson.objects.create(teacher=teacher, lesson_code='~{}'.format(uuid.uuid4().hex[:6]))
+        lesson.student.add(*student_ids)
+        event = models.TeachingEventTracker.objects.create(
+            lesson=lesson, event_type=gdata.EVENT_SIGN, start_time=timezone.now() - datetime.timedelta(minutes=1),
+            end_time=timezone.now() + datetime.timedelta(minutes=10))
+
+        buffer = SignInBuffer()
+
+        def _sign_in(user_id):
+            start = time.perf_counter()
+            try:
+                ret = buffer.submit(event.id, user_id).result(timeout=gdata.SIGN_IN_ACK_TIMEOUT)
+                return ret['status'], time.perf_counter() - start
+            finally:
+                connection.close()
+
+        try:
+            workload = student_ids * options['repeat']
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+                results = list(executor.map(_sign_in, workload))
+            cost = time.perf_counter() - start
+
+            latencies = sorted(_l for _, _l in results)
+            rows = models.SignInTable.objects.filter(event=event).count()
+            event.refresh_from_db()
+            self.stdout.write('{} submissions in {:.2f}s ({:.1f}/s), {} flushes'.format(
+                len(workload), cost, len(workload) / cost, buffer.flush_count))
+            self.stdout.write('status: {}'.format(dict(collections.Counter(_s for _s, _ in results))))
+            self.stdout.write('ack latency p50={:.1f}ms p99={:.1f}ms'.format(
+                latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000))
+            self.stdout.write('rows={} join_num={}'.format(rows, event.join_num))
+            if rows != len(student_ids) or event.join_num != len(student_ids):
+                raise CommandError('sign-in rows or join_num mismatch')
+        finally:
+            models.SignInTable.objects.filter(event=event).delete()
+            event.delete()
+            lesson.student.clear()
+            lesson.delete()
+            models.UserProfile.objects.filter(id__in=student_ids + [teacher.id]).delete()
@@ -0,0 +1,121 @@
+"""
+大文件上传内存压测：分别上传临时文件(TemporaryUploadedFile)及普通文件对象，
+上传过程中采样进程RSS，输出峰值增量，用于确认上传占用的内存与文件大小无关
+
+用法:
+    python manage.py fdfs_stub_server --port 22122 --discard
+    python manage.py bench_upload_memory --tracker 127.0.0.1:22122 --size 1024
+
+仅支持Linux(读取 /proc/self/status)
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+from django.core.files.base import File
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+
+from fdfs_storage import FastDFSStorage
+from teaching_helper import gdata
+
+MB = 1024 * 1024
+
+
+def current_rss():
+    """当前进程常驻内存(字节)
+    """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class RSSSampler(threading.Thread):
+    """后台线程按固定间隔采样RSS，记录峰值
+    """
+
+    def __init__(self, interval=0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.base = current_rss()
+        self.peak = self.base
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak - self.base
+
+
+def _fill(f, size):
+    block = os.urandom(MB)
+    for _ in range(size // MB):
+        f.write(block)
+    f.write(block[:size % MB])
+    f.flush()
+
+
+class Command(BaseCommand):
+    help = 'measure peak RSS while uploading large files through FastDFSStorage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tracker', default='127.0.0.1:22122')
+        parser.add_argument('--size', type=int, default=1024, help='megabytes per file')
+        parser.add_argument('--max-rss', type=int, default=None,
+                            help='fail if the peak RSS grows by more than this many megabytes')
+
+    def handle(self, *args, **options):
+        if not os.path.exists('/proc/self/status'):
+            raise CommandError('RSS sampling needs /proc/self/status')
+        size = options['size'] * MB
+        max_rss = options['max_rss'] if options['max_rss'] is not None else 4 * gdata.FDFS_CHUNK_SIZE // MB + 32
+
+        with tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False) as conf:
+            conf.write('connect_timeout=5\nnetwork_timeout=300\nbase_path=/tmp\ntracker_server={}\n'.format(
+                options['tracker']))
+        storage = FastDFSStorage(base_url='', client_conf=conf.name, dedup=False)
+
+        results = []
+        try:
+            # Django 上传大于 FILE_UPLOAD_MAX_MEMORY_SIZE 的文件时得到的对象
+            upload = TemporaryUploadedFile('bench.bin', 'application/octet-stream', size, None)
+            _fill(upload, size)
+            upload.seek(0)
+            results.append(('temporary uploaded file', self._measure(storage, upload)))
+            upload.close()
+
+            # 普通文件对象(如管理命令中打开的本地文件)
+            with tempfile.TemporaryFile() as f:
+                _fill(f, size)
+                f.seek(0)
+                results.append(('plain file', self._measure(storage, File(f, name='bench.bin'))))
+        finally:
+            os.unlink(conf.name)
+
+        for mode, (cost, grown) in results:
+            self.stdout.write('{}: {} MB in {:.2f}s ({:.1f} MB/s), peak RSS +{:.1f} MB'.format(
+                mode, options['size'], cost, options['size'] / cost, grown / MB))
+        self.stdout.write(json.dumps(storage.stats(), indent=2))
+        if any(_grown > max_rss * MB for _, (_, _grown) in results):
+            raise CommandError('peak RSS grew by more than {} MB'.format(max_rss))
+
+    @staticmethod
+    def _measure(storage, content):
+        sampler = RSSSampler()
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            storage.save(content.name, content)
+        finally:
+            cost = time.perf_counter() - start
+            grown = sampler.stop()
+        return cost, grown
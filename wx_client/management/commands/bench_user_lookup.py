@@ -0,0 +1,77 @@
+"""
+认证用户查询压测：比较按 nickName 查询与按主键+进程内缓存查询的RPS
+
+用法:
+    python manage.py bench_user_lookup --users 100000 --requests 20000
+
+所有种子数据在事务内写入，压测结束后回滚
+"""
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+import model_access as mc
+from wx_client import models
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'benchmark authenticated-user lookup (nickName scan vs primary key + LRU cache)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100000, help='number of seeded users')
+        parser.add_argument('--requests', type=int, default=20000, help='number of lookups per scenario')
+        parser.add_argument('--active', type=int, default=300, help='distinct users issuing requests')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self._run(options['users'], options['requests'], options['active'])
+                raise _Rollback()
+        except _Rollback:
+            self.stdout.write('seed data rolled back')
+
+    def _run(self, user_num, request_num, active_num):
+        self.stdout.write('seeding {} users...'.format(user_num))
+        batch = []
+        for idx in range(user_num):
+            u_uuid = uuid.uuid4()
+            batch.append(models.UserProfile(u_uuid=u_uuid,
+                                            username=u_uuid.hex,
+                                            nickName='user_{}'.format(idx),
+                                            encrypted_code=u_uuid.hex))
+            if len(batch) >= 5000:
+                models.UserProfile.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            models.UserProfile.objects.bulk_create(batch)
+
+        active_users = list(models.UserProfile.objects.order_by('?').values_list('id', 'nickName')[:active_num])
+        workload = [random.choice(active_users) for _ in range(request_num)]
+
+        def _by_nickname(item):
+            return models.UserProfile.objects.filter(nickName=item[1]).first()
+
+        def _by_pk(item):
+            return models.UserProfile.objects.filter(pk=item[0]).first()
+
+        def _by_cache(item):
+            return mc.QueryUserProfileHelper.query_user_by_id(item[0])
+
+        mc.QueryUserProfileHelper.user_cache.clear()
+        for name, func in (('nickName scan', _by_nickname),
+                           ('primary key', _by_pk),
+                           ('primary key + LRU', _by_cache)):
+            start = time.perf_counter()
+            for item in workload:
+                func(item)
+            cost = time.perf_counter() - start
+            self.stdout.write('{:<20} {:>10.1f} req/s'.format(name, request_num / cost))
+
+        self.stdout.write('user cache stats: {}'.format(mc.QueryUserProfileHelper.user_cache.stats()))
@@ -0,0 +1,63 @@
+"""
+班课码并发分配检查：模拟多个进程并发创建班课，校验班课码无重复
+
+用法:
+    python manage.py check_code_allocation --lessons 1000 --threads 64 --workers 4
+
+检查结束后删除创建的班课及临时教师，并归还占用的班课码
+"""
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from logic.lesson_code import LessonCodeAllocator
+from wx_client import models
+
+
+class Command(BaseCommand):
+    help = 'create lessons concurrently and check that lesson codes are unique'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lessons', type=int, default=1000)
+        parser.add_argument('--threads', type=int, default=64)
+        parser.add_argument('--workers', type=int, default=4, help='simulated uwsgi processes (allocators)')
+
+    def handle(self, *args, **options):
+        u_uuid = uuid.uuid4()
+        teacher = models.UserProfile.objects.create(u_uuid=u_uuid, username=u_uuid.hex,
+                                                    nickName='allocation-check', encrypted_code=u_uuid.hex)
+        allocators = [LessonCodeAllocator() for _ in range(options['workers'])]
+
+        def _create(idx):
+            try:
+                code = allocators[idx % len(allocators)].allocate()
+                if not code:
+                    return None
+                models.Lesson.objects.create(teacher=teacher, lesson_code=code, lesson_name='check-{}'.format(idx))
+                return code
+            finally:
+                connection.close()
+
+        codes = []
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+                codes = [_c for _c in executor.map(_create, range(options['lessons'])) if _c]
+            cost = time.perf_counter() - start
+
+            duplicated = [_c for _c, _n in collections.Counter(codes).items() if _n > 1]
+            self.stdout.write('created {} lessons in {:.2f}s, duplicated codes: {}'.format(
+                len(codes), cost, len(duplicated)))
+            if duplicated:
+                raise CommandError('duplicated lesson codes: {}'.format(duplicated[:10]))
+            if len(codes) < options['lessons']:
+                raise CommandError('lesson codes exhausted, generate more codes first')
+        finally:
+            models.Lesson.objects.filter(teacher=teacher).delete()
+            teacher.delete()
+            leftover = [_c for _a in allocators for _c in _a._block]
+            models.LessonCode.objects.filter(code__in=codes + leftover).update(is_occupied=False)
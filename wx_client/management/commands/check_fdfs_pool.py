@@ -0,0 +1,62 @@
+"""
+FastDFS连接池检查：并发上传到 tracker(可使用 fdfs_stub_server)，校验文件id无重复并输出连接池统计
+
+用法:
+    python manage.py fdfs_stub_server --port 22122 --drop-rate 0.02
+    python manage.py check_fdfs_pool --tracker 127.0.0.1:22122 --files 2000 --threads 64
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import tempfile
+import time
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+
+from fdfs_storage import CONNECTION_ERRORS, FastDFSStorage, FdfsClientPool
+
+
+class Command(BaseCommand):
+    help = 'upload files concurrently through the pooled FastDFS storage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tracker', default='127.0.0.1:22122')
+        parser.add_argument('--files', type=int, default=2000)
+        parser.add_argument('--threads', type=int, default=64)
+        parser.add_argument('--size', type=int, default=16 * 1024, help='bytes per file')
+        parser.add_argument('--pool-size', type=int, default=None)
+
+    def handle(self, *args, **options):
+        with tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False) as conf:
+            conf.write('connect_timeout=5\nnetwork_timeout=30\nbase_path=/tmp\ntracker_server={}\n'.format(
+                options['tracker']))
+        storage = FastDFSStorage(base_url='', client_conf=conf.name, dedup=False)
+        if options['pool_size']:
+            storage._pool = FdfsClientPool(storage.pool.factory, size=options['pool_size'])
+
+        payload = os.urandom(options['size'])
+
+        def _upload(idx):
+            try:
+                return storage.save('check-{}.bin'.format(idx), ContentFile(payload))
+            except CONNECTION_ERRORS as e:
+                # 上传阶段的错误不重试(存储服务器可能已保存)，计为失败
+                self.stderr.write('upload {} failed: {!r}'.format(idx, e))
+                return None
+
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+                file_ids = list(executor.map(_upload, range(options['files'])))
+            cost = time.perf_counter() - start
+        finally:
+            os.unlink(conf.name)
+
+        failed = file_ids.count(None)
+        file_ids = [_id for _id in file_ids if _id is not None]
+        self.stdout.write('uploaded {} files in {:.2f}s ({:.1f}/s), {} failed'.format(
+            len(file_ids), cost, len(file_ids) / cost, failed))
+        self.stdout.write(json.dumps(storage.stats(), indent=2))
+        if len(set(file_ids)) != len(file_ids):
+            raise CommandError('duplicated file ids')
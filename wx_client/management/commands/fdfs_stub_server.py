@@ -0,0 +1,165 @@
+"""
+本地FastDFS桩服务，同一端口同时充当 tracker 与 storage，文件保存在内存中，用于本地调试及压测
+
+用法:
+    python manage.py fdfs_stub_server --port 22122 --delay 0.01 --drop-rate 0.05
+    python manage.py fdfs_stub_server --discard  # 只记录文件大小，不保存内容(大文件压测)
+
+client.conf 中 tracker_server 指向该端口即可，支持上传、追加上传、删除、分组查询及连接检测
+"""
+import random
+import socketserver
+import struct
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+HEADER = struct.Struct('!QBB')  # pkg_len + cmd + status
+GROUP_NAME_LEN = 16
+IP_ADDRESS_LEN = 15
+EXT_NAME_LEN = 6
+
+CMD_RESP = 100
+CMD_QUIT = 82
+CMD_ACTIVE_TEST = 111
+CMD_LIST_ALL_GROUPS = 91
+CMD_QUERY_STORE = 101
+CMD_QUERY_FETCH = 102
+CMD_QUERY_UPDATE = 103
+CMD_UPLOAD_FILE = 11
+CMD_DELETE_FILE = 12
+CMD_UPLOAD_APPENDER_FILE = 23
+CMD_APPEND_FILE = 24
+
+ENOENT = 2
+EINVAL = 22
+
+
+class _SizeOnly(object):
+    """--discard 模式下代替文件内容，只累计大小
+    """
+
+    __slots__ = ('size',)
+
+    def __init__(self, data=b''):
+        self.size = len(data)
+
+    def extend(self, data):
+        self.size += len(data)
+
+    def __len__(self):
+        return self.size
+
+
+def _build_handler(group, host, port, delay, drop_rate, files, lock, discard=False):
+    store = _SizeOnly if discard else bytearray
+    group_name = group.encode().ljust(GROUP_NAME_LEN, b'\x00')
+    ip_addr = host.encode().ljust(IP_ADDRESS_LEN, b'\x00')
+
+    class StubHandler(socketserver.BaseRequestHandler):
+
+        def _recv(self, size):
+            data = b''
+            while len(data) < size:
+                chunk = self.request.recv(min(size - len(data), 65536))
+                if not chunk:
+                    raise ConnectionResetError
+                data += chunk
+            return data
+
+        def _recv_content(self, size):
+            """读取文件内容，分块写入，--discard 时不在内存中保留
+            """
+            content = store()
+            while size:
+                chunk = self._recv(min(size, 65536))
+                content.extend(chunk)
+                size -= len(chunk)
+            return content
+
+        def _reply(self, body=b'', status=0):
+            self.request.sendall(HEADER.pack(len(body), CMD_RESP, status) + body)
+
+        def handle(self):
+            try:
+                while True:
+                    pkg_len, cmd, _ = HEADER.unpack(self._recv(HEADER.size))
+                    if cmd == CMD_QUIT:
+                        return
+                    if cmd in (CMD_UPLOAD_FILE, CMD_UPLOAD_APPENDER_FILE):
+                        reply = self._upload(pkg_len)
+                    elif cmd == CMD_APPEND_FILE:
+                        reply = self._append(pkg_len)
+                    else:
+                        reply = self._dispatch(cmd, self._recv(pkg_len) if pkg_len else b'')
+                    time.sleep(delay)
+                    if random.random() < drop_rate:
+                        return  # simulate a broken connection
+                    self._reply(*reply)
+            except (ConnectionError, struct.error):
+                return
+
+        def _upload(self, pkg_len):
+            # |-store_path_index(1)-file_size(8)-file_ext_name(6)-|-content-|
+            _, file_size, ext_name = struct.unpack('!BQ{}s'.format(EXT_NAME_LEN), self._recv(15))
+            content = self._recv_content(pkg_len - 15)
+            ext_name = ext_name.strip(b'\x00').decode()
+            filename = 'M00/00/00/{}{}'.format(uuid.uuid4().hex, '.' + ext_name if ext_name else '')
+            with lock:
+                files[filename] = content
+            return group_name + filename.encode(), 0
+
+        def _append(self, pkg_len):
+            # |-appended_filename_len(8)-file_size(8)-appended_filename-|-content-|
+            name_len, file_size = struct.unpack('!QQ', self._recv(16))
+            filename = self._recv(name_len).decode()
+            content = self._recv_content(pkg_len - 16 - name_len)
+            with lock:
+                if filename not in files:
+                    return b'', ENOENT
+                files[filename].extend(content)
+            return b'', 0
+
+        def _dispatch(self, cmd, body):
+            if cmd in (CMD_ACTIVE_TEST, CMD_LIST_ALL_GROUPS):
+                return b'', 0
+            if cmd == CMD_QUERY_STORE:
+                return group_name + ip_addr + struct.pack('!QB', port, 0), 0
+            if cmd in (CMD_QUERY_FETCH, CMD_QUERY_UPDATE):
+                return group_name + ip_addr + struct.pack('!Q', port), 0
+            if cmd == CMD_DELETE_FILE:
+                filename = body[GROUP_NAME_LEN:].decode()
+                with lock:
+                    deleted = files.pop(filename, None)
+                return b'', 0 if deleted is not None else ENOENT
+            return b'', EINVAL
+
+    return StubHandler
+
+
+class Command(BaseCommand):
+    help = 'run a local stub server of FastDFS tracker and storage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=22122)
+        parser.add_argument('--group', default='group1')
+        parser.add_argument('--delay', type=float, default=0.0, help='seconds to wait before replying')
+        parser.add_argument('--drop-rate', type=float, default=0.0, help='ratio of requests answered by closing')
+        parser.add_argument('--discard', action='store_true', help='keep file sizes only')
+
+    def handle(self, *args, **options):
+        files, lock = {}, threading.Lock()
+        handler = _build_handler(options['group'], options['host'], options['port'], options['delay'],
+                                 options['drop_rate'], files, lock, options['discard'])
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer((options['host'], options['port']), handler)
+        server.daemon_threads = True
+        self.stdout.write('FastDFS stub server listening on {}:{}'.format(options['host'], options['port']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write('{} files, {} bytes stored'.format(len(files), sum(len(_f) for _f in files.values())))
+            server.server_close()
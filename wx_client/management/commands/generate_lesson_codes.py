@@ -0,0 +1,30 @@
+"""
+批量生成班课码
+
+用法:
+    python manage.py generate_lesson_codes --num 100000
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from logic.lesson_code import LessonCodeGenerator
+from teaching_helper import gdata
+
+
+class Command(BaseCommand):
+    help = 'generate lesson codes in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--num', type=int, default=gdata.LESSON_CODE_NUM, help='number of codes')
+        parser.add_argument('--batch-size', type=int, default=gdata.LESSON_CODE_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+
+        def _progress(created, total):
+            self.stdout.write('{}/{} ({:.1f}s)'.format(created, total, time.perf_counter() - start))
+
+        created = LessonCodeGenerator(batch_size=options['batch_size']).generate(options['num'], progress=_progress)
+        self.stdout.write(self.style.SUCCESS('generated {} lesson codes in {:.2f}s'.format(
+            created, time.perf_counter() - start)))
@@ -0,0 +1,44 @@
+"""
+把 FeatureForSignIn.base64_face 中的历史人像图片转存至FastDFS
+
+用法:
+    python manage.py migrate_face_images --batch-size 100
+
+可重复执行，只处理 base64_face 非空的记录
+"""
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+
+import face_recognition
+from fdfs_storage import fc
+from wx_client import models
+
+
+class Command(BaseCommand):
+    help = 'move legacy base64 face images into FastDFS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        moved = invalid = 0
+        last_id = 0
+        while True:
+            records = list(models.FeatureForSignIn.objects.filter(id__gt=last_id).exclude(base64_face='').order_by(
+                'id').only('id', 'base64_face')[:options['batch_size']])
+            if not records:
+                break
+            last_id = records[-1].id
+
+            for record in records:
+                image = face_recognition.decode_b64_image(record.base64_face)
+                face_image = ''
+                if image:
+                    suffix = face_recognition.guess_image_suffix(image)
+                    face_image = fc.save('face.{}'.format(suffix), ContentFile(image)).decode()
+                    moved += 1
+                else:
+                    invalid += 1
+                models.FeatureForSignIn.objects.filter(pk=record.pk).update(face_image=face_image, base64_face='')
+
+        self.stdout.write('moved {} face images, dropped {} invalid ones'.format(moved, invalid))
@@ -0,0 +1,23 @@
+"""
+校准班课计数(LessonCounter)，建议通过 crontab 定期执行，例如每小时:
+
+    0 * * * * cd /home/ubuntu/services/teaching_helper && python manage.py reconcile_lesson_counters
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from logic import lesson_counter
+
+
+class Command(BaseCommand):
+    help = 'recount students, resources, questions, notices and events of lessons'
+
+    def add_arguments(self, parser):
+        parser.add_argument('lesson_ids', nargs='*', type=int, help='default -> all lessons')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        done = lesson_counter.reconcile(options['lesson_ids'] or None)
+        self.stdout.write(self.style.SUCCESS('reconciled {} lessons in {:.2f}s'.format(
+            done, time.perf_counter() - start)))
@@ -0,0 +1,47 @@
+"""
+把已录入的人脸注册到AIP人脸库用户组 gdata.AIP_FACE_GROUP
+
+用法:
+    python manage.py sync_aip_faces --batch-size 100
+
+人脸库搜索(face_recognition.AIPFaceBackend)之前录入的人脸不在人脸库中，按 face_token 补注册；
+可重复执行，已注册的用户覆盖原人脸
+"""
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from django.core.management.base import BaseCommand
+
+import face_recognition
+from teaching_helper.exception import RateLimitError
+from wx_client import models
+
+
+class Command(BaseCommand):
+    help = 'register enrolled faces into the AIP face library'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        added = failed = 0
+        last_id = 0
+        while True:
+            records = list(models.FeatureForSignIn.objects.filter(id__gt=last_id).order_by('id').only(
+                'id', 'user_id', 'face_token')[:options['batch_size']])
+            if not records:
+                break
+            last_id = records[-1].id
+
+            for record in records:
+                try:
+                    res = face_recognition.aip_service.add_user(record.face_token, record.user_id)
+                except (RateLimitError, FutureTimeoutError) as e:
+                    res = {'error_code': -1, 'error_msg': repr(e)}
+                if res.get('error_code'):
+                    failed += 1
+                    self.stderr.write('failed to register the face of [UserProfile:{}]: {}'.format(
+                        record.user_id, res.get('error_msg')))
+                else:
+                    added += 1
+
+        self.stdout.write('registered {} faces, {} failed'.format(added, failed))
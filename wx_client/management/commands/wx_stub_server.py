@@ -0,0 +1,71 @@
+"""
+本地微信接口桩服务，代替 jscode2session 用于本地调试及压测
+
+用法:
+    python manage.py wx_stub_server --port 18080 --delay 0.05 --error-rate 0.1
+    TH_WX_API_BASE=http://127.0.0.1:18080 python manage.py runserver
+
+返回的 openid 由 js_code 确定性地生成，同一个 code 总是对应同一个用户
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import hashlib
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+
+def _build_handler(delay, error_rate):
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/sns/jscode2session':
+                return self._reply(404, {'errcode': 404, 'errmsg': 'not found'})
+
+            time.sleep(delay)
+            if random.random() < error_rate:
+                return self._reply(503, {'errcode': -1, 'errmsg': 'system busy'})
+
+            js_code = parse_qs(url.query).get('js_code', [''])[0]
+            if not js_code:
+                return self._reply(200, {'errcode': 40029, 'errmsg': 'invalid code'})
+
+            digest = hashlib.sha256(js_code.encode('utf-8')).hexdigest()
+            return self._reply(200, {'openid': 'stub-{}'.format(digest[:28]), 'session_key': digest[28:52]})
+
+        def _reply(self, status, data):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_):
+            pass
+
+    return StubHandler
+
+
+class Command(BaseCommand):
+    help = 'run a local stub server of WeChat jscode2session'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=18080)
+        parser.add_argument('--delay', type=float, default=0.0, help='seconds to wait before replying')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='ratio of 503 replies')
+
+    def handle(self, *args, **options):
+        server = ThreadingHTTPServer((options['host'], options['port']),
+                                     _build_handler(options['delay'], options['error_rate']))
+        self.stdout.write('WeChat stub server listening on http://{}:{}'.format(options['host'], options['port']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
@@ -53,7 +53,12 @@ class FeatureForSignIn(models.Model):
 
     user = models.ForeignKey('UserProfile', on_delete=models.CASCADE)
     face_token = models.CharField(verbose_name='人脸特征密文', max_length=132, unique=True)
-    base64_face = models.TextField(max_length=10000)
+    # 人像图片原始字节存放于FastDFS，此处只保存 file id
+    face_image = models.CharField(verbose_name='人像图片', max_length=128, default='', blank=True)
+    # legacy, base64 images uploaded before face_image existed, moved out by `manage.py migrate_face_images`
+    base64_face = models.TextField(max_length=10000, default='', blank=True)
+    # float32 x gdata.FACE_EMBEDDING_DIM, only written by face_recognition.LocalEmbeddingBackend
+    embedding = models.BinaryField(null=True, verbose_name='人脸特征向量')
     # the mac of BlueTooth is not unique
     blue_tooth_mac = models.CharField(verbose_name='蓝牙Mac地址', max_length=64)
     record_time = models.DateTimeField(verbose_name='记录时间', auto_now_add=True)
@@ -68,7 +73,7 @@ class Lesson(models.Model):
 
     cls_img = models.URLField(default=gdata.DEFAULT_LESSON_IMG)
     teacher = models.ForeignKey(UserProfile, related_name='teaching_lessons', on_delete=models.PROTECT)
-    lesson_code = models.CharField(max_length=gdata.LESSON_CODE_LENGTH, db_index=True)
+    lesson_code = models.CharField(max_length=gdata.LESSON_CODE_LENGTH, unique=True)
     lesson_name = models.CharField(max_length=32, default='')
     lesson_cls = models.CharField(max_length=2, choices=gdata.LESSON_CLS_CHOICE, default=gdata.OTHER_SUBJECT)
     create_time = models.DateTimeField(auto_created=True, default=timezone.now)
@@ -82,7 +87,27 @@ class Lesson(models.Model):
 
     @property
     def stu_num(self):
-        return self.student.count()
+        try:
+            return self.counter.student_num
+        except LessonCounter.DoesNotExist:
+            return self.student.count()
+
+
+class LessonCounter(models.Model):
+    """班课计数(反范式)
+
+    由 wx_client.signals 随学生加入/退出、资源、答疑、教学事件的增删同步更新，
+    由 logic.lesson_counter.reconcile 定期校准
+    """
+
+    lesson = models.OneToOneField(Lesson, related_name='counter', primary_key=True, on_delete=models.CASCADE)
+    student_num = models.IntegerField(default=0, verbose_name='学生数')
+    resource_num = models.IntegerField(default=0, verbose_name='课堂资源数')
+    question_num = models.IntegerField(default=0, verbose_name='答疑问题数')
+    solved_question_num = models.IntegerField(default=0, verbose_name='已解决问题数')
+    notice_num = models.IntegerField(default=0, verbose_name='通知数')
+    event_num = models.IntegerField(default=0, verbose_name='教学事件数')
+    reconcile_time = models.DateTimeField(null=True, verbose_name='最近校准时间')
 
 
 class LessonResource(models.Model):
@@ -163,12 +188,22 @@ class TeachingEventTracker(models.Model):
     join_num = models.IntegerField(default=0, verbose_name='参与人数')
     lesson = models.ForeignKey(Lesson, related_name='lesson_events', on_delete=models.PROTECT)
 
+    # 定位签到的地理围栏，未设置时不校验学生位置
+    latitude = models.FloatField(null=True, verbose_name='签到中心纬度')
+    longitude = models.FloatField(null=True, verbose_name='签到中心经度')
+    radius = models.IntegerField(null=True, verbose_name='签到半径(米)')
+
     # sign_in_related的json字符串，且其中六种类型(key)互斥
     ext_info = models.TextField(max_length=128, null=False, default=json.dumps(SIGN_IN_RELATED))
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['lesson', 'start_time', 'end_time'], name='event_lesson_time_idx'),
+        ]
+
     @property
     def status(self):
-        now_time = datetime.now()
+        now_time = timezone.now()
         if now_time > self.start_time:
             if (self.end_time and now_time < self.end_time) or (not self.end_time):
                 return gdata.EVENT_STATUS_ON_SHELF
@@ -189,9 +224,15 @@ class SignInTable(models.Model):
     """
 
     lesson = models.ForeignKey(Lesson, related_name='sign_events', on_delete=models.PROTECT)
+    event = models.ForeignKey(TeachingEventTracker, related_name='sign_ins', null=True, on_delete=models.PROTECT)
     success_time = models.DateTimeField(auto_now_add=True, verbose_name='签到时间')
     user = models.ForeignKey(UserProfile, on_delete=models.PROTECT)
-    distance = models.IntegerField(null=True)
+    distance = models.IntegerField(null=True, verbose_name='与签到中心的距离(米)')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['event', 'user'], name='unique_event_sign_in'),
+        ]
 
     # @property
     # def full_stu_num(self):
@@ -227,10 +268,10 @@ class LessonAnswer(models.Model):
 class LessonCode(models.Model):
     """班课码
 
-    暂时支持10万个班课码，脚本录入
+    暂时支持10万个班课码，由 logic.lesson_code.LessonCodeGenerator 批量录入
     """
-    code = models.CharField(max_length=16, verbose_name='班课随机码', null=False, db_index=True)
-    is_occupied = models.BooleanField(null=False, verbose_name='是否被占用', default=False)
+    code = models.CharField(max_length=16, verbose_name='班课随机码', null=False, unique=True)
+    is_occupied = models.BooleanField(null=False, verbose_name='是否被占用', default=False, db_index=True)
 
 
 class Saying(models.Model):
@@ -282,3 +323,21 @@ class SayingComment(models.Model):
                              related_name='sub_comments', on_delete=models.CASCADE)
     comment_time = models.DateTimeField(auto_now_add=True)
     is_delete = models.BooleanField(default=False)
+
+
+class StoredFile(models.Model):
+    """FastDFS文件的内容索引，相同内容(sha256 + 扩展名)只保存一份
+
+    由 fdfs_storage.FastDFSStorage 维护: save 命中时引用计数加一，delete 时减一，减到0才删除远端文件
+    """
+
+    digest = models.CharField(verbose_name='内容sha256', max_length=64)
+    ext_name = models.CharField(verbose_name='扩展名', max_length=16, default='', blank=True)
+    remote_file_id = models.CharField(verbose_name='FastDFS文件id', max_length=128, unique=True)
+    size = models.BigIntegerField(default=0, verbose_name='文件大小')
+    ref_count = models.IntegerField(default=1, verbose_name='引用计数')
+    create_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'stored file'
+        unique_together = ('digest', 'ext_name')
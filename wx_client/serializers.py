@@ -4,11 +4,11 @@ import jwt
 from django.utils.translation import ugettext as _
 from rest_framework import serializers
 
+import model_access as mc
 from teaching_helper import gdata
 from teaching_helper import glog
 from utils import JWTHandler
 from wx_client import models
-from wx_client import models as wx_m
 
 _logger = glog.get_logger(__name__)
 
@@ -28,6 +28,7 @@ class JWTVerificationSerializer(serializers.Serializer):
 
         return {
             'token': token,
+            'payload': payload,
             'user': user
         }
 
@@ -48,16 +49,15 @@ class JWTVerificationSerializer(serializers.Serializer):
 
     def _check_user(self, payload):
         _self = self
-        username = JWTHandler.jwt_get_username_from_payload_handler(payload)
+        user_id = payload.get('user_id')
 
-        if not username:
+        if not user_id:
             msg = _('Invalid payload.')
             raise serializers.ValidationError(msg)
 
         # Make sure user exists
-        try:
-            user = wx_m.UserProfile.objects.filter(nickName=username).first()
-        except wx_m.UserProfile.DoesNotExist:
+        user = mc.QueryUserProfileHelper.query_user_by_id(user_id)
+        if not user:
             msg = _("User doesn't exist.")
             raise serializers.ValidationError(msg)
 
@@ -117,7 +117,7 @@ class UserInfoSerializer(serializers.ModelSerializer):
 class FeatureForSignInSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.FeatureForSignIn
-        fields = ('face_token', 'base64_face')
+        fields = ('face_token',)
 
     def update(self, instance, validated_data):
         super(FeatureForSignInSerializer, self).update(instance, validated_data)
@@ -166,6 +166,42 @@ class LessonInfoSerializer(serializers.ModelSerializer):
         depth = 1
 
 
+class LessonListSerializer(serializers.ModelSerializer):
+    """班课列表(我创建的/我听的)
+
+    :remark:
+        * 仅输出教师的简要信息，不输出学生列表
+        * 查询集须经 `prepare` 处理：教师及班课计数(LessonCounter)通过join查询，每个列表固定一次查询
+        * 学生数取自 LessonCounter.student_num，与班课详情一致
+    """
+
+    teacher = UserInfoSerializer()
+    stu_num = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = models.Lesson
+        fields = (
+            'id',
+            'cls_img',
+            'teacher',
+            'lesson_code',
+            'lesson_name',
+            'lesson_cls',
+            'create_time',
+            'finish_time',
+            'qr_code',
+            'academic_year',
+            'term',
+            'is_delete',
+            'desc',
+            'stu_num',
+        )
+
+    @staticmethod
+    def prepare(queryset):
+        return queryset.select_related('teacher', 'counter')
+
+
 class SayingInfoSerializer(serializers.ModelSerializer):
 
     class Meta:
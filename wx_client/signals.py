@@ -0,0 +1,184 @@
+"""
+wx_client 模型信号处理
+
+* UserProfile 变更/删除时使进程内用户缓存失效
+* 维护班课计数(LessonCounter)
+* 班课创建/变更/删除时使班课码解析缓存失效
+* 学生加入/退出班课时更新随机点名名单
+* 学生加入班课或人脸数据变更时使班课人脸特征矩阵失效
+"""
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+import face_recognition
+import model_access as mc
+from logic import lesson_counter
+from logic import roll_call
+from teaching_helper import gdata
+from wx_client import models
+
+
+@receiver([post_save, post_delete], sender=models.UserProfile)
+def invalidate_user_cache(sender, instance, **_):
+    _ = sender
+    mc.QueryUserProfileHelper.invalidate_user(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=models.Lesson)
+def invalidate_lesson_ref_cache(sender, instance, **_):
+    _ = sender
+    mc.QueryLesson.invalidate_lesson_code(instance.lesson_code)
+
+
+# ---------------------------------------------
+# 班课计数
+
+
+@receiver(post_save, sender=models.Lesson)
+def create_lesson_counter(sender, instance, created, **_):
+    _ = sender
+    if created:
+        models.LessonCounter.objects.get_or_create(lesson=instance)
+
+
+@receiver(m2m_changed, sender=models.Lesson.student.through)
+def count_lesson_students(sender, instance, action, reverse, pk_set, **_):
+    """学生加入/退出班课，与 add/remove 处于同一事务
+
+    post_add 的 pk_set 只含新加入的关联，而 post_remove 的 pk_set 是调用方传入的全部id(含并非成员的)，
+    因此在 pre_remove 中先查出实际会删除的关联，post_remove 按其计数
+    """
+    _ = sender
+    if action == 'pre_remove':
+        instance._removed_member_ids = _member_ids(instance, reverse, pk_set) if pk_set else set()
+    elif action in ('post_add', 'post_remove'):
+        if action == 'post_remove':
+            pk_set = instance.__dict__.pop('_removed_member_ids', pk_set)
+        if not pk_set:
+            return
+        delta = 1 if action == 'post_add' else -1
+        if reverse:  # user.listening_lessons.add(*lessons)
+            lesson_counter.incr(pk_set, student_num=delta)
+        else:  # lesson.student.add(*users)
+            lesson_counter.incr([instance.pk], student_num=delta * len(pk_set))
+    elif action == 'post_clear':
+        if reverse:
+            # lessons of the user are unknown after clearing, leave it to the periodic reconciling
+            return
+        lesson_counter.reconcile([instance.pk])
+
+
+def _member_ids(instance, reverse, pk_set):
+    """pk_set 中与 instance 存在班课成员关系的id
+    """
+    through = models.Lesson.student.through.objects
+    if reverse:  # instance 为学生，pk_set 为班课
+        rows = through.filter(userprofile_id=instance.pk, lesson_id__in=pk_set).values_list('lesson_id', flat=True)
+    else:
+        rows = through.filter(lesson_id=instance.pk, userprofile_id__in=pk_set).values_list('userprofile_id', flat=True)
+    return set(rows)
+
+
+@receiver(post_save, sender=models.LessonResource)
+def count_lesson_resources(sender, instance, created, **_):
+    _ = sender
+    if created and not instance.is_delete:
+        lesson_counter.incr([instance.lesson_id], resource_num=1)
+
+
+@receiver(post_delete, sender=models.LessonResource)
+def uncount_lesson_resources(sender, instance, **_):
+    _ = sender
+    if not instance.is_delete:
+        lesson_counter.incr([instance.lesson_id], resource_num=-1)
+
+
+@receiver(post_save, sender=models.LessonQuestion)
+def count_lesson_questions(sender, instance, created, **_):
+    _ = sender
+    if created:
+        lesson_counter.incr([instance.lesson_id], question_num=1)
+
+
+@receiver(post_delete, sender=models.LessonQuestion)
+def uncount_lesson_questions(sender, instance, **_):
+    _ = sender
+    lesson_counter.incr([instance.lesson_id], question_num=-1)
+    lesson_counter.refresh_solved(instance.lesson_id)
+
+
+@receiver([post_save, post_delete], sender=models.LessonAnswer)
+def count_solved_questions(sender, instance, **_):
+    _ = sender
+    lesson_counter.refresh_solved(instance.lesson_question.lesson_id)
+
+
+@receiver(post_save, sender=models.TeachingEventTracker)
+def count_lesson_events(sender, instance, created, **_):
+    _ = sender
+    if created:
+        lesson_counter.incr([instance.lesson_id],
+                            event_num=1,
+                            notice_num=1 if instance.event_type == gdata.EVENT_NOTICE else 0)
+
+
+@receiver(post_delete, sender=models.TeachingEventTracker)
+def uncount_lesson_events(sender, instance, **_):
+    _ = sender
+    lesson_counter.incr([instance.lesson_id],
+                        event_num=-1,
+                        notice_num=-1 if instance.event_type == gdata.EVENT_NOTICE else 0)
+
+
+# ---------------------------------------------
+# 随机点名名单
+
+
+@receiver(m2m_changed, sender=models.Lesson.student.through)
+def update_roll_call_rosters(sender, instance, action, reverse, pk_set, **_):
+    """名单在事务提交后更新，回滚的加入/退出不影响名单
+    """
+    _ = sender
+    if action == 'post_add' and pk_set:
+        if reverse:
+            added = [(_id, [instance.pk]) for _id in pk_set]
+        else:
+            added = [(instance.pk, list(pk_set))]
+        transaction.on_commit(lambda: [roll_call.rosters.add_students(*_a) for _a in added])
+    elif action == 'post_remove' and pk_set:
+        lesson_ids = list(pk_set) if reverse else [instance.pk]
+        transaction.on_commit(lambda: [roll_call.rosters.invalidate(_id) for _id in lesson_ids])
+    elif action == 'pre_clear' and reverse:
+        lesson_ids = list(instance.listening_lessons.values_list('id', flat=True))
+        transaction.on_commit(lambda: [roll_call.rosters.invalidate(_id) for _id in lesson_ids])
+    elif action == 'post_clear' and not reverse:
+        lesson_id = instance.pk
+        transaction.on_commit(lambda: roll_call.rosters.invalidate(lesson_id))
+
+
+# ---------------------------------------------
+# 班课人脸特征矩阵
+
+
+def _invalidate_face_matrices(lesson_ids):
+    backend = face_recognition.get_face_backend()
+    if isinstance(backend, face_recognition.LocalEmbeddingBackend):
+        lesson_ids = list(lesson_ids)
+        transaction.on_commit(lambda: backend.invalidate(lesson_ids))
+
+
+@receiver([post_save, post_delete], sender=models.FeatureForSignIn)
+def invalidate_face_matrices(sender, instance, **_):
+    _ = sender
+    _invalidate_face_matrices(models.Lesson.student.through.objects.filter(
+        userprofile_id=instance.user_id).values_list('lesson_id', flat=True))
+
+
+@receiver(m2m_changed, sender=models.Lesson.student.through)
+def invalidate_face_matrices_of_students(sender, instance, action, reverse, pk_set, **_):
+    _ = sender
+    if action in ('post_add', 'post_remove') and pk_set:
+        _invalidate_face_matrices(pk_set if reverse else [instance.pk])
+    elif action == 'post_clear' and not reverse:
+        _invalidate_face_matrices([instance.pk])
@@ -1,3 +1,658 @@
-from django.test import TestCase
+import math
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+import numpy as np
+import requests
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+import face_recognition
+import fdfs_storage
+import utils
+from http_access import HTTPAccess
+from logic import geofence
+from logic import lesson_code
+from logic import qr_login
+from logic import roll_call
+from logic import sign_in
+from teaching_helper import gdata
+from teaching_helper.exception import HTTPAccessError
+from wx_client import models
+from wx_client import views
+from wx_client.management.commands import fdfs_stub_server
+
+
+class _Response(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class _StubSession(object):
+    """代替 requests.Session，按顺序返回预设的响应或抛出预设的异常
+    """
+
+    def __init__(self, results, delay=0.0):
+        self.results = list(results)
+        self.delay = delay
+        self.calls = []
+
+    def request(self, method, url, timeout=None, **kwargs):
+        self.calls.append((method, url, timeout, kwargs))
+        time.sleep(self.delay)
+        result = self.results.pop(0) if len(self.results) > 1 else self.results[0]
+        if isinstance(result, Exception):
+            raise result
+        return _Response(result)
+
+
+class HTTPAccessTest(SimpleTestCase):
+
+    def _access(self, results, delay=0.0, **kwargs):
+        kwargs.setdefault('retry_backoff', 0.001)
+        access = HTTPAccess('test', **kwargs)
+        access.session = _StubSession(results, delay)
+        return access
+
+    def test_retry_until_success(self):
+        access = self._access([503, requests.ConnectionError('reset'), 200], max_retries=2)
+        res = access.get('http://stub/api')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(access.session.calls), 3)
+        self.assertEqual(access.stats()['retries'], 2)
+        self.assertEqual(access.breaker.state, access.breaker.CLOSED)
+
+    def test_retries_exhausted(self):
+        access = self._access([503], max_retries=2)
+        with self.assertRaises(HTTPAccessError):
+            access.get('http://stub/api')
+        self.assertEqual(len(access.session.calls), 3)
+
+    def test_post_not_retried(self):
+        access = self._access([503, 200], max_retries=2)
+        with self.assertRaises(HTTPAccessError):
+            access.post('http://stub/api')
+        self.assertEqual(len(access.session.calls), 1)
+
+    def test_deadline(self):
+        access = self._access([requests.Timeout('slow')], delay=0.05, max_retries=10, deadline=0.2)
+        start = time.monotonic()
+        with self.assertRaises(HTTPAccessError):
+            access.get('http://stub/api')
+        self.assertLess(time.monotonic() - start, 0.2 + 0.1)
+        self.assertLess(len(access.session.calls), 11)
+        for _, _, (connect_timeout, read_timeout), _ in access.session.calls:
+            self.assertLessEqual(connect_timeout, 0.2)
+            self.assertLessEqual(read_timeout, 0.2)
+
+    def test_credentials_redacted(self):
+        url = 'http://stub/sns/jscode2session?appid=app&secret=app-secret&js_code=user-code'
+        access = self._access([requests.ConnectionError('Max retries exceeded with url: {}'.format(url[11:]))],
+                              max_retries=1)
+        with self.assertLogs('http_access', level='WARNING') as logs, self.assertRaises(HTTPAccessError) as ctx:
+            access.get(url)
+        for text in logs.output + [str(ctx.exception)]:
+            self.assertNotIn('app-secret', text)
+            self.assertNotIn('user-code', text)
+
+
+class LessonListQueryTest(TestCase):
+    """班课列表的查询次数与班课数、学生数无关
+    """
+
+    def setUp(self):
+        self.teacher = self._user('teacher')
+        self.student = self._user('student')
+        self.lesson_num = 0
+
+    @staticmethod
+    def _user(name):
+        return models.UserProfile.objects.create(username=name, nickName=name, encrypted_code=name)
+
+    def _add_lessons(self, num):
+        for _ in range(num):
+            self.lesson_num += 1
+            lesson = models.Lesson.objects.create(
+                teacher=self.teacher, lesson_code='T{:06d}'.format(self.lesson_num), qr_code='http://qr/')
+            lesson.student.add(self.student, self._user('s{}'.format(self.lesson_num)))
+
+    def _get(self, user):
+        request = APIRequestFactory().get('/api/v1/wx_client/lesson/')
+        force_authenticate(request, user=user)
+        return views.LessonView.as_view()(request)
+
+    def test_query_count(self):
+        self._add_lessons(2)
+        with self.assertNumQueries(2):
+            res = self._get(self.teacher)
+        self.assertEqual(res.data['r'], 0)
+        self.assertEqual([_l['stu_num'] for _l in res.data['data']['create']], [2, 2])
+
+        self._add_lessons(10)
+        with self.assertNumQueries(2):
+            res = self._get(self.student)
+        self.assertEqual(len(res.data['data']['listen']), 12)
+        self.assertEqual(res.data['data']['listen'][0]['teacher']['nickName'], 'teacher')
+
+
+class GeoFenceTest(SimpleTestCase):
+
+    LAT, LNG, RADIUS = 30.5145, 114.4165, 100
+
+    @classmethod
+    def _north(cls, meters):
+        return cls.LAT + math.degrees(meters / geofence.EARTH_RADIUS), cls.LNG
+
+    @classmethod
+    def _east(cls, meters):
+        return cls.LAT, cls.LNG + math.degrees(meters / (geofence.EARTH_RADIUS * math.cos(math.radians(cls.LAT))))
+
+    def test_boundary(self):
+        fence = geofence.GeoFence(self.LAT, self.LNG, self.RADIUS)
+        points = [(self.LAT, self.LNG), self._north(99.9), self._north(100.1), self._east(99.9), self._east(100.1)]
+        distances, inside = fence.check([_p[0] for _p in points], [_p[1] for _p in points])
+        self.assertEqual(inside.tolist(), [True, True, False, True, False])
+        self.assertAlmostEqual(distances[0], 0.0)
+        self.assertAlmostEqual(distances[1], 99.9, places=3)
+        self.assertAlmostEqual(distances[3], 99.9, places=3)
+
+    def test_outside_box(self):
+        fence = geofence.GeoFence(self.LAT, self.LNG, self.RADIUS)
+        distances, inside = fence.check([self.LAT + 1, self.LAT], [self.LNG, self.LNG - 1])
+        self.assertTrue(np.isnan(distances).all())
+        self.assertFalse(inside.any())
+
+    def test_box_corner(self):
+        # 在外接矩形内但在圆外
+        fence = geofence.GeoFence(self.LAT, self.LNG, self.RADIUS)
+        lat, lng = self._north(90)[0], self._east(90)[1]
+        distances, inside = fence.check([lat], [lng])
+        self.assertGreater(distances[0], self.RADIUS)
+        self.assertFalse(inside[0])
+
+    def test_empty(self):
+        distances, inside = geofence.GeoFence(self.LAT, self.LNG, self.RADIUS).check([], [])
+        self.assertEqual(distances.shape, (0,))
+        self.assertEqual(inside.shape, (0,))
+
+    def test_near_pole(self):
+        fence = geofence.GeoFence(90.0, 0.0, self.RADIUS)
+        distances, inside = fence.check([90.0 - math.degrees(50 / geofence.EARTH_RADIUS)], [123.0])
+        self.assertTrue(inside[0])
+        self.assertAlmostEqual(distances[0], 50, places=3)
+
+    def test_check_locations(self):
+        event = models.TeachingEventTracker(id=1, latitude=self.LAT, longitude=self.LNG, radius=self.RADIUS)
+        locations = {1: self._north(50), 2: None, 4: (self._north(90)[0], self._east(90)[1]), 5: self._north(150)}
+        distances, rejected = sign_in._check_locations(event, [1, 2, 3, 4, 5], locations)
+        self.assertEqual(distances, {1: 50})
+        self.assertEqual(sorted(rejected), [2, 3, 4, 5])
+        self.assertEqual(rejected[2]['status'], gdata.SIGN_IN_REJECTED)
+        self.assertEqual(rejected[3]['errmsg'], '缺少定位信息')
+        self.assertEqual(rejected[4]['distance'], 127)  # 外接矩形内、圆外
+        self.assertIsNone(rejected[5]['distance'])  # 外接矩形外，不计算距离
+
+    def test_event_without_fence(self):
+        event = models.TeachingEventTracker(id=2, latitude=None, longitude=None, radius=None)
+        self.assertEqual(sign_in._check_locations(event, [1], {}), ({}, {}))
+
+
+class RollCallTest(TestCase):
+    """多个进程各自持有点名会话时，同一次点名内不重复点到同一学生
+    """
+
+    def setUp(self):
+        teacher = models.UserProfile.objects.create(username='teacher', nickName='teacher', encrypted_code='t')
+        self.lesson = models.Lesson.objects.create(teacher=teacher, lesson_code='T000001', qr_code='http://qr/')
+        self.lesson.student.add(*[models.UserProfile.objects.create(
+            username='s{}'.format(_i), nickName='s{}'.format(_i), encrypted_code='s{}'.format(_i)) for _i in range(20)])
+        self.event = models.TeachingEventTracker.objects.create(lesson=self.lesson, event_type=gdata.EVENT_CALL,
+                                                                 start_time=timezone.now())
+        roll_call.rosters.invalidate(self.lesson.id)
+
+    def test_sessions_share_called_set(self):
+        # 模拟两个 uwsgi 进程中的会话
+        sessions = [roll_call.RollCallSession(self.event.id, self.lesson.id, self.lesson.teacher_id) for _ in range(2)]
+        called = []
+        for _i in range(20):
+            called.append(sessions[_i % 2].draw())
+            self.assertEqual(sessions[0].called_num, _i + 1)
+        self.assertEqual(sorted(called), sorted(self.lesson.student.values_list('id', flat=True)))
+        self.assertIsNone(sessions[0].draw())
+        self.assertIsNone(sessions[1].draw())
+        self.assertEqual(sessions[1].remaining, 0)
+
+
+class StubEmbedderMatchTest(SimpleTestCase):
+    """StubEmbedder 特征下 LocalEmbeddingBackend 的比对得分及阈值
+    """
+
+    LESSON_ID = 1
+    DIM = 128
+
+    def setUp(self):
+        self.embedder = face_recognition.StubEmbedder(self.DIM)
+        self.backend = face_recognition.LocalEmbeddingBackend(self.embedder, dim=self.DIM)
+        self.images = {_id: 'face-{}'.format(_id).encode() for _id in range(1, 11)}
+        vectors = [self.backend.embed(_i) for _i in self.images.values()]
+        self.backend.matrices.set(self.LESSON_ID, face_recognition.LessonFaceMatrix(
+            np.asarray(list(self.images), dtype=np.int64), np.vstack(vectors)))
+
+    def test_embedding(self):
+        vector = self.embedder(b'face')
+        self.assertEqual(vector.shape, (self.DIM,))
+        self.assertEqual(vector.dtype, np.float32)
+        self.assertAlmostEqual(float(np.linalg.norm(vector)), 1.0, places=5)
+        np.testing.assert_array_equal(vector, self.embedder(b'face'))
+        self.assertFalse(np.allclose(vector, self.embedder(b'other face')))
+
+    def test_same_image_matches(self):
+        for user_id, image in self.images.items():
+            (best_id, score), = self.backend.match(image, self.LESSON_ID)
+            self.assertEqual(best_id, user_id)
+            self.assertAlmostEqual(score, 1.0, places=5)
+
+    def test_other_image_below_threshold(self):
+        ranked = self.backend.match(b'stranger', self.LESSON_ID, top_k=len(self.images))
+        self.assertEqual(len(ranked), len(self.images))
+        self.assertEqual([_s for _, _s in ranked], sorted((_s for _, _s in ranked), reverse=True))
+        self.assertLess(ranked[0][1], gdata.FACE_MATCH_THRESHOLD)
+
+    def test_match_batch_threshold(self):
+        probes = [self.images[3], self.images[7], b'stranger']
+        scores, matched = self.backend.match_batch(probes, self.LESSON_ID)
+        self.assertEqual(sorted(matched), [3, 7])
+        self.assertEqual(len(scores), len(self.images))
+
+        # 阈值降到陌生人得分以下，陌生人被认定为最相近的学生
+        (stranger_id, stranger_score), = self.backend.match(b'stranger', self.LESSON_ID)
+        _, matched = self.backend.match_batch(probes, self.LESSON_ID, threshold=stranger_score - 1e-6)
+        self.assertIn(stranger_id, matched)
+        self.assertTrue({3, 7} <= set(matched))
+
+        _, matched = self.backend.match_batch(probes, self.LESSON_ID, threshold=1.01)
+        self.assertEqual(matched, {})
+
+    @override_settings(FACE_EMBEDDER=None)
+    def test_embedder_required(self):
+        with self.assertRaises(ImproperlyConfigured):
+            face_recognition.LocalEmbeddingBackend(dim=self.DIM)
+
+    @override_settings(FACE_EMBEDDER='face_recognition.StubEmbedder')
+    def test_embedder_from_settings(self):
+        backend = face_recognition.LocalEmbeddingBackend(dim=self.DIM)
+        self.assertIsInstance(backend.embedder, face_recognition.StubEmbedder)
+        np.testing.assert_allclose(backend.embed(b'face'), self.embedder(b'face'), atol=1e-6)
+
+    def test_empty_lesson(self):
+        self.backend.matrices.set(2, face_recognition.LessonFaceMatrix(
+            np.empty((0,), dtype=np.int64), np.empty((0, self.DIM), dtype=np.float32)))
+        self.assertEqual(self.backend.match(b'face', 2), [])
+        self.assertEqual(self.backend.match_batch([b'face'], 2), ({}, {}))
+
+
+class _FakeAipClient(object):
+    """代替 AipFace，人脸库搜索返回预设的候选人，记录每次请求
+    """
+
+    def __init__(self, user_list=None, error_code=0, face_lists=None):
+        self.user_list = user_list or []
+        self.error_code = error_code
+        self.face_lists = face_lists or {}
+        self.calls = []
+
+    def search(self, image, image_type, group_id_list, options=None):
+        self.calls.append(('search', group_id_list, options))
+        return {'error_code': self.error_code, 'result': {'user_list': self.user_list}}
+
+    def multiSearch(self, image, image_type, group_id_list, options=None):
+        """合照中每张人脸的候选人由 face_lists[图片base64] 给出
+        """
+        self.calls.append(('multiSearch', group_id_list, options))
+        face_list = [{'face_token': 'f', 'user_list': _u} for _u in self.face_lists.get(image, [])]
+        if not face_list:
+            return {'error_code': gdata.AIP_ERROR_USER_NOT_FOUND, 'error_msg': 'match user is not found'}
+        return {'error_code': self.error_code, 'result': {'face_num': len(face_list), 'face_list': face_list}}
+
+    def addUser(self, image, image_type, group_id, user_id, options=None):
+        self.calls.append(('addUser', group_id, user_id, image_type, options))
+        return {'error_code': self.error_code, 'error_msg': 'fake'}
+
+
+class AIPFaceBackendTest(TestCase):
+
+    def setUp(self):
+        teacher = models.UserProfile.objects.create(username='teacher', nickName='teacher', encrypted_code='t')
+        self.lesson = models.Lesson.objects.create(teacher=teacher, lesson_code='T000001', qr_code='http://qr/')
+        self.students = []
+        for _i in range(50):
+            student = models.UserProfile.objects.create(
+                username='s{}'.format(_i), nickName='s{}'.format(_i), encrypted_code='s{}'.format(_i))
+            self.lesson.student.add(student)
+            models.FeatureForSignIn.objects.create(user=student, face_token='token-{}'.format(_i), blue_tooth_mac='')
+            self.students.append(student)
+        self.outsider = models.UserProfile.objects.create(username='o', nickName='o', encrypted_code='o')
+        models.FeatureForSignIn.objects.create(user=self.outsider, face_token='token-o', blue_tooth_mac='')
+
+    def _service(self, client, **kwargs):
+        service = face_recognition.AIPFaceService(client, **kwargs)
+        return mock.patch.object(face_recognition, 'aip_service', service), service
+
+    def test_match_one_search(self):
+        client = _FakeAipClient([
+            {'group_id': gdata.AIP_FACE_GROUP, 'user_id': str(self.outsider.id), 'score': 95.0},
+            {'group_id': gdata.AIP_FACE_GROUP, 'user_id': str(self.students[3].id), 'score': 90.0},
+            {'group_id': gdata.AIP_FACE_GROUP, 'user_id': str(self.students[7].id), 'score': 40.0},
+        ])
+        patcher, service = self._service(client)
+        with patcher:
+            ranked = face_recognition.AIPFaceBackend().match(b'face', self.lesson.id, top_k=3)
+        # 非班课学生被过滤，请求数与班课人数无关
+        self.assertEqual(ranked, [(self.students[3].id, 0.9), (self.students[7].id, 0.4)])
+        self.assertEqual(service.stats()['requests'], 1)
+        self.assertEqual(client.calls, [('search', gdata.AIP_FACE_GROUP,
+                                         {'max_user_num': gdata.AIP_SEARCH_MAX_USER_NUM})])
+
+    def test_match_quota_exhausted(self):
+        patcher, service = self._service(_FakeAipClient(), qps=0.01, burst=1)
+        service.bucket.acquire()
+        with patcher, mock.patch.object(gdata, 'AIP_QUOTA_WAIT', 0.01):
+            self.assertEqual(face_recognition.AIPFaceBackend().match(b'face', self.lesson.id), [])
+        self.assertEqual(service.stats()['requests'], 0)
+
+    def test_enroll(self):
+        client = _FakeAipClient()
+        patcher, _ = self._service(client)
+        with patcher:
+            self.assertEqual(face_recognition.AIPFaceBackend().enroll(b'face', self.outsider.id), {})
+        self.assertEqual(client.calls, [('addUser', gdata.AIP_FACE_GROUP, str(self.outsider.id),
+                                         gdata.AIP_CLIENT_ARGS['image_type'], {'action_type': 'REPLACE'})])
+
+        patcher, _ = self._service(_FakeAipClient(error_code=222202))
+        with patcher:
+            self.assertIsNone(face_recognition.AIPFaceBackend().enroll(b'face', self.outsider.id))
+
+
+class FaceSignInViewTest(TestCase):
+
+    def setUp(self):
+        self.teacher = models.UserProfile.objects.create(username='teacher', nickName='teacher', encrypted_code='t')
+        lesson = models.Lesson.objects.create(teacher=self.teacher, lesson_code='T000001', qr_code='http://qr/')
+        self.student = models.UserProfile.objects.create(username='s', nickName='s', encrypted_code='s')
+        lesson.student.add(self.student)
+        self.event = models.TeachingEventTracker.objects.create(lesson=lesson, event_type=gdata.EVENT_SIGN,
+                                                                start_time=timezone.now())
+        models.FeatureForSignIn.objects.create(user=self.student, face_token='token-s', blue_tooth_mac='')
+        self.backend = face_recognition.LocalEmbeddingBackend(face_recognition.StubEmbedder(64), dim=64)
+        self.backend.matrices.set(lesson.id, face_recognition.LessonFaceMatrix(
+            np.asarray([self.student.id], dtype=np.int64), self.backend.embed(b'student-face')[None, :]))
+
+    def _post(self, backend, images):
+        request = APIRequestFactory().post('/api/v1/wx_client/lesson/sign-in/faces', {
+            'event_id': self.event.id,
+            'faces': [SimpleUploadedFile('{}.jpg'.format(_i), _image) for _i, _image in enumerate(images)],
+        }, format='multipart')
+        force_authenticate(request, user=self.teacher)
+        with mock.patch.object(face_recognition, 'get_face_backend', return_value=backend):
+            return views.FaceSignInView.as_view()(request).data
+
+    def test_sign_in(self):
+        res = self._post(self.backend, [b'student-face', b'stranger'])
+        self.assertEqual(res['r'], 0)
+        self.assertEqual(res['data']['signed_num'], 1)
+        self.assertEqual(res['data']['students'][0]['id'], self.student.id)
+        self.assertEqual(res['data']['students'][0]['status'], gdata.SIGN_IN_SUCCESS)
+
+    def test_aip_group_photo(self):
+        other = models.UserProfile.objects.create(username='o', nickName='o', encrypted_code='o')
+        models.FeatureForSignIn.objects.create(user=other, face_token='token-o', blue_tooth_mac='')
+        client = _FakeAipClient(face_lists={
+            face_recognition.AIPFaceService._encode(b'group-photo'): [
+                [{'user_id': str(other.id), 'score': 99.0}, {'user_id': str(self.student.id), 'score': 60.0}],
+                [{'user_id': str(self.student.id), 'score': 92.0}],
+            ],
+        })
+        service = face_recognition.AIPFaceService(client)
+        with mock.patch.object(face_recognition, 'aip_service', service):
+            res = self._post(face_recognition.AIPFaceBackend(), [b'group-photo', b'nobody'])
+        # 非班课学生被过滤，合照中第二张人脸认定为班课学生
+        self.assertEqual(res['r'], 0)
+        self.assertEqual(res['data']['signed_num'], 1)
+        self.assertEqual([(_s['id'], _s['score']) for _s in res['data']['students']], [(self.student.id, 0.92)])
+        self.assertEqual(service.stats()['requests'], 2)
+        self.assertEqual(client.calls[0][2]['max_face_num'], gdata.AIP_GROUP_PHOTO_MAX_FACES)
+
+    def test_limits(self):
+        self.assertEqual(self._post(self.backend, [b'f'] * (gdata.FACE_BATCH_MAX_PROBES + 1))['r'], 1)
+        self.assertEqual(self._post(self.backend, [b'f' * (gdata.FACE_BATCH_IMAGE_MAX_SIZE + 1)])['r'], 1)
+        aip_backend = face_recognition.AIPFaceBackend()
+        self.assertEqual(self._post(aip_backend, [b'f'] * (gdata.AIP_BATCH_MAX_IMAGES + 1))['r'], 1)
+        self.assertEqual(self._post(aip_backend, [b'f' * (gdata.AIP_BATCH_IMAGE_MAX_SIZE + 1)])['r'], 1)
+
+    def test_aip_quota_exhausted(self):
+        service = face_recognition.AIPFaceService(_FakeAipClient(), qps=0.01, burst=1)
+        service.bucket.acquire()
+        with mock.patch.object(face_recognition, 'aip_service', service), \
+                mock.patch.object(gdata, 'AIP_QUOTA_WAIT', 0.01):
+            res = self._post(face_recognition.AIPFaceBackend(), [b'group-photo', b'other-photo'])
+        self.assertEqual(res['r'], 1)
+        self.assertTrue(res['errmsg'])
+        self.assertEqual(service.stats()['requests'], 0)
+        self.assertFalse(models.SignInTable.objects.exists())
+
+
+class _FakeFdfsClient(object):
+
+    def __init__(self, errors):
+        self.errors = errors
+
+    def upload_by_buffer(self, data, file_ext_name=None):
+        if self.errors:
+            raise self.errors.pop(0)
+        return {'Status': 'Upload successed.', 'Remote file_id': b'group1/M00/00/00/a.' + file_ext_name.encode()}
+
+
+class FdfsClientPoolTest(SimpleTestCase):
+
+    def _pool(self, errors):
+        self.created = 0
+
+        def _factory():
+            self.created += 1
+            return _FakeFdfsClient(errors)
+        return fdfs_storage.FdfsClientPool(_factory, size=2)
+
+    def test_retry_connection_error(self):
+        pool = self._pool([fdfs_storage.FDFSConnectionError('refused')])
+        ret = pool.call('upload_by_buffer', b'data', file_ext_name='jpg', retries=1)
+        self.assertEqual(ret['Remote file_id'], b'group1/M00/00/00/a.jpg')
+        self.assertEqual(self.created, 2)
+        self.assertEqual(pool.stats()['discarded'], 1)
+
+    def test_bad_response_not_retried(self):
+        # 存储服务器可能已保存了文件，不重试
+        for error in (fdfs_storage.FDFSResponseError('bad response'), OSError('timed out')):
+            pool = self._pool([error])
+            with self.assertRaises(type(error)):
+                pool.call('upload_by_buffer', b'data', file_ext_name='jpg', retries=1)
+            self.assertEqual(self.created, 1)
+            self.assertEqual(pool.stats()['open'], 0)
+
+
+class FastDFSRegisterTest(TestCase):
+
+    def setUp(self):
+        self.storage = fdfs_storage.FastDFSStorage(base_url='', client_conf='client.conf')
+        self.storage._pool = mock.Mock()
+
+    def test_register(self):
+        file_name = b'group1/M00/00/00/a.jpg'
+        self.assertEqual(self.storage._register('d' * 64, 'jpg', 3, file_name), file_name)
+        self.assertEqual(models.StoredFile.objects.get(digest='d' * 64).remote_file_id, file_name.decode())
+
+    def test_reuse_concurrent_upload(self):
+        models.StoredFile.objects.create(digest='d' * 64, ext_name='jpg', remote_file_id='group1/M00/00/00/a.jpg')
+        ret = self.storage._register('d' * 64, 'jpg', 3, b'group1/M00/00/00/b.jpg')
+        self.assertEqual(ret, b'group1/M00/00/00/a.jpg')
+        self.assertEqual(models.StoredFile.objects.get(digest='d' * 64).ref_count, 2)
+        self.storage._pool.call.assert_called_once_with('delete_file', b'group1/M00/00/00/b.jpg')
+
+    def test_attempts_bounded(self):
+        # 登记一直冲突且没有可复用的文件时不再无限重试
+        with mock.patch.object(models.StoredFile.objects, 'create', side_effect=IntegrityError('conflict')) as create:
+            with self.assertRaises(IntegrityError):
+                self.storage._register('d' * 64, 'jpg', 3, b'group1/M00/00/00/b.jpg')
+        self.assertEqual(create.call_count, gdata.FDFS_REGISTER_ATTEMPTS)
+        self.storage._pool.call.assert_called_once_with('delete_file', b'group1/M00/00/00/b.jpg')
+
+
+class FastDFSStubServerTest(TestCase):
+    """FastDFSStorage 经真实的 fdfs_client 协议与本地桩服务(fdfs_stub_server)交互
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        cls.files = {}
+        handler = fdfs_stub_server._build_handler('group1', '127.0.0.1', port, 0.0, 0.0, cls.files, threading.Lock())
+        cls.server = socketserver.ThreadingTCPServer(('127.0.0.1', port), handler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.conf = tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False)
+        cls.conf.write('connect_timeout=5\nnetwork_timeout=30\ntracker_server=127.0.0.1:{}\n'.format(port))
+        cls.conf.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        os.unlink(cls.conf.name)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.storage = fdfs_storage.FastDFSStorage(base_url='', client_conf=self.conf.name)
+
+    def _stored(self, name):
+        return bytes(self.files[name.decode().split('/', 1)[1]])
+
+    def test_save_and_delete(self):
+        name = self.storage.save('face.jpg', ContentFile(b'face-image'))
+        self.assertTrue(name.startswith(b'group1/M00/') and name.endswith(b'.jpg'))
+        self.assertEqual(self._stored(name), b'face-image')
+        self.assertEqual(self.storage.save('copy.jpg', ContentFile(b'face-image')), name)
+
+        self.storage.delete(name)
+        self.assertEqual(len(self.files), 1)
+        self.storage.delete(name)
+        self.assertEqual(self.files, {})
+        self.assertEqual(self.storage.stats()['created'], 1)
+
+    def test_save_chunked(self):
+        data = bytes(range(256)) * 4
+        with mock.patch.object(gdata, 'FDFS_CHUNK_SIZE', 100):
+            name = self.storage.save('resource.bin', ContentFile(data))
+        self.assertEqual(self._stored(name), data)
+        self.storage.delete(name)
+        self.assertNotIn(name.decode().split('/', 1)[1], self.files)
+
+
+class QRCodeViewTest(TestCase):
+
+    def _get(self, code, fmt='png'):
+        request = APIRequestFactory().get('/api/v1/wx_client/qrcode/{}.{}'.format(code, fmt))
+        return views.QRCodeView.as_view()(request, code=code, fmt=fmt)
+
+    def test_render_existing_codes(self):
+        teacher = models.UserProfile.objects.create(username='teacher', nickName='teacher', encrypted_code='t')
+        models.Lesson.objects.create(teacher=teacher, lesson_code='T000001', qr_code='http://qr/')
+        qr_login.get_qr_login_store().create('a' * 32, 'http://qr/')
+        for code, fmt in (('T000001', 'png'), ('a' * 32, 'svg')):
+            res = self._get(code, fmt)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res['Content-Type'], utils.QRCodeHelper.CONTENT_TYPES[fmt])
+
+    def test_unknown_code(self):
+        self.assertEqual(self._get('T999999').status_code, 404)
+        self.assertEqual(self._get('b' * 32, 'svg').status_code, 404)
+
+
+class LessonCodeAPIViewTest(TestCase):
+
+    def setUp(self):
+        self.admin = models.UserProfile.objects.create(username='admin', nickName='admin', encrypted_code='a',
+                                                       is_staff=True)
+        self.teacher = models.UserProfile.objects.create(username='teacher', nickName='teacher', encrypted_code='t')
+
+    def _call(self, method, user=None, data=None, path='/api/v1/wx_client/generate_code/'):
+        request = getattr(APIRequestFactory(), method)(path, data, format='json' if method == 'post' else None)
+        if user is not None:
+            force_authenticate(request, user=user)
+        return views.LessonCodeAPIView.as_view()(request)
+
+    def test_staff_only(self):
+        with mock.patch.object(lesson_code.LessonCodeJob, 'start') as start:
+            self.assertGreaterEqual(self._call('get').status_code, 400)
+            self.assertEqual(self._call('post', self.teacher, {'num': 10}).status_code, 403)
+        start.assert_not_called()
+
+    def test_generate(self):
+        with mock.patch.object(lesson_code.LessonCodeJob, 'start', return_value=True) as start:
+            self.assertEqual(self._call('get', self.admin).data['r'], 0)
+            start.assert_called_once_with(gdata.LESSON_CODE_NUM)
+
+            self.assertEqual(self._call('get', self.admin, path='/api/v1/wx_client/generate_code/?progress=1')
+                             .data['r'], 0)
+            self.assertEqual(start.call_count, 1)
+
+            self.assertEqual(self._call('post', self.admin, {'num': gdata.LESSON_CODE_NUM + 1}).data['r'], 1)
+            self.assertEqual(self._call('post', self.admin, {'num': 10}).data['r'], 0)
+            start.assert_called_with(10)
+
+
+class LessonStudentCountTest(TestCase):
+    """学生加入/退出班课时的学生计数
+    """
+
+    def setUp(self):
+        teacher = self._user('teacher')
+        self.lesson = models.Lesson.objects.create(teacher=teacher, lesson_code='T000001', qr_code='http://qr/')
+        self.students = [self._user('s{}'.format(_i)) for _i in range(3)]
+        self.lesson.student.add(*self.students[:2])
+
+    @staticmethod
+    def _user(name):
+        return models.UserProfile.objects.create(username=name, nickName=name, encrypted_code=name)
+
+    def _student_num(self):
+        return models.LessonCounter.objects.get(lesson=self.lesson).student_num
+
+    def test_add(self):
+        self.assertEqual(self._student_num(), 2)
+        self.lesson.student.add(*self.students)
+        self.assertEqual(self._student_num(), 3)
+
+    def test_remove_non_member(self):
+        self.lesson.student.remove(self.students[2])
+        self.assertEqual(self._student_num(), 2)
+        self.lesson.student.remove(self.students[0], self.students[2])
+        self.assertEqual(self._student_num(), 1)
+
+    def test_remove_reverse(self):
+        other = models.Lesson.objects.create(teacher=self.lesson.teacher, lesson_code='T000002', qr_code='http://qr/')
+        self.students[0].listening_lessons.remove(self.lesson, other)
+        self.assertEqual(self._student_num(), 1)
+        self.assertEqual(models.LessonCounter.objects.get(lesson=other).student_num, 0)
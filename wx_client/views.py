@@ -1,20 +1,29 @@
+from concurrent.futures import TimeoutError as FutureTimeoutError
 import copy
-import random
-import string
+import datetime
 import uuid
-from urllib.parse import urljoin
 import copy
 
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.permissions import IsAdminUser
 from rest_framework.views import APIView
 
-import encryption
+import face_recognition
 import model_access as mc
 import utils
 from fdfs_storage import fc
+from logic import lesson_code
+from logic import qr_login
+from logic import roll_call
+from logic import sign_in
 from teaching_helper import gdata
 from teaching_helper import glog
+from teaching_helper.exception import RateLimitError
 from utils import DictResponse
 from wx_api import WxAPIAccess
 from wx_client import models
@@ -44,16 +53,11 @@ class BrowserQRLogin(HandleAPIView):
     def put(self, request, **_):
         _ = self
 
-        with gdata.LOGIN_QR_CODE_CACHE_LOCK:
-            qr_uid = request.data.get('qr_uid')
-            _logger.debug('=============cache: {}'.format(gdata.LOGIN_QR_CODE_CACHE))
-            login_item = gdata.LOGIN_QR_CODE_CACHE.get(qr_uid, None)
-            if login_item is None:
-                return DictResponse(data='二维码已过期, 请刷新页面')
+        qr_uid = request.data.get('qr_uid')
+        if not qr_login.get_qr_login_store().scan(qr_uid, request.user.id):
+            return DictResponse(data='二维码已过期, 请刷新页面')
 
-            login_item.user_id = request.user.id
-            login_item.is_success = True
-            return DictResponse(r=0, data='登陆成功，请等待页面自动跳转...')
+        return DictResponse(r=0, data='登陆成功，请等待页面自动跳转...')
 
 
 class UserRegister(HandleAPIView):
@@ -98,9 +102,8 @@ class UserRegister(HandleAPIView):
         if not openid:
             return DictResponse(errmsg='登录态创建失败')
 
-        encrypted_code = encryption.sha256(openid)
+        user, encrypted_code = mc.QueryUserProfileHelper.query_user_by_openid(openid)
         u_uuid = uuid.uuid4()
-        user = mc.QueryUserProfileHelper.query_user_by_encrypted_code(encrypted_code)
 
         # 用户首次登陆
         if not user:
@@ -166,9 +169,30 @@ class FaceProxy(HandleAPIView):
             return DictResponse(errmsg='未上传人像数据')
         return DictResponse(r=0, data=face_record.face_token)
 
+    @staticmethod
+    def _face_image(request):
+        """上传的人像图片
+
+        优先读取 multipart 文件 `face`，兼容旧客户端的 base64 字段 `base64_face`
+
+        :return: (图片字节, 扩展名)，无效时图片为None
+        """
+        face_file = request.FILES.get('face')
+        if face_file is None:
+            image = face_recognition.decode_b64_image(request.data.get('base64_face'))
+            if not image or len(image) > gdata.FACE_IMAGE_MAX_SIZE:
+                return None, ''
+            return image, face_recognition.guess_image_suffix(image)
+
+        suffix = face_file.name.rsplit('.', 1)[-1].lower()
+        if suffix not in gdata.IMAGES_FILES_SUFFIX or face_file.size > gdata.FACE_IMAGE_MAX_SIZE:
+            return None, ''
+        return face_file.read(), suffix
+
     def post(self, request, **_):
         """新建或更新人像数据
 
+        :param: face 人像图片(multipart)，或 base64_face (base64编码的图片)
         :return:
         1. 录入人脸数据失败
             {'r': 1,
@@ -186,13 +210,35 @@ class FaceProxy(HandleAPIView):
             _logger.warning('face-data for [UserProfile:{}]: serializer-data is invalid.'.format(user.nickName))
             return DictResponse(errmsg='人像数据录入失败')
 
-        face_record = mc.QueryFeatureForSignInHelper.query_face_record_by_user(user)
-        face_data_dict = serializer.validated_data
-        if face_record:
-            serializer.update(face_record, face_data_dict)
-        else:
-            new_face_record = models.FeatureForSignIn(user=user, **face_data_dict)
-            new_face_record.save()
+        image, suffix = self._face_image(request)
+        if not image:
+            return DictResponse(errmsg='人像数据录入失败')
+
+        enrolled = face_recognition.get_face_backend().enroll(image, user.id)
+        if enrolled is None:
+            return DictResponse(errmsg='人像数据录入失败')
+        face_data_dict = dict(serializer.validated_data)
+        face_data_dict.update(enrolled)
+        face_data_dict['face_image'] = fc.save('face.{}'.format(suffix), ContentFile(image)).decode()
+        face_data_dict['base64_face'] = ''
+
+        old_image = None
+        try:
+            face_record = mc.QueryFeatureForSignInHelper.query_face_record_by_user(user)
+            if face_record:
+                old_image = face_record.face_image
+                serializer.update(face_record, face_data_dict)
+            else:
+                new_face_record = models.FeatureForSignIn(user=user, **face_data_dict)
+                new_face_record.save()
+        except Exception as e:
+            # 未写入数据库，删除本次上传的图片
+            _logger.warning('failed to save the face-data of [UserProfile:{}]: {}'.format(user.nickName, e))
+            fc.delete(face_data_dict['face_image'])
+            return DictResponse(errmsg='人像数据录入失败')
+
+        if old_image:
+            fc.delete(old_image)
         _logger.info('flush the face-data of [UserProfile:{}] to db successfully..'.format(user.nickName))
         ret_info = {'face_token': face_data_dict.get('face_token', '')}
         return DictResponse(r=0, errmsg='人脸录入成功', data=ret_info)
@@ -228,7 +274,7 @@ class LessonView(HandleAPIView):
     """
 
     serializer = serializers.LessonSerializer
-    info_serializer = serializers.LessonInfoSerializer
+    list_serializer = serializers.LessonListSerializer
 
     def get(self, request, **_):
         """获取我创建/我听的的班课集合
@@ -237,11 +283,10 @@ class LessonView(HandleAPIView):
         """
         try:
             user = request.user
-            teaching_lessons = self.info_serializer(user.teaching_lessons.order_by('-create_time').all(),
-                                                    many=True).data
-            listening_lessons = self.info_serializer(user.listening_lessons.order_by('-create_time').all(),
-
-                                                     many=True).data
+            teaching_lessons = self.list_serializer(
+                self.list_serializer.prepare(user.teaching_lessons.order_by('-create_time')), many=True).data
+            listening_lessons = self.list_serializer(
+                self.list_serializer.prepare(user.listening_lessons.order_by('-create_time')), many=True).data
         except Exception as e:
             _logger.warn('failed to get information of lessons, error:{}'.format(e), exc_info=True)
             return DictResponse(errmsg='查询班课失败')
@@ -254,29 +299,38 @@ class LessonView(HandleAPIView):
 
     def post(self, request, **_):
         """创建班课
+
+        班课码由 settings.LESSON_CODE_ENGINE 决定：
+        * table: 从 LessonCode 表中分配
+        * cipher: 班课入库后由班课id计算
         """
+        code = None
+        use_cipher = lesson_code.cipher_enabled()
         try:
             user = request.user
-            lesson_code = models.LessonCode.objects.filter(is_occupied=False).first()
-            qr_helper = utils.QRCodeHelper.qr_code_helper()
-            qr_helper.generate_qr_code(lesson_code.code)
-            assert qr_helper.is_successful
-            qr_url = urljoin(gdata.HTTP_DOMAIN + '/images/qrcode/', '{}.png'.format(lesson_code.code))
+            code = lesson_code.placeholder_code() if use_cipher else lesson_code.allocator.allocate()
+            assert code, '班课码已用尽'
+            qr_url = utils.QRCodeHelper.qr_code_url(code)
             raw_data = copy.deepcopy(request.data)
 
             raw_data['teacher_id'] = user.id
             raw_data['qr_code'] = qr_url
-            raw_data['lesson_code'] = lesson_code.code
+            raw_data['lesson_code'] = code
 
             serializer = self.serializer(data=raw_data)
             assert serializer.is_valid()
-            serializer.save()
+            with transaction.atomic():
+                lesson = serializer.save()
+                if use_cipher:
+                    lesson.lesson_code = lesson_code.get_cipher().encode(lesson.id)
+                    lesson.qr_code = utils.QRCodeHelper.qr_code_url(lesson.lesson_code)
+                    lesson.save(update_fields=['lesson_code', 'qr_code'])
         except (ValueError, AssertionError, Exception) as _:
             _logger.warning('LessonView, failed to create lesson, error:{}'.format(_), exc_info=True)
+            if code and not use_cipher:
+                lesson_code.allocator.release(code)
             return DictResponse(errmsg=_)
         else:
-            lesson_code.is_occupied = True
-            lesson_code.save()
             return DictResponse(r=0, data=serializer.data)
 
     def put(self, request, **_):
@@ -284,10 +338,12 @@ class LessonView(HandleAPIView):
         """
         _ = self
         try:
-            lesson = models.Lesson.objects.filter(lesson_code=request.data['lesson_code']).first()
-            assert lesson.teacher != request.user, '角色类型错误..'
-            lesson.student.add(request.user)
-        except KeyError or Exception as e:
+            ref = mc.QueryLesson.resolve_lesson_code(request.data['lesson_code'])
+            assert ref, '班课不存在'
+            lesson_id, teacher_id = ref
+            assert teacher_id != request.user.id, '角色类型错误..'
+            models.Lesson(pk=lesson_id, teacher_id=teacher_id).student.add(request.user)
+        except (KeyError, AssertionError) as e:
             _logger.warning('LessonView put error: {}'.format(e))
             return DictResponse(errmsg=e, status=status.HTTP_406_NOT_ACCEPTABLE)
         else:
@@ -296,28 +352,47 @@ class LessonView(HandleAPIView):
 
 class LessonCodeAPIView(HandleAPIView):
     """班课码视图
+
+    :remark:
+        * 仅管理员(is_staff)可用；大批量生成请使用管理命令 generate_lesson_codes
+        * 班课码在后台任务中生成，请求立即返回任务进度
     """
 
-    authentication_classes = []
+    permission_classes = [IsAdminUser]
 
     def get(self, request, **_):
-        """生成班课码
+        """生成 gdata.LESSON_CODE_NUM 个班课码(已有任务在运行时不再启动)，带参数 progress=1 时只查询进度
+
+        :return:
+            {
+                'status': running/done/failed,
+                'created': 已生成数量,
+                'total': 目标数量,
+                'started_at': 开始时间戳,
+                'cost': 耗时(秒),
+            }
+            无任务时 data 为 None
         """
         _ = self
-        _ = request
-        _list = list(string.ascii_uppercase + string.digits)
+        if not request.query_params.get('progress'):
+            lesson_code.LessonCodeJob.start(gdata.LESSON_CODE_NUM)
+        return DictResponse(r=0, data=lesson_code.LessonCodeJob.progress())
 
-        for _ in range(gdata.LESSON_CODE_NUM):
+    def post(self, request, **_):
+        """后台生成指定数量的班课码
 
-            while 1:
-                cur_code = ''.join(random.sample(_list, gdata.LESSON_CODE_LEN))
-                code_obj = models.LessonCode.objects.filter(code=cur_code).first()
-                if not code_obj:
-                    new_code_obj = models.LessonCode(code=cur_code)
-                    new_code_obj.save()
-                    break
+        :param: num 班课码数量，不超过 gdata.LESSON_CODE_NUM
+        """
+        _ = self
+        try:
+            total = int(request.data.get('num', gdata.LESSON_CODE_NUM))
+            assert 0 < total <= gdata.LESSON_CODE_NUM, '无效的班课码数量'
+        except (ValueError, TypeError, AssertionError) as e:
+            return DictResponse(errmsg='无效的班课码数量: {}'.format(e))
 
-        return DictResponse(r=0, data='生成班课码数据成功...')
+        if not lesson_code.LessonCodeJob.start(total):
+            return DictResponse(errmsg='已有班课码生成任务正在运行', data=lesson_code.LessonCodeJob.progress())
+        return DictResponse(r=0, data=lesson_code.LessonCodeJob.progress())
 
 
 class LessonIndexPageOverview(HandleAPIView):
@@ -335,128 +410,282 @@ class LessonIndexPageOverview(HandleAPIView):
             'resource_num': 课堂资源数
             'questions_num': 答疑区问题数(已解决数/总数)
             'notice_num': 通知数量
-            'teach_schedulers': {
-                'all': [
-                    {},
-                    {},
-                    {}
-                ],
-                'ing': [
-                    {},
-                    {},
-                    {},
-                ]
-                'to': [
-                    {},
-                    {},
-                    {},
+            'teach_schedulers': {  # 每类最多 gdata.LESSON_SCHEDULE_PAGE_SIZE 条
+                'track_all_list': [
+                    {
+                        'start_time': '2013-01-23 23:00:23',
+                        'end_time': '2013-01-23 23:20:23',  # 未设置结束时间时为''
+                        'detail': '签到',
+                        'status': 0,  # 0 - 已结束，1 - 进行中，2 - 待开始
+                        'join_num': 参与人数,
+                        'code': 事件id,
+                    },
+                    ...
                 ],
-                'up': [
-                    {},
-                    {}
-                ]
+                'track_active_list': [...],    # 进行中
+                'track_deactive_list': [...],  # 已结束，remark: 学生身份不提供该类目
+                'track_toactive_list': [...],  # 待开始
             }
         }
         """
         _ = self
         _type = request.query_params.get('type', 0)  # 0-教师身份， 1-学生身份
         lesson_code = request.query_params.get('lesson_code', '')
-        lesson = models.Lesson.objects.filter(lesson_code=lesson_code).first()
+        lesson = mc.QueryLesson.query_lesson_by_lesson_code(lesson_code)
         lesson_info = serializers.LessonInfoSerializer(lesson, many=False).data
-
-        # todo 班课首页
+        counter = getattr(lesson, 'counter', None) or models.LessonCounter()
+
+        is_teacher = str(_type) == '0'
+        schedule = mc.QueryTeachingEvent.query_schedule(lesson, with_inactive=is_teacher)
+        teach_schedulers = {
+            'track_all_list': schedule['all'],
+            'track_active_list': schedule['active'],
+            'track_toactive_list': schedule['upcoming'],
+        }
+        if is_teacher:  # remark: 学生身份不提供该类目
+            teach_schedulers['track_deactive_list'] = schedule['inactive']
 
         lesson_index_info = {
             'lesson_data': lesson_info,
-            'resource_num': 0,
+            'resource_num': counter.resource_num,
             'stu_num': lesson.stu_num,
-            'questions_num': '0/0',
-            'notice_num': 0,
-            'teach_schedulers': {
-                'track_all_list': [
-                    {
-                        'start_time': '2013-01-23 23:00:23',
-                        'end_time': '23:20:23',
-                        'detail': '测试一下',
-                        'status': 0,  # 0 - 已结束，1 - 进行中，2 - 待开始
-                        'code': '899b20c069d846e3b3980989dc3925b5',
-                    },
-                    {
-                        'start_time': '2013-01-23 23:00:23',
-                        'end_time': '',
-                        'detail': '测试一下',
-                        'status': 1,  # 0 - 已结束，1 - 进行中，2 - 待开始
-                        'code': '899b20c069d846e3b3980989dc3925b5',
-                    },
-                    {
-                        'start_time': '2013-01-23 23:00:23',
-                        'end_time': '23:20:23',
-                        'detail': '测试一下',
-                        'status': 0,  # 0 - 已结束，1 - 进行中，2 - 待开始
-                        'code': '899b20c069d846e3b3980989dc3925b5',
-                    },
-                    {
-                        'start_time': '2013-01-23 23:00:23',
-                        'end_time': '23:20:23',
-                        'detail': '测试一下',
-                        'status': 2,  # 0 - 已结束，1 - 进行中，2 - 待开始
-                        'code': '899b20c069d846e3b3980989dc3925b5',
-                    },
-                    {
-                        'start_time': '2013-01-23 23:00:23',
-                        'end_time': '23:00:23',
-                        'detail': '测试一下',
-                        'status': 2,  # 0 - 已结束，1 - 进行中，2 - 待开始
-                        'code': '899b20c069d846e3b3980989dc3925b5',
-                    },
-                ],
-                'track_active_list': [
-                    {
-                        'start_time': '2013-01-23 23:00:23',
-                        'end_time': '',
-                        'detail': '测试一下',
-                        'status': 1,  # 0 - 已结束，1 - 进行中，2 - 待开始
-                        'code': '899b20c069d846e3b3980989dc3925b5',
-                    },
-                ],
-                'track_deactive_list': [  # remark: 学生身份不提供该类目
-                    {
-                        'start_time': '2013-01-23 23:00:23',
-                        'end_time': '23:20:23',
-                        'detail': '测试一下',
-                        'status': 2,  # 0 - 已结束，1 - 进行中，2 - 待开始
-                        'code': '899b20c069d846e3b3980989dc3925b5',
-                    },
-                    {
-                        'start_time': '2013-01-23 23:00:23',
-                        'end_time': '23:00:23',
-                        'detail': '测试一下',
-                        'status': 2,  # 0 - 已结束，1 - 进行中，2 - 待开始
-                        'code': '899b20c069d846e3b3980989dc3925b5',
-                    },
-                ],
-                'track_toactive_list': [
-                    {
-                        'start_time': '2013-01-23 23:00:23',
-                        'end_time': '23:20:23',
-                        'detail': '测试一下',
-                        'status': 0,  # 0 - 已结束，1 - 进行中，2 - 待开始
-                        'code': '899b20c069d846e3b3980989dc3925b5',
-                    },
-                    {
-                        'start_time': '2013-01-23 23:00:23',
-                        'end_time': '23:20:23',
-                        'detail': '测试一下',
-                        'status': 0,  # 0 - 已结束，1 - 进行中，2 - 待开始
-                        'code': '899b20c069d846e3b3980989dc3925b5',
-                    },
-                ]
-            }
+            'questions_num': '{}/{}'.format(counter.solved_question_num, counter.question_num),
+            'notice_num': counter.notice_num,
+            'teach_schedulers': teach_schedulers,
         }
 
         return DictResponse(r=0, data=lesson_index_info)
 
 
+class SignInView(HandleAPIView):
+    """课堂签到
+    """
+
+    @staticmethod
+    def _location(data):
+        """请求中的定位 (latitude, longitude)，缺失时为 (None, None)
+        """
+        latitude, longitude = data.get('latitude'), data.get('longitude')
+        if latitude in (None, '') or longitude in (None, ''):
+            return None, None
+        latitude, longitude = float(latitude), float(longitude)
+        assert -90 <= latitude <= 90 and -180 <= longitude <= 180, '无效的定位'
+        return latitude, longitude
+
+    def post(self, request, **_):
+        """学生签到，签到写入数据库后返回
+
+        :param: latitude/longitude 学生定位，签到设置了签到范围时必填
+        :return:
+            {'r': 0/1,
+             'errmsg': 失败原因,
+             'data': {'status': success/duplicated/rejected, 'errmsg': ..., 'distance': 与签到中心的距离(米)}}
+        """
+        try:
+            event_id = int(request.data.get('event_id'))
+            latitude, longitude = self._location(request.data)
+        except (TypeError, ValueError):
+            return DictResponse(errmsg='无效的签到事件或定位')
+        except AssertionError as e:
+            return DictResponse(errmsg=e)
+
+        future = sign_in.sign_in_buffer.submit(event_id, request.user.id, latitude, longitude)
+        try:
+            result = future.result(timeout=gdata.SIGN_IN_ACK_TIMEOUT)
+        except FutureTimeoutError:
+            _logger.warning('SignInView, sign-in of [UserProfile:{}] timed out'.format(request.user.id))
+            return DictResponse(errmsg='签到繁忙，请稍后重试')
+        except Exception as e:
+            # 写入失败时同一签到事件的所有请求都带有该异常，错误栈已由 SignInBuffer.flush 记录
+            _logger.warning('SignInView, sign-in of [UserProfile:{}] failed: {}'.format(request.user.id, e))
+            return DictResponse(errmsg='签到失败，请稍后重试')
+
+        is_success = result['status'] == gdata.SIGN_IN_SUCCESS
+        return DictResponse(r=0 if is_success else 1, errmsg=result['errmsg'], data=result)
+
+    def put(self, request, **_):
+        """教师发起签到
+
+        :param:
+            lesson_code: 班课码
+            duration: 持续时间(分钟)，默认 gdata.SIGN_IN_DEFAULT_DURATION
+            latitude/longitude/radius: 签到中心及半径(米)，不设置时不校验学生定位
+        :return: {'r': 0, 'data': {'code': 签到事件id}}
+        """
+        try:
+            ref = mc.QueryLesson.resolve_lesson_code(request.data['lesson_code'])
+            assert ref and ref[1] == request.user.id, '班课不存在'
+            duration = int(request.data.get('duration') or gdata.SIGN_IN_DEFAULT_DURATION)
+            assert duration > 0, '无效的签到时长'
+            latitude, longitude = self._location(request.data)
+            radius = request.data.get('radius')
+            radius = int(radius) if latitude is not None and radius not in (None, '') else None
+            assert radius is None or 0 < radius <= gdata.SIGN_IN_MAX_RADIUS, '无效的签到范围'
+        except (KeyError, TypeError, ValueError, AssertionError) as e:
+            _logger.warning('SignInView put error: {}'.format(e))
+            return DictResponse(errmsg=e)
+
+        now = timezone.now()
+        event = models.TeachingEventTracker.objects.create(
+            lesson_id=ref[0], event_type=gdata.EVENT_SIGN, start_time=now,
+            end_time=now + datetime.timedelta(minutes=duration),
+            latitude=latitude if radius else None, longitude=longitude if radius else None, radius=radius)
+        return DictResponse(r=0, data={'code': str(event.id)})
+
+
+class FaceSignInView(HandleAPIView):
+    """整班人脸签到
+
+    :remark:
+        * 图片数及大小上限由比对后端决定(face_recognition.BaseFaceBackend.batch_max_images / batch_image_max_size)
+        * AIP后端支持合照(每张最多 gdata.AIP_GROUP_PHOTO_MAX_FACES 张人脸)，本地比对每张图片按一张人脸处理
+    """
+
+    def post(self, request, **_):
+        """教师上传多张学生人脸，与班课全部学生比对后统一签到
+
+        :param: event_id 签到事件id, faces 人脸图片(multipart，可多张，AIP后端可以是合照)
+        :return:
+            {'r': 0,
+             'data': {
+                'signed_num': 本次签到成功人数,
+                'students': [
+                    {'id': ..., 'nickName': ..., 'score': 最高得分, 'status': success/duplicated/rejected/''},
+                    ...
+                ],  # 班课中已录入人脸的学生，按得分降序
+             }}
+        """
+        _ = self
+        try:
+            event_id = int(request.data.get('event_id'))
+        except (TypeError, ValueError):
+            return DictResponse(errmsg='无效的签到事件')
+
+        teacher_id = models.TeachingEventTracker.objects.filter(
+            pk=event_id, event_type=gdata.EVENT_SIGN).values_list('lesson__teacher_id', flat=True).first()
+        if teacher_id != request.user.id:
+            return DictResponse(errmsg='签到不存在')
+
+        backend = face_recognition.get_face_backend()
+        faces = request.FILES.getlist('faces')
+        if not faces or len(faces) > backend.batch_max_images:
+            return DictResponse(errmsg='请上传1~{}张人脸图片'.format(backend.batch_max_images))
+        if any(_f.size > backend.batch_image_max_size for _f in faces):
+            return DictResponse(errmsg='图片过大')
+
+        try:
+            # 逐张读取，本地比对时内存中只有一张图片
+            report = sign_in.verify_faces(event_id, (_f.read() for _f in faces), backend)
+        except (RateLimitError, FutureTimeoutError) as e:
+            _logger.warning('face sign-in of event {} failed: {!r}'.format(event_id, e))
+            return DictResponse(errmsg='人脸比对繁忙，请稍后重试')
+        scores, results = report['scores'], report['results']
+        nick_names = dict(models.UserProfile.objects.filter(id__in=scores).values_list('id', 'nickName'))
+        students = [{
+            'id': _id,
+            'nickName': nick_names.get(_id, ''),
+            'score': round(_score, 4),
+            'status': results[_id]['status'] if _id in results else '',
+        } for _id, _score in sorted(scores.items(), key=lambda _s: _s[1], reverse=True)]
+        signed_num = sum(1 for _r in results.values() if _r['status'] == gdata.SIGN_IN_SUCCESS)
+        return DictResponse(r=0, data={'signed_num': signed_num, 'students': students})
+
+
+class RollCallView(HandleAPIView):
+    """随机点名
+
+    :remark:
+        * 同一次点名内不重复点到同一学生(已点到的学生记录在共享缓存中，与处理请求的进程无关)，全部点过后返回 r=1
+    """
+
+    def put(self, request, **_):
+        """教师发起点名
+
+        :return: {'r': 0, 'data': {'code': 点名事件id, 'student_num': 学生数}}
+        """
+        _ = self
+        try:
+            ref = mc.QueryLesson.resolve_lesson_code(request.data['lesson_code'])
+            assert ref and ref[1] == request.user.id, '班课不存在'
+        except (KeyError, AssertionError) as e:
+            _logger.warning('RollCallView put error: {}'.format(e))
+            return DictResponse(errmsg=e)
+
+        event = models.TeachingEventTracker.objects.create(lesson_id=ref[0], event_type=gdata.EVENT_CALL,
+                                                           start_time=timezone.now())
+        session = roll_call.get_session(event.id)
+        return DictResponse(r=0, data={'code': str(event.id), 'student_num': session.remaining})
+
+    def post(self, request, **_):
+        """点名，随机抽取一名未点到的学生
+
+        :return:
+            {'r': 0,
+             'data': {
+                'student': {'id': ..., 'nickName': ..., 'avatarUrl': ...},
+                'called_num': 已点人数,
+                'remaining': 未点人数,
+             }}
+        """
+        _ = self
+        try:
+            event_id = int(request.data.get('event_id'))
+        except (TypeError, ValueError):
+            return DictResponse(errmsg='无效的点名事件')
+
+        session = roll_call.get_session(event_id)
+        if session is None or session.teacher_id != request.user.id:
+            return DictResponse(errmsg='点名不存在')
+
+        student_id = session.draw()
+        if student_id is None:
+            return DictResponse(errmsg='全部学生已点名', data={'called_num': session.called_num, 'remaining': 0})
+
+        called_num = session.called_num
+        models.TeachingEventTracker.objects.filter(pk=event_id).update(join_num=called_num)
+        student = mc.QueryUserProfileHelper.query_user_by_id(student_id)
+        return DictResponse(r=0, data={
+            'student': {
+                'id': student_id,
+                'nickName': getattr(student, 'nickName', ''),
+                'avatarUrl': getattr(student, 'avatarUrl', None),
+            },
+            'called_num': called_num,
+            'remaining': session.remaining,
+        })
+
+
+class QRCodeView(HandleAPIView):
+    """二维码图片
+
+    :remark:
+        * 图片在内存中生成并按内容缓存，内容不变，允许客户端长期缓存
+        * 只渲染存在的二维码(有效的扫码登录会话或已创建的班课码)，其余返回404
+    """
+
+    authentication_classes = []
+
+    @staticmethod
+    def _exists(code):
+        if qr_login.get_qr_login_store().fetch(code) is not None:
+            return True
+        return models.Lesson.objects.filter(lesson_code=code).exists()
+
+    def get(self, request, code, fmt, **_):
+        _ = request
+        if not self._exists(code):
+            return HttpResponse(status=status.HTTP_404_NOT_FOUND)
+        try:
+            data = utils.QRCodeHelper.render(code, fmt)
+        except AssertionError as e:
+            _logger.warning('QRCodeView, failed to render qr code, error:{}'.format(e))
+            return HttpResponse(status=status.HTTP_400_BAD_REQUEST)
+
+        response = HttpResponse(data, content_type=utils.QRCodeHelper.CONTENT_TYPES[fmt])
+        response['Cache-Control'] = 'public, max-age={}, immutable'.format(gdata.QR_CODE_MAX_AGE)
+        return response
+
+
 class FileAPIView(APIView):
     """文件上传
     """
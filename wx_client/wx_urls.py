@@ -9,7 +9,8 @@ urlpatterns = [
     # POST    upload file resource
     url(r'^file/$', views.FileAPIView.as_view()),
 
-    # GET     generate 10000 lesson-code http://134.175.27.71:8008/api/v1/wx_client/generate_code/
+    # GET     progress of the lesson-code generating job
+    # POST    generate lesson-codes in background, `num` default 10000
     url(r'^generate_code/$', views.LessonCodeAPIView.as_view()),
 
     # POST    face feature record
@@ -34,11 +35,25 @@ urlpatterns = [
     # GET     get overview-information of page named `lesson-index`
     url(r'^lesson-index/overview/$', views.LessonIndexPageOverview.as_view()),
 
+    # POST    sign in a sign-in event of the lesson
+    # PUT     start a sign-in event, optionally limited to a radius around a location
+    url(r'^lesson/sign-in$', views.SignInView.as_view()),
+
+    # POST    sign in the students recognized in the uploaded faces (teacher)
+    url(r'^lesson/sign-in/faces$', views.FaceSignInView.as_view()),
+
+    # PUT     start a roll call of the lesson
+    # POST    call a random student who has not been called yet
+    url(r'^lesson/roll-call$', views.RollCallView.as_view()),
+
     # GET     get sayings list
     # POST    publish saying
     # DELETE
     url(r'^saying/$', views.SayView.as_view()),
 
+    # GET     qr code image of lesson code or login uuid
+    url(r'^qrcode/(?P<code>[A-Za-z0-9]{1,64})\.(?P<fmt>png|svg)$', views.QRCodeView.as_view()),
+
     # put     scanf qr_code for login on Browser
     url(r'^browser/operation$', views.BrowserQRLogin.as_view())
 ]